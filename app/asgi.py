@@ -0,0 +1,164 @@
+# app/asgi.py
+# Async serving mode: the routes of app/main.py as non-blocking Starlette handlers. Both run the same route logic
+# (app/handlers.py, app/signup.py); here it reaches Stripe through the *_async methods (httpx) and Postgres through
+# asyncpg (see app/flow.py), so a request waiting on either holds no thread.
+# Run with: uvicorn app.asgi:app
+import asyncio
+import functools
+import logging
+import time
+from contextlib import asynccontextmanager
+from typing import Any, Awaitable, Callable, Dict
+
+from starlette.applications import Starlette
+from starlette.exceptions import HTTPException
+from starlette.requests import Request
+from starlette.responses import HTMLResponse, JSONResponse, Response
+from starlette.routing import Route
+
+from app import flow, handlers, metrics, profiling, signup, stripe_client
+from app.async_database import get_async_database
+from app.main import create_app
+
+logger = logging.getLogger(__name__)
+
+routes = []
+
+
+def route(path: str, methods: tuple = ('GET',)):
+    """
+    Registers a handler under path and records its latency under the path pattern, like the Flask after_request hook.
+    Profiles the request when asked to (see app/profiling.py). Samples are taken from the event loop thread, so they
+    include whatever else the loop ran meanwhile; the spans only cover the request's own task.
+    """
+    def decorator(handler: Callable[[Request], Awaitable[Response]]):
+        @functools.wraps(handler)
+        async def timed(request: Request) -> Response:
+            started = time.perf_counter()
+            status = '500'
+            profiled = profiling.request_profiled(request.headers.get(profiling.PROFILE_HEADER))
+            try:
+                with profiling.profile(f"request-{request.method}-{path}", enabled=profiled) as trace:
+                    response = await handler(request)
+                if trace is not None:
+                    response.headers[profiling.PROFILE_ID_HEADER] = trace.name
+                status = str(response.status_code)
+                return response
+            except HTTPException as e:
+                status = str(e.status_code)
+                raise
+            finally:
+                metrics.HTTP_REQUEST_DURATION.observe(time.perf_counter() - started, path, request.method, status)
+        routes.append(Route(path, timed, methods=list(methods)))
+        return handler
+    return decorator
+
+
+async def json_body(request: Request) -> Dict[str, Any]:
+    # Same failures as Flask's request.json: 415 without a JSON content type, 400 for a body that does not parse
+    if request.headers.get('content-type', '').split(';')[0].strip() != 'application/json':
+        raise HTTPException(415)
+    try:
+        return await request.json()
+    except ValueError:
+        raise HTTPException(400)
+
+
+def error(message: str, status_code: int) -> JSONResponse:
+    return JSONResponse({'error': message}, status_code=status_code)
+
+
+def respond(outcome: tuple) -> Response:
+    # Builds the response of shared route logic (app/handlers.py): a dict body is JSON, a str is sent as text
+    body, status = outcome
+    if isinstance(body, dict):
+        return JSONResponse(body, status_code=status)
+    return HTMLResponse(body, status_code=status)
+
+def discard(task: asyncio.Task) -> None:
+    # Stops a task whose result is no longer needed without leaving an unretrieved exception behind
+    task.cancel()
+    task.add_done_callback(lambda done: done.cancelled() or done.exception())
+
+
+@route('/')
+async def hello_world(request: Request) -> Response:
+    return HTMLResponse('Hello, World!')
+
+@route('/submit-application', methods=('POST',))
+async def submit_application(request: Request) -> Response:
+    form, message = signup.parse_signup(await json_body(request), request.headers.get(signup.SIGNUP_KEY_HEADER))
+    if message:
+        return error(message, 400)
+    # The two duplicate checks are independent, the Stripe one (mirror, else Customer.list) runs as a task meanwhile
+    stripe_check = asyncio.create_task(flow.run_async(signup.stripe_check(form)))
+
+    async def wait_for_stripe_check() -> tuple:
+        return await stripe_check
+
+    try:
+        return respond(await flow.run_async(signup.submit(form, flow.Call(None, wait_for_stripe_check))))
+    finally:
+        if not stripe_check.done():
+            # Answered (or failed) before it was needed
+            discard(stripe_check)
+
+@route('/add-payment', methods=('POST',))
+async def add_payment(request: Request) -> Response:
+    return respond(await flow.run_async(handlers.add_payment(await json_body(request))))
+
+@route('/customer-payment-methods', methods=('POST',))
+async def customer_payment_methods(request: Request) -> Response:
+    return respond(await flow.run_async(handlers.customer_payment_methods(await json_body(request))))
+
+@route('/set-default-payment-method', methods=('POST',))
+async def set_default_payment_method(request: Request) -> Response:
+    return respond(await flow.run_async(handlers.set_default_payment_method(await json_body(request))))
+
+@route('/process-charges', methods=('POST',))
+async def process_charges_route(request: Request) -> Response:
+    # An authorized X-Profile header profiles the run itself, not just this request
+    profile = profiling.authorized(request.headers.get(profiling.PROFILE_HEADER))
+    return respond(await flow.run_async(handlers.process_charges(await json_body(request), profile)))
+
+@route('/charge-jobs/{job_id:int}')
+async def charge_job_status(request: Request) -> Response:
+    return respond(await flow.run_async(handlers.charge_job_status(request.path_params['job_id'])))
+
+@route('/webhook', methods=('POST',))
+async def webhook(request: Request) -> Response:
+    payload = await request.body()
+    sig_header = request.headers.get('stripe-signature')
+    if sig_header is None:
+        raise HTTPException(400)
+    return respond(await flow.run_async(handlers.webhook(payload, sig_header)))
+
+@route('/webhook-inbox-stats')
+async def webhook_inbox_stats(request: Request) -> Response:
+    return respond(await flow.run_async(handlers.webhook_inbox_stats()))
+
+@route('/pool-stats')
+async def pool_stats(request: Request) -> Response:
+    return JSONResponse(get_async_database().stats(), status_code=200)
+
+@route('/metrics')
+async def metrics_endpoint(request: Request) -> Response:
+    metrics.update_pool_metrics(get_async_database().stats())
+    return Response(metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+
+@asynccontextmanager
+async def lifespan(app: Starlette):
+    stripe_client.configure()
+    await get_async_database().open()
+    # The charge job and chunk, webhook inbox, email outbox and scheduler workers are threads on the sync pool,
+    # started here (after any fork of the server) in the context of a Flask app of their own
+    workers = create_app().extensions['background_workers']
+    try:
+        yield
+    finally:
+        workers.stop(timeout=0)
+        await get_async_database().close()
+
+
+app = Starlette(routes=routes, lifespan=lifespan)
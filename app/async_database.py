@@ -0,0 +1,116 @@
+# app/async_database.py
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from typing import Any, Dict
+
+from app.config import Config
+from app.database import PoolTimeout
+from app.lazy import lazy_import
+
+asyncpg = lazy_import('asyncpg')
+
+
+class AsyncDatabase:
+    def __init__(self, database_url, minconn=None, maxconn=None, timeout=None):
+        """
+        Wraps an asyncpg connection pool for the ASGI app. The pool itself is created by open() inside the event loop.
+        :param database_url: A string containing the database connection information.
+        :param minconn: Connections opened up front. Defaults to Config.DB_ASYNC_POOL_MIN.
+        :param maxconn: Upper bound on open connections. Defaults to Config.DB_ASYNC_POOL_MAX.
+        :param timeout: Seconds to wait for a free connection before raising PoolTimeout. Defaults to Config.DB_POOL_TIMEOUT.
+        """
+        self.database_url = database_url
+        self.minconn = Config.DB_ASYNC_POOL_MIN if minconn is None else minconn
+        self.maxconn = Config.DB_ASYNC_POOL_MAX if maxconn is None else maxconn
+        self.timeout = Config.DB_POOL_TIMEOUT if timeout is None else timeout
+        self._pool: asyncpg.Pool | None = None
+        self._waiting = 0
+        self._stats = {
+            'checkouts': 0,
+            'timeouts': 0,
+            'wait_seconds_total': 0.0,
+            'wait_seconds_max': 0.0
+        }
+
+    async def open(self) -> None:
+        """
+        Opens the pool. asyncpg prepares and caches statements per connection on its own; the cache is disabled
+        unless Config.DB_PREPARED_STATEMENTS is on, for the same pgbouncer reason as the sync pool.
+        """
+        if self._pool is None:
+            self._pool = await asyncpg.create_pool(
+                self.database_url,
+                min_size=self.minconn,
+                max_size=self.maxconn,
+                statement_cache_size=100 if Config.DB_PREPARED_STATEMENTS else 0
+            )
+
+    async def close(self) -> None:
+        """
+        Closes every connection in the pool, waiting for checked out connections to be released.
+        """
+        if self._pool is not None:
+            pool, self._pool = self._pool, None
+            await pool.close()
+
+    @asynccontextmanager
+    async def transaction(self):
+        """
+        Checks a connection out of the pool and yields it inside a transaction (committed on success, rolled back
+        on error). Waits up to the checkout timeout when every connection is in use.
+        :raises PoolTimeout: If no connection is available in time.
+        """
+        if self._pool is None:
+            raise RuntimeError('AsyncDatabase.open() has not been awaited.')
+        started = time.monotonic()
+        self._waiting += 1
+        try:
+            connection = await self._pool.acquire(timeout=self.timeout)
+        except asyncio.TimeoutError:
+            self._stats['timeouts'] += 1
+            raise PoolTimeout(f'No database connection available after {self.timeout}s.')
+        finally:
+            self._waiting -= 1
+        waited = time.monotonic() - started
+        self._stats['checkouts'] += 1
+        self._stats['wait_seconds_total'] += waited
+        self._stats['wait_seconds_max'] = max(self._stats['wait_seconds_max'], waited)
+        try:
+            async with connection.transaction():
+                yield connection
+        finally:
+            await self._pool.release(connection)
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Returns pool size, utilization and checkout wait statistics, with the same keys as Database.stats().
+        """
+        stats = dict(self._stats)
+        size = self._pool.get_size() if self._pool is not None else 0
+        idle = self._pool.get_idle_size() if self._pool is not None else 0
+        in_use = size - idle
+        stats.update({
+            'size': size,
+            'idle': idle,
+            'in_use': in_use,
+            'waiting': self._waiting,
+            'maxconn': self.maxconn,
+            'utilization': in_use / self.maxconn if self.maxconn else 0.0,
+            'wait_seconds_avg': stats['wait_seconds_total'] / stats['checkouts'] if stats['checkouts'] else 0.0
+        })
+        return stats
+
+
+_async_database = None
+
+
+def get_async_database() -> AsyncDatabase:
+    """
+    Returns the process-wide AsyncDatabase, creating it (unopened) on first use. Everything runs on one event
+    loop, so no lock is needed.
+    """
+    global _async_database
+    if _async_database is None:
+        _async_database = AsyncDatabase(Config.DATABASE_URL)
+    return _async_database
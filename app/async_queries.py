@@ -0,0 +1,297 @@
+# app/async_queries.py
+import json
+import logging
+import time
+from contextlib import asynccontextmanager
+from typing import Any, Dict, List
+
+from app import metrics, profiling, sql
+from app.async_database import AsyncDatabase, get_async_database
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncQueries:
+    """
+    asyncpg counterparts of the Queries methods behind the request handlers of the ASGI app. Statements are the same
+    as in Queries, with $n parameters, and return the same shapes.
+    """
+    def __init__(self, db: AsyncDatabase | None = None):
+        """
+        :param db: The database to run queries against. Defaults to the process-wide async database.
+        """
+        self._db = db
+
+    @property
+    def db(self) -> AsyncDatabase:
+        return self._db or get_async_database()
+
+    @asynccontextmanager
+    async def _connection(self, query: str):
+        """
+        Yields a pooled connection inside a transaction for one call and records the block's duration, checkout
+        included, under the query label (the same series the sync Queries methods report to) and as a 'db.<query>'
+        span when profiling.
+        """
+        started = time.perf_counter()
+        try:
+            async with self.db.transaction() as conn:
+                yield conn
+        except Exception:
+            metrics.DB_QUERY_ERRORS.inc(query)
+            raise
+        finally:
+            duration = time.perf_counter() - started
+            metrics.DB_QUERY_DURATION.observe(duration, query)
+            profiling.record_span(f"db.{query}", started, duration)
+
+    async def check_existence(self, table_name: str, fields: List[str], values: List[Any]) -> bool:
+        """
+        Checks if any records match the specified fields and values in the specified table of the database.
+
+        Parameters:
+        - table_name (str): The name of the table to search.
+        - fields (List[str]): The fields to query against.
+        - values (List[Any]): The values corresponding to each field.
+
+        Returns:
+        - bool: True if at least one record matches the criteria, False otherwise.
+
+        Raises:
+        - Exception: Propagates any exceptions caught during database operations.
+        """
+        if len(fields) != len(values):
+            raise ValueError('Fields and values count mismatch.')
+
+        query = sql.to_positional(sql.compile_query('exists', table_name, tuple(fields)))
+
+        try:
+            async with self._connection('check_existence') as conn:
+                return await conn.fetchval(query, *values) is not None
+        except Exception as e:
+            logger.error(f"Failed to communicate with database: {e}")
+            raise
+
+    async def insert_record(self, table_name: str, data: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Inserts a record into the specified table in the database.
+
+        Parameters:
+        - table_name (str): The name of the table where the data will be inserted.
+        - data (Dict[str, Any]): A dictionary where keys are column names and values are the data to insert.
+
+        Returns:
+        - Dict[str, Any]: A dictionary containing a success message.
+
+        Raises:
+        - Exception: Propagates any exceptions caught during database operations.
+        """
+        query = sql.to_positional(sql.compile_query('insert', table_name, tuple(data.keys())))
+
+        try:
+            async with self._connection('insert_record') as conn:
+                await conn.execute(query, *data.values())
+                return {'message': 'Record inserted successfully.'}
+        except Exception as e:
+            logger.error(f"Failed to insert record into database: {e}")
+            raise
+
+    async def mirror_customer_lookup(self, email: str | None, phone: str | None,
+                                     signup_key: str | None = None) -> Dict[str, Any] | None:
+        """
+        Looks up a live customer with the given normalized email or phone in the local Stripe customer mirror,
+        preferring the one created by the signup with signup_key.
+
+        Parameters:
+        - email (str | None): The normalized email.
+        - phone (str | None): The normalized phone number.
+        - signup_key (str | None): The idempotency key of the signup being checked.
+
+        Returns:
+        - Dict[str, Any] | None: The matching customer's 'customer_id' and 'signup_key', or None if none matches.
+
+        Raises:
+        - Exception: Propagates any exceptions caught during database operations.
+        """
+        query = """
+        SELECT customer_id, signup_key FROM stripe_customers
+        WHERE NOT deleted AND (email_normalized = $1 OR phone_normalized = $2)
+        ORDER BY signup_key IS NOT DISTINCT FROM $3 DESC
+        LIMIT 1
+        """
+
+        try:
+            async with self._connection('mirror_customer_lookup') as conn:
+                record = await conn.fetchrow(query, email, phone, signup_key)
+                return dict(record) if record else None
+        except Exception as e:
+            logger.error(f"Failed to communicate with database: {e}")
+            raise
+
+    async def fetch_mirror_state(self) -> Dict[str, Any]:
+        """
+        Fetches when the Stripe customer mirror was last synced.
+
+        Returns:
+        - Dict[str, Any]: State names ('full_sync', 'event') mapped to their timestamps.
+
+        Raises:
+        - Exception: Propagates any exceptions caught during database operations.
+        """
+        try:
+            async with self._connection('fetch_mirror_state') as conn:
+                rows = await conn.fetch("SELECT name, synced_at FROM stripe_mirror_state")
+                return {row['name']: row['synced_at'] for row in rows}
+        except Exception as e:
+            logger.error(f"Failed to communicate with database: {e}")
+            raise
+
+    async def enqueue_charge_job(self, type_code: str | None, run_id: int | None = None, priority: int = 0,
+                                 profile: bool = False) -> int | None:
+        """
+        Adds a charge job to the queue, unless the type code already has a queued or running job.
+
+        Parameters:
+        - type_code (str | None): The customer type code to charge. Looked up from the run when resuming.
+        - run_id (int | None): An existing charge run to resume instead of starting a new one.
+        - priority (int): Claim order and Stripe limiter priority of the job; higher goes first.
+        - profile (bool): Run the job, and the chunks of its run, under the sampling profiler.
+
+        Returns:
+        - int | None: The ID of the queued job, or None if the type code already has an open job.
+
+        Raises:
+        - Exception: Propagates any exceptions caught during database operations.
+        """
+        query = """
+        INSERT INTO charge_jobs (type_code, run_id, priority, profile)
+        SELECT coalesce($1, (SELECT type_code FROM charge_runs WHERE id = $2)), $2, $3, $4
+        ON CONFLICT DO NOTHING
+        RETURNING id
+        """
+
+        try:
+            async with self._connection('enqueue_charge_job') as conn:
+                return await conn.fetchval(query, type_code, run_id, priority, profile)
+        except Exception as e:
+            logger.error(f"Failed to enqueue charge job: {e}")
+            raise
+
+    async def fetch_open_charge_job(self, type_code: str | None, run_id: int | None = None) -> Dict[str, Any] | None:
+        """
+        Fetches the queued or running charge job of a type code (or of the type code of a run).
+
+        Parameters:
+        - type_code (str | None): The customer type code.
+        - run_id (int | None): A charge run whose type code is used when type_code is None.
+
+        Returns:
+        - Dict[str, Any] | None: The open job, or None if there is none.
+
+        Raises:
+        - Exception: Propagates any exceptions caught during database operations.
+        """
+        query = """
+        SELECT * FROM charge_jobs
+        WHERE type_code = coalesce($1, (SELECT type_code FROM charge_runs WHERE id = $2))
+          AND status IN ('queued', 'running')
+        """
+
+        try:
+            async with self._connection('fetch_open_charge_job') as conn:
+                record = await conn.fetchrow(query, type_code, run_id)
+                return dict(record) if record else None
+        except Exception as e:
+            logger.error(f"Failed to communicate with database: {e}")
+            raise
+
+    async def fetch_charge_job_progress(self, job_id: int) -> Dict[str, Any] | None:
+        """
+        Fetches a charge job together with its run's progress, counted from the run ledger.
+
+        Parameters:
+        - job_id (int): The ID of the job.
+
+        Returns:
+        - Dict[str, Any] | None: The job with 'processed', 'successes', 'failures' and 'elapsed_seconds', or None if no job has that ID.
+
+        Raises:
+        - Exception: Propagates any exceptions caught during database operations.
+        """
+        query = """
+        SELECT j.*,
+               count(a.customer_id) AS processed,
+               count(a.customer_id) FILTER (WHERE a.status = 'success') AS successes,
+               count(a.customer_id) FILTER (WHERE a.status = 'failure') AS failures,
+               extract(epoch FROM coalesce(j.finished_at, now()) - j.started_at) AS elapsed_seconds
+        FROM charge_jobs j
+        LEFT JOIN charge_attempts a ON a.run_id = j.run_id
+        WHERE j.id = $1
+        GROUP BY j.id
+        """
+
+        try:
+            async with self._connection('fetch_charge_job_progress') as conn:
+                record = await conn.fetchrow(query, job_id)
+                return dict(record) if record else None
+        except Exception as e:
+            logger.error(f"Failed to communicate with database: {e}")
+            raise
+
+    async def insert_webhook_event(self, event: Dict[str, Any]) -> bool:
+        """
+        Persists a verified Stripe event to the webhook inbox. Redeliveries of an event already in the inbox are ignored.
+
+        Parameters:
+        - event (Dict[str, Any]): The verified Stripe event.
+
+        Returns:
+        - bool: True if the event is new, False if it was a duplicate delivery.
+
+        Raises:
+        - Exception: Propagates any exceptions caught during database operations.
+        """
+        query = """
+        INSERT INTO webhook_events (event_id, type, payload, stripe_created)
+        VALUES ($1, $2, $3, to_timestamp($4))
+        ON CONFLICT (event_id) DO NOTHING
+        """
+
+        try:
+            async with self._connection('insert_webhook_event') as conn:
+                status = await conn.execute(query, event['id'], event['type'], json.dumps(event), event.get('created'))
+                # asyncpg returns the command tag, e.g. 'INSERT 0 1'
+                return status.endswith(' 1')
+        except Exception as e:
+            logger.error(f"Failed to store webhook event: {e}")
+            raise
+
+    async def webhook_inbox_stats(self, max_attempts: int) -> Dict[str, Any]:
+        """
+        Summarizes the webhook inbox backlog.
+
+        Parameters:
+        - max_attempts (int): The attempt count after which an event is considered dead.
+
+        Returns:
+        - Dict[str, Any]: 'backlog', 'dead' and 'lag_seconds', as Queries.webhook_inbox_stats.
+
+        Raises:
+        - Exception: Propagates any exceptions caught during database operations.
+        """
+        query = """
+        SELECT count(*) FILTER (WHERE attempts < $1) AS backlog,
+               count(*) FILTER (WHERE attempts >= $1) AS dead,
+               coalesce(extract(epoch FROM now() - min(received_at) FILTER (WHERE attempts < $1)), 0) AS lag_seconds
+        FROM webhook_events
+        WHERE processed_at IS NULL
+        """
+
+        try:
+            async with self._connection('webhook_inbox_stats') as conn:
+                record = dict(await conn.fetchrow(query, max_attempts))
+                record['lag_seconds'] = float(record['lag_seconds'])
+                return record
+        except Exception as e:
+            logger.error(f"Failed to communicate with database: {e}")
+            raise
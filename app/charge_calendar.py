@@ -1,84 +1,97 @@
 # app/charge_calendar.py
-import stripe
 import logging
-from typing import List, Dict
+import os
+import socket
+import threading
+import time
+from collections import Counter
+from typing import Callable, List, Dict
+from concurrent.futures import ThreadPoolExecutor
+from app.config import Config
 from app.queries import Queries
-import json
+from app import charge_errors, mailer, metrics, profiling, stripe_client
+from app.payment_profiles import list_payment_profiles, listing_pays_off, resolve_payment_profile
+from app.pipeline import imap_unordered
+from app.reports import REPORT_FIELDS, ChargeReportWriter
+from app.lazy import lazy_import
 import datetime
 
+stripe = lazy_import('stripe')
+
 queries = Queries()
 
 logger = logging.getLogger(__name__)
 
 
-def charge_customer(customer_id: str, amount: int, card_upcharge: int) -> Dict[str, any]:
+def charge_customer(customer_id: str, amount: int, card_upcharge: int, idempotency_key: str | None = None,
+                    profile: Dict[str, any] | None = None, metadata: Dict[str, str] | None = None) -> Dict[str, any]:
     response = {
         'customer_id': customer_id,
         'amount_charged': 0,
         'charge_type': '',
         'status': '',
-        'reason': ''
+        'reason': '',
+        'failure_type': None,
+        'failure_code': None,
+        'payment_intent_id': None,
+        'payment_intent_status': None
     }
-    try:
-        # Retrieve the customer object
-        customer = stripe.Customer.retrieve(customer_id)
-        response['amount_charged'] = amount
-    except stripe.InvalidRequestError as e:
-        response['status'] = 'failure'
-        response['reason'] = 'Customer does not exist in Stripe'
-        return response
-    except stripe.StripeError as e:
+    if profile is None:
+        # Not prefetched, resolve the customer's default payment method inline
+        profile = resolve_payment_profile(customer_id)
+
+    if profile.get('error'):
         response['status'] = 'failure'
-        response['reason'] = 'Unrecognized Stripe error'
+        response['reason'] = profile['error']
+        response['failure_type'] = profile.get('failure_type', charge_errors.TRANSIENT)
+        response['failure_code'] = profile.get('failure_code')
         return response
-    
-    if hasattr(customer, 'deleted') and customer.deleted:
+    response['amount_charged'] = amount
+
+    if profile['deleted']:
         response['status'] = 'failure'
-        response['reason'] = 'Customer has been deleted in Stripe'
+        response.update(charge_errors.failure(charge_errors.PERMANENT, 'customer_deleted', 'Customer has been deleted in Stripe'))
         return response
 
-    # Check and set default payment method if not exists
-    default_payment_method_id = customer.invoice_settings.default_payment_method
+    default_payment_method_id = profile['payment_method_id']
     if not default_payment_method_id:
-        # Retrieve and set the first available payment method
-        payment_methods = stripe.PaymentMethod.list(customer=customer_id)
-        if payment_methods.data:
-            first_payment_method = payment_methods.data[0]
-            stripe.Customer.modify(customer_id, invoice_settings={'default_payment_method': first_payment_method.id})
-            default_payment_method_id = first_payment_method.id
-        else:
-            response['status'] = 'failure'
-            response['reason'] = 'No payment methods on file'
-            return response
+        response['status'] = 'failure'
+        response.update(charge_errors.failure(charge_errors.PERMANENT, 'no_payment_method', 'No payment methods on file'))
+        return response
 
     try:
-        # Retrieve and charge using the default payment method
-        payment_method = stripe.PaymentMethod.retrieve(default_payment_method_id)
-        response['charge_type'] = payment_method.type
-        if payment_method.type == 'card':
+        # Charge using the default payment method
+        response['charge_type'] = profile['payment_method_type']
+        if profile['payment_method_type'] == 'card':
             amount += card_upcharge  # Adjust for card upcharge
 
         # Execute the charge
-        stripe.PaymentIntent.create(amount=amount, currency='usd', customer=customer_id, payment_method=default_payment_method_id, off_session=True, confirm=True)
+        with profiling.span('charge.create_payment_intent', customer_id=customer_id):
+            payment_intent = stripe_client.call(
+                stripe.PaymentIntent.create,
+                amount=amount,
+                currency='usd',
+                customer=customer_id,
+                payment_method=default_payment_method_id,
+                off_session=True,
+                confirm=True,
+                metadata=metadata or {},
+                idempotency_key=idempotency_key
+            )
         response['status'] = 'success'
         response['amount_charged'] = amount
+        # Bank debits are still 'processing' here; their payment_intent.* webhook settles the ledger entry
+        response['payment_intent_id'] = payment_intent.id
+        response['payment_intent_status'] = payment_intent.status
     except stripe.StripeError as e:
         response['status'] = 'failure'
-        response['reason'] = 'Stripe error during charging'
+        response.update(charge_errors.classify(e))
+        declined_intent = getattr(e.error, 'payment_intent', None) if e.error else None
+        if declined_intent:
+            response['payment_intent_id'] = declined_intent.get('id')
+            response['payment_intent_status'] = declined_intent.get('status')
     return response
 
-def customers_from_type_code(type_code: str) -> List[Dict]:
-    customer_data = queries.fetch_records(
-        table_name='customers',
-        fields=['customer_type'],
-        values=[type_code],
-        return_fields=['customer_id', 'email', 'phone', 'name']
-    )
-    if not customer_data:
-        logger.error("Failed to retrieve customer data.")
-        return []
-    return customer_data
-
 def fetch_charge_info(type_code: str) -> dict:
     charge_info_data = queries.fetch_records(
         table_name='charge_info',
@@ -95,27 +108,336 @@ def fetch_charge_info(type_code: str) -> dict:
     else:
         return charge_info_data[0]['data']
     
-def process_charges(type_code: str) -> None:
-    charge_info = fetch_charge_info(type_code)
-    customers = customers_from_type_code(type_code)
-    results = []
-    stats = {'total_customers': len(customers), 'charged_customers': 0}
-
-    for customer in customers:
-        result = charge_customer(customer['customer_id'], charge_info['amount'], charge_info['card_upcharge'])
+def charge_idempotency_key(run_id: int, customer_id: str, retry: int = 0) -> str:
+    # Deterministic per (run, customer): replaying a charge after a crash returns the
+    # original PaymentIntent instead of creating a second one (within Stripe's 24h window)
+    key = f"charge-run-{run_id}-{customer_id}"
+    return f"{key}-retry-{retry}" if retry else key
+
+def retry_idempotency_key(run_id: int, retry: Dict[str, any]) -> str:
+    # A decline is replayed by Stripe for its original key, other transient failures keep theirs (see charge_errors)
+    if charge_errors.needs_new_idempotency_key(retry['failure_code']):
+        return charge_idempotency_key(run_id, retry['customer_id'], retry['retry_attempts'] + 1)
+    return retry['idempotency_key']
+
+class ChargeRunLocked(RuntimeError):
+    """Raised when the type code is already being charged, by this or another process."""
+
+class ChargeChunkLost(RuntimeError):
+    """Raised when a worker's lease on a chunk expired and another worker took the chunk over."""
+
+class ChunkLease:
+    def __init__(self, run_id: int, chunk: int, worker: str):
+        """
+        Keeps a worker's lease on a chunk alive while it charges the chunk: a thread renews it every third of
+        Config.CHARGE_CHUNK_LEASE, however long the limiter, backoff or a slow Stripe call hold up the results.
+        :param run_id: The ID of the run.
+        :param chunk: The chunk number.
+        :param worker: The worker holding the lease.
+        """
+        self.run_id = run_id
+        self.chunk = chunk
+        self.worker = worker
+        self.lost = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self) -> None:
+        """
+        Starts the renewal thread.
+        """
+        self._thread = threading.Thread(target=self._work, name=f"lease-{self.run_id}-{self.chunk}", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """
+        Stops renewing (the chunk is done or released) and waits for the thread.
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def check(self) -> None:
+        """
+        Raises ChargeChunkLost once a renewal found the chunk taken over by another worker.
+        """
+        if self.lost.is_set():
+            raise ChargeChunkLost(f"Chunk {self.chunk} of charge run {self.run_id} was taken over by another worker.")
+
+    def _work(self) -> None:
+        while not self._stop.wait(Config.CHARGE_CHUNK_LEASE / 3):
+            if not self._renew_once():
+                self.lost.set()
+                return
+
+    def _renew_once(self) -> bool:
+        try:
+            return queries.renew_charge_chunk(self.run_id, self.chunk, self.worker, Config.CHARGE_CHUNK_LEASE)
+        except Exception:
+            # The lease is still ours until it runs out; try again at the next renewal
+            logger.error(f"Failed to renew the lease on chunk {self.chunk} of charge run {self.run_id}.", exc_info=True)
+            return True
+
+def chunk_worker_name() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}:{threading.current_thread().name}"
+
+def process_charges(type_code: str | None = None, workers: int | None = None, run_id: int | None = None,
+                    progress: Callable[[Dict[str, any]], None] | None = None, priority: int = 0,
+                    window_ends_at: datetime.datetime | None = None) -> int:
+    if run_id is not None:
+        run = queries.fetch_charge_run(run_id)
+        if run is None:
+            raise ValueError(f"Charge run {run_id} does not exist.")
+        type_code = run['type_code']
+    with queries.charge_lock(type_code) as locked:
+        if not locked:
+            raise ChargeRunLocked(f"Customers of type {type_code} are already being charged.")
+        return _process_charges(type_code, workers, run_id, progress, priority, window_ends_at)
+
+def _process_charges(type_code: str, workers: int | None, run_id: int | None,
+                     progress: Callable[[Dict[str, any]], None] | None, priority: int,
+                     window_ends_at: datetime.datetime | None) -> int:
+    # Coordinates the run: splits its customers into chunks, works on them alongside any chunk workers
+    # (ChargeChunkRunner, in this or other processes and hosts), retries transient failures and merges the results
+    if run_id is None:
+        charge_info = fetch_charge_info(type_code)
+        if not charge_info:
+            # Unknown or ambiguous type code: fail the job with a reason instead of opening chunks that cannot be charged
+            raise ValueError(f"No unique charge info for type code {type_code}.")
+        run_id = queries.create_charge_run(type_code, charge_info)
+    else:
+        charge_info = queries.fetch_charge_run(run_id)['charge_info']
+        logger.info(f"Resuming charge run {run_id}.")
+
+    window = 0.0
+    if window_ends_at is not None:
+        # Chunks become claimable one after another, so the run is spread over what is left of the window
+        window = (window_ends_at - datetime.datetime.now(datetime.timezone.utc)).total_seconds()
+    total = queries.open_charge_chunks(run_id, type_code, Config.CHARGE_CHUNK_SIZE, priority, window)
+    stats = {
+        'run_id': run_id,
+        'expected_customers': total,
+        'total_customers': total
+    }
+    if progress:
+        progress(stats)
+
+    def heartbeat(result: Dict[str, any] | None = None) -> None:
+        if progress:
+            progress(stats)
+
+    worker = chunk_worker_name()
+    try:
+        while True:
+            chunk = queries.claim_charge_chunk(worker, Config.CHARGE_CHUNK_LEASE, run_id=run_id)
+            if chunk is not None:
+                work_chunk(chunk, worker, workers, heartbeat)
+                continue
+            counts = queries.fetch_charge_chunk_counts(run_id)
+            if not counts.get('queued') and not counts.get('running'):
+                break
+            # The rest is leased by other workers, or not claimable yet in a windowed run
+            heartbeat()
+            time.sleep(Config.JOB_POLL_INTERVAL)
+        stats['retried'] = retry_transient_failures(run_id, charge_info, priority, workers, heartbeat)
+    except Exception:
+        try:
+            _finish_run(run_id, stats, 'failed')
+        except Exception:
+            logger.error(f"Failed to close charge run {run_id}.", exc_info=True)
+        raise
+
+    if counts.get('failed'):
+        _finish_run(run_id, stats, 'failed')
+        raise RuntimeError(f"{counts['failed']} chunks of charge run {run_id} failed; resume the run to retry them.")
+    _finish_run(run_id, stats, 'completed')
+    if Config.CHARGE_FAILURE_EMAILS:
+        # Only queued here, the outbox worker sends them so the run is not held up by SendGrid
+        try:
+            mailer.queue_charge_failure_emails(run_id)
+        except Exception:
+            logger.error(f"Failed to queue update payment emails for charge run {run_id}.", exc_info=True)
+    if not stats['total_customers']:
+        logger.error("Failed to retrieve customer data.")
+    return run_id
+
+def retry_transient_failures(run_id: int, charge_info: Dict[str, any], priority: int = 0, workers: int | None = None,
+                             heartbeat: Callable[..., None] | None = None) -> int:
+    """
+    Works through the retry queue of a run: charges its transient failures again as their backoff runs out. Waits
+    for retries coming due within Config.CHARGE_RETRY_HOLD; later ones are left to a resume of the run, which the
+    scheduler queues once they are due.
+
+    Returns:
+    - int: The number of retried charges.
+    """
+    hold_until = time.monotonic() + Config.CHARGE_RETRY_HOLD
+    retried = 0
+    while True:
+        retries = queries.fetch_charge_retries(run_id, Config.CHARGE_RETRY_MAX_ATTEMPTS)
+        due = {retry['customer_id']: retry_idempotency_key(run_id, retry) for retry in retries if retry['due_in'] <= 0}
+        if due:
+            logger.info(f"Retrying {len(due)} transient charge failures of run {run_id}.")
+            charge_customers(run_id, charge_info, priority, list(due), workers, heartbeat, idempotency_key=due.get)
+            retried += len(due)
+            continue
+        if not retries:
+            return retried
+        wait = min(retry['due_in'] for retry in retries)
+        if time.monotonic() + wait > hold_until:
+            logger.info(f"Leaving {len(retries)} charge retries of run {run_id} for a later resume.")
+            return retried
+        if heartbeat:
+            heartbeat()
+        time.sleep(min(wait, Config.JOB_POLL_INTERVAL))
+
+def _finish_run(run_id: int, stats: Dict[str, any], status: str) -> Dict[str, any]:
+    # The report is written from the ledger, so it covers the results of every worker that charged part of the run.
+    # The ledger is the durable record: a run that crashes before getting here gets its report when it is resumed.
+    report = ChargeReportWriter(name=f"run{run_id}_{datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}")
+    with report:
+        for result in queries.stream_records('charge_attempts', ['run_id'], [run_id], REPORT_FIELDS):
+            report.write(result)
+        summary = report.close({**stats, 'status': status, 'workers': queries.fetch_charge_chunk_workers(run_id)})
+    queries.finish_charge_run(run_id, stats['total_customers'], status=status, summary=summary)
+    metrics.CHARGE_RUNS.inc(status)
+    return summary
+
+def work_chunk(chunk: Dict[str, any], worker: str, workers: int | None = None,
+               heartbeat: Callable[..., None] | None = None) -> None:
+    """
+    Charges a claimed chunk and marks it done, or releases it for another attempt if charging it failed.
+    """
+    run_id, number = chunk['run_id'], chunk['chunk']
+    try:
+        summary = charge_chunk(chunk, worker, workers, heartbeat)
+    except ChargeChunkLost:
+        # The worker that took it over finishes the chunk, the idempotency keys keep the overlap from double charging
+        logger.warning(f"Lost the lease on chunk {number} of charge run {run_id}.")
+        return
+    except Exception as e:
+        logger.error(f"Chunk {number} of charge run {run_id} failed.", exc_info=True)
+        queries.finish_charge_chunk(run_id, number, worker, error=str(e), max_attempts=Config.CHARGE_CHUNK_MAX_ATTEMPTS)
+        return
+    queries.finish_charge_chunk(run_id, number, worker, summary=summary)
+
+def charge_chunk(chunk: Dict[str, any], worker: str, workers: int | None = None,
+                 heartbeat: Callable[..., None] | None = None) -> Dict[str, int]:
+    """
+    Charges the customers of a claimed chunk that are not settled in the run yet, renewing the chunk's lease on a
+    ChunkLease thread until it is done. Blocked customers (see Queries.fetch_charge_blocks) are recorded as skipped without a Stripe call.
+
+    Returns:
+    - Dict[str, int]: Result counts of the chunk per status, plus 'settled_before' and 'amount_cents'.
+
+    Raises:
+    - ChargeChunkLost: If the lease expired and another worker took the chunk over.
+    """
+    run_id, number = chunk['run_id'], chunk['chunk']
+    settled = queries.fetch_settled_customer_ids(run_id, chunk['customer_ids'])
+    pending = [customer_id for customer_id in chunk['customer_ids'] if customer_id not in settled]
+    summary = Counter(settled_before=len(settled))
+    lease = ChunkLease(run_id, number, worker)
+
+    def on_result(result: Dict[str, any]) -> None:
+        summary[result['status']] += 1
         if result['status'] == 'success':
-            stats['charged_customers'] += 1     
-        results.append(result)
+            summary['amount_cents'] += result['amount_charged']
+        # Stops charging a chunk another worker has taken over
+        lease.check()
+        if heartbeat:
+            heartbeat(result)
 
-    current_time = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-    json_filename = f'charge_report_{current_time}.json'
-    stats_filename = f'stats_{current_time}.txt'
-    
-    # Write JSON report
-    with open(json_filename, 'w') as file:
-        json.dump(results, file, indent=4)
-
-    # Write stats file
-    with open(stats_filename, 'w') as file:
-        file.write(f"Total Stripe Customers: {stats['total_customers']}\n")
-        file.write(f"Customers Charged: {stats['charged_customers']}\n")
+    lease.start()
+    try:
+        _charge_chunk_customers(chunk, pending, workers, on_result)
+    finally:
+        lease.stop()
+    lease.check()
+    return dict(summary)
+
+def _charge_chunk_customers(chunk: Dict[str, any], pending: List[str], workers: int | None,
+                            on_result: Callable[[Dict[str, any]], None]) -> None:
+    run_id = chunk['run_id']
+    if Config.CHARGE_SKIP_BLOCKED and pending:
+        blocked = queries.fetch_charge_blocks(pending)
+        for customer_id, block in blocked.items():
+            result = {
+                'customer_id': customer_id,
+                'amount_charged': 0,
+                'charge_type': '',
+                'status': 'skipped',
+                'reason': f"Skipped until the payment info changes: {block['reason']}",
+                'failure_type': charge_errors.PERMANENT,
+                'failure_code': block['failure_code']
+            }
+            record_charge_result(run_id, charge_idempotency_key(run_id, customer_id), result)
+            on_result(result)
+        pending = [customer_id for customer_id in pending if customer_id not in blocked]
+
+    charge_customers(run_id, chunk['charge_info'], chunk['priority'], pending, workers, on_result)
+
+def record_charge_result(run_id: int, idempotency_key: str, result: Dict[str, any]) -> None:
+    queries.record_charge_attempt(run_id, idempotency_key, result)
+    metrics.CHARGE_ATTEMPTS.inc(result['status'])
+    if result['status'] == 'success':
+        metrics.CHARGE_AMOUNT.inc(amount=result['amount_charged'])
+
+def charge_customers(run_id: int, charge_info: Dict[str, any], priority: int, customer_ids: List[str],
+                     workers: int | None = None, on_result: Callable[[Dict[str, any]], None] | None = None,
+                     idempotency_key: Callable[[str], str] | None = None) -> None:
+    """
+    Charges customers of a run and records each result in the ledger as it comes in.
+
+    Parameters:
+    - run_id (int): The ID of the run.
+    - charge_info (Dict[str, any]): The run's charge info ('amount' and 'card_upcharge').
+    - priority (int): Stripe limiter priority of the calls.
+    - customer_ids (List[str]): The customers to charge.
+    - workers (int | None): Concurrent charges. Defaults to Config.CHARGE_WORKERS.
+    - on_result (Callable | None): Called with every result after it is recorded, on the calling thread.
+    - idempotency_key (Callable | None): Maps a customer ID to its idempotency key. Defaults to charge_idempotency_key.
+    """
+    workers = workers or Config.CHARGE_WORKERS
+    key = idempotency_key or (lambda customer_id: charge_idempotency_key(run_id, customer_id))
+    # Lets payment_intent.* webhooks find the ledger entry of asynchronously settling charges
+    run_metadata = {'charge_run_id': str(run_id)}
+
+    def charge(profile: dict) -> Dict[str, any]:
+        customer_id = profile['customer_id']
+        with stripe_client.priority(priority):
+            return charge_customer(customer_id, charge_info['amount'], charge_info['card_upcharge'],
+                                   idempotency_key=key(customer_id), profile=profile, metadata=run_metadata)
+
+    def resolve(customer_id: str) -> Dict[str, any]:
+        with stripe_client.priority(priority):
+            return resolve_payment_profile(customer_id)
+
+    def record(result: Dict[str, any]) -> None:
+        record_charge_result(run_id, key(result['customer_id']), result)
+        if on_result:
+            on_result(result)
+
+    # The pool threads record their spans into (and are sampled for) the profile of the run, if it has one
+    charge, resolve = profiling.bind(charge), profiling.bind(resolve)
+
+    if workers > 1:
+        # Two pipelined stages: the prefetch pool resolves payment profiles ahead of the
+        # charging pool, which then only has to make the PaymentIntent call. Both share the
+        # limiter in stripe_client, which keeps the process under its share of the Stripe quota.
+        prefetch_workers = Config.PREFETCH_WORKERS or workers
+        # Listing pages through the whole account for every chunk, so only list when that beats a retrieve per customer
+        listing = Config.PREFETCH_MODE == 'list' and listing_pays_off(len(customer_ids), queries.estimate_mirror_customers())
+        # The listing runs on this thread (inside the run's profile, if any), at the run's priority
+        with stripe_client.priority(priority), \
+                ThreadPoolExecutor(max_workers=prefetch_workers, thread_name_prefix='prefetch') as prefetcher, \
+                ThreadPoolExecutor(max_workers=workers, thread_name_prefix='charge') as executor:
+            if listing:
+                profiles = list_payment_profiles(customer_ids)
+            else:
+                profiles = imap_unordered(prefetcher, resolve, customer_ids, prefetch_workers * 2)
+            for result in imap_unordered(executor, charge, profiles, workers * 2):
+                record(result)
+    else:
+        for customer_id in customer_ids:
+            record(charge(resolve(customer_id)))
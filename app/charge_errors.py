@@ -0,0 +1,66 @@
+# app/charge_errors.py
+from typing import Dict
+
+from app.lazy import lazy_import
+
+stripe = lazy_import('stripe')
+
+# A transient failure may go through on a later attempt, a permanent one not before the customer's payment info changes
+TRANSIENT = 'transient'
+PERMANENT = 'permanent'
+
+# Declines the issuer expects to succeed if tried again later (see Stripe's decline code reference)
+SOFT_DECLINE_CODES = frozenset({
+    'approve_with_id', 'issuer_not_available', 'processing_error', 'reenter_transaction', 'try_again_later'
+})
+
+
+def failure(failure_type: str, failure_code: str, reason: str) -> Dict[str, str]:
+    return {'failure_type': failure_type, 'failure_code': failure_code, 'reason': reason}
+
+
+def classify(error: 'stripe.StripeError') -> Dict[str, str]:
+    """
+    Classifies a Stripe error that made charging a customer fail (after stripe_client's own retries).
+
+    Transient: rate limits, connection errors, lock timeouts, Stripe server errors, soft declines and anything
+    unrecognized. Permanent: other card declines and card errors, and invalid requests (e.g. a customer or payment
+    method that no longer exists).
+
+    Parameters:
+    - error (stripe.StripeError): The error.
+
+    Returns:
+    - Dict[str, str]: 'failure_type' (TRANSIENT or PERMANENT), 'failure_code' and a readable 'reason'.
+    """
+    code = getattr(error, 'code', None)
+    if isinstance(error, stripe.CardError):
+        # The issuer's reason is only in the error body, e.g. 'insufficient_funds' for code 'card_declined'
+        code = getattr(error.error, 'decline_code', None) or code or 'card_declined'
+        failure_type = TRANSIENT if code in SOFT_DECLINE_CODES else PERMANENT
+        return failure(failure_type, code, f"Card declined ({code})")
+    if isinstance(error, stripe.RateLimitError):
+        return failure(TRANSIENT, code or 'rate_limit', 'Stripe rate limit exceeded')
+    if isinstance(error, stripe.APIConnectionError):
+        return failure(TRANSIENT, 'api_connection_error', 'Could not reach Stripe')
+    if code == 'lock_timeout':
+        return failure(TRANSIENT, code, 'Stripe lock timeout')
+    if isinstance(error, stripe.InvalidRequestError):
+        code = code or 'invalid_request_error'
+        if code == 'resource_missing':
+            return failure(PERMANENT, code, 'Customer or payment method does not exist in Stripe')
+        return failure(PERMANENT, code, f"Stripe rejected the charge ({code})")
+    if isinstance(error, (stripe.AuthenticationError, stripe.PermissionError)):
+        # A problem with our API key, not with the customer
+        return failure(TRANSIENT, code or 'authentication_error', 'Stripe rejected the API key')
+    status = getattr(error, 'http_status', None)
+    return failure(TRANSIENT, code or f"http_{status or 'unknown'}", f"Stripe error ({error.__class__.__name__})")
+
+
+def needs_new_idempotency_key(failure_code: str | None) -> bool:
+    """
+    Stripe stores the outcome of a request that reached it under its idempotency key and replays it for the same key,
+    so a retried decline needs a new key. Other transient failures (connection errors, 5xx, rate limits) reuse the
+    original key: if the first request did go through, Stripe returns it instead of charging again.
+    """
+    return failure_code in SOFT_DECLINE_CODES
@@ -13,6 +13,16 @@ class Config:
 
     # sendgrid
     SENDGRID_API_KEY = os.getenv('SENDGRID_API_KEY', 'default_sendgrid_api_key')
+    SENDGRID_TIMEOUT = float(os.getenv('SENDGRID_TIMEOUT', 10))
+    EMAIL_OUTBOX_WORKER = os.getenv('EMAIL_OUTBOX_WORKER', 'true').lower() == 'true'
+    EMAIL_BATCH_SIZE = int(os.getenv('EMAIL_BATCH_SIZE', 1000))
+    EMAIL_POLL_INTERVAL = float(os.getenv('EMAIL_POLL_INTERVAL', 5))
+    EMAIL_LEASE_SECONDS = int(os.getenv('EMAIL_LEASE_SECONDS', 120))
+    EMAIL_MAX_ATTEMPTS = int(os.getenv('EMAIL_MAX_ATTEMPTS', 8))
+    EMAIL_BACKOFF_BASE = float(os.getenv('EMAIL_BACKOFF_BASE', 30))
+    EMAIL_BACKOFF_MAX = float(os.getenv('EMAIL_BACKOFF_MAX', 3600))
+    # Queue an UPDATE_PAYMENT_TEMPLATE_ID email to every customer whose charge failed once a run finishes
+    CHARGE_FAILURE_EMAILS = os.getenv('CHARGE_FAILURE_EMAILS', 'true').lower() == 'true'
     
     COMPANY_NAME = os.getenv('COMPANY_NAME', 'default_company_name')
     STAFF_EMAIL = os.getenv('COMPANY_EMAIL', 'default_company_email')
@@ -24,3 +34,95 @@ class Config:
 
     # database
     DATABASE_URL = os.getenv('DATABASE_URL', 'default_database_url')
+    DB_POOL_MIN = int(os.getenv('DB_POOL_MIN', 1))
+    DB_POOL_MAX = int(os.getenv('DB_POOL_MAX', 10))
+    DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', 5))
+    DB_POOL_HEALTH_CHECK_AFTER = float(os.getenv('DB_POOL_HEALTH_CHECK_AFTER', 30))
+    # Server-side prepared statements for hot queries; leave off behind a transaction-pooling proxy (pgbouncer)
+    DB_PREPARED_STATEMENTS = os.getenv('DB_PREPARED_STATEMENTS', 'false').lower() == 'true'
+    DB_BATCH_SIZE = int(os.getenv('DB_BATCH_SIZE', 1000))
+    DB_COPY_THRESHOLD = int(os.getenv('DB_COPY_THRESHOLD', 5000))
+    DB_STREAM_ITERSIZE = int(os.getenv('DB_STREAM_ITERSIZE', 2000))
+    # asyncpg pool of the ASGI app (app/asgi.py); requests beyond it wait for a connection instead of opening more
+    DB_ASYNC_POOL_MIN = int(os.getenv('DB_ASYNC_POOL_MIN', 1))
+    DB_ASYNC_POOL_MAX = int(os.getenv('DB_ASYNC_POOL_MAX', 20))
+
+    # stripe customer mirror
+    STRIPE_MIRROR_MAX_AGE = int(os.getenv('STRIPE_MIRROR_MAX_AGE', 7 * 24 * 3600))
+    STRIPE_MIRROR_FALLBACK = os.getenv('STRIPE_MIRROR_FALLBACK', 'true').lower() == 'true'
+    # Threads running the Stripe duplicate check of /submit-application next to the database one (Flask app)
+    SIGNUP_CHECK_WORKERS = int(os.getenv('SIGNUP_CHECK_WORKERS', 16))
+
+    # stripe http client
+    # Point at a local Stripe stand-in (e.g. stripe-mock) for tests and benchmarks
+    STRIPE_API_BASE = os.getenv('STRIPE_API_BASE')
+    STRIPE_CONNECT_TIMEOUT = float(os.getenv('STRIPE_CONNECT_TIMEOUT', 5))
+    STRIPE_READ_TIMEOUT = float(os.getenv('STRIPE_READ_TIMEOUT', 30))
+    STRIPE_HTTP_POOL_SIZE = int(os.getenv('STRIPE_HTTP_POOL_SIZE', 32))
+    STRIPE_MAX_NETWORK_RETRIES = int(os.getenv('STRIPE_MAX_NETWORK_RETRIES', 2))
+    STRIPE_TRANSIENT_RETRIES = int(os.getenv('STRIPE_TRANSIENT_RETRIES', 3))
+
+    # charging
+    CHARGE_WORKERS = int(os.getenv('CHARGE_WORKERS', 8))
+    STRIPE_RATE_LIMIT = float(os.getenv('STRIPE_RATE_LIMIT', 80))
+    STRIPE_MIN_RATE = float(os.getenv('STRIPE_MIN_RATE', 5))
+    STRIPE_RATE_LIMIT_RETRIES = int(os.getenv('STRIPE_RATE_LIMIT_RETRIES', 5))
+    STRIPE_BACKOFF_BASE = float(os.getenv('STRIPE_BACKOFF_BASE', 0.5))
+    STRIPE_BACKOFF_MAX = float(os.getenv('STRIPE_BACKOFF_MAX', 8))
+    # 'retrieve' resolves each customer with one expanded Customer.retrieve, 'list' pages through all
+    # Stripe customers 100 at a time (cheaper when a type code covers most of the account; it pages once per chunk, so a
+    # chunk falls back to retrieves when the account, estimated from the mirror, needs more pages than it has customers)
+    PREFETCH_MODE = os.getenv('PREFETCH_MODE', 'retrieve')
+    PREFETCH_WORKERS = int(os.getenv('PREFETCH_WORKERS', 0))
+    # Runs are split into chunks of this many customers, claimed by the job that runs them and any chunk workers
+    CHARGE_CHUNK_SIZE = int(os.getenv('CHARGE_CHUNK_SIZE', 500))
+    # A chunk whose worker stops renewing its lease for this many seconds is taken over by another worker
+    CHARGE_CHUNK_LEASE = int(os.getenv('CHARGE_CHUNK_LEASE', 120))
+    CHARGE_CHUNK_MAX_ATTEMPTS = int(os.getenv('CHARGE_CHUNK_MAX_ATTEMPTS', 5))
+    # Threads per process that help with the chunks of any running run (python -m app.jobs for dedicated hosts)
+    CHARGE_CHUNK_WORKERS = int(os.getenv('CHARGE_CHUNK_WORKERS', 0))
+    # Transient failures (rate limits, connection errors, soft declines) are retried with exponential backoff
+    CHARGE_RETRY_MAX_ATTEMPTS = int(os.getenv('CHARGE_RETRY_MAX_ATTEMPTS', 5))
+    CHARGE_RETRY_BACKOFF_BASE = float(os.getenv('CHARGE_RETRY_BACKOFF_BASE', 60))
+    CHARGE_RETRY_BACKOFF_MAX = float(os.getenv('CHARGE_RETRY_BACKOFF_MAX', 6 * 3600))
+    # A run waits this many seconds at its end for retries coming due; later ones are run by a resume the scheduler queues
+    CHARGE_RETRY_HOLD = float(os.getenv('CHARGE_RETRY_HOLD', 600))
+    # Skip customers whose last failure was permanent (hard decline, no payment method) until their payment info changes
+    CHARGE_SKIP_BLOCKED = os.getenv('CHARGE_SKIP_BLOCKED', 'true').lower() == 'true'
+
+    # reports
+    REPORT_DIR = os.getenv('REPORT_DIR', 'reports')
+    REPORT_FORMAT = os.getenv('REPORT_FORMAT', 'jsonl')
+    REPORT_COMPRESS = os.getenv('REPORT_COMPRESS', 'false').lower() == 'true'
+
+    # profiling: a sampled stack profile and span timings of one request or charge run, written to PROFILE_DIR.
+    # Requests opt in with an X-Profile header carrying PROFILE_TOKEN (unset disables the header), or everything
+    # is profiled with PROFILE_REQUESTS / PROFILE_CHARGE_RUNS.
+    PROFILE_DIR = os.getenv('PROFILE_DIR', 'profiles')
+    PROFILE_TOKEN = os.getenv('PROFILE_TOKEN', '')
+    PROFILE_REQUESTS = os.getenv('PROFILE_REQUESTS', 'false').lower() == 'true'
+    PROFILE_CHARGE_RUNS = os.getenv('PROFILE_CHARGE_RUNS', 'false').lower() == 'true'
+    # Seconds between stack samples
+    PROFILE_INTERVAL = float(os.getenv('PROFILE_INTERVAL', 0.005))
+
+    # background jobs
+    JOB_WORKERS = int(os.getenv('JOB_WORKERS', 1))
+    JOB_POLL_INTERVAL = float(os.getenv('JOB_POLL_INTERVAL', 2))
+    JOB_HEARTBEAT_INTERVAL = float(os.getenv('JOB_HEARTBEAT_INTERVAL', 10))
+    JOB_STALE_AFTER = int(os.getenv('JOB_STALE_AFTER', 120))
+    # Whether create_app() starts the background workers (charge jobs and chunks, webhook inbox, email outbox,
+    # scheduler) in the process that calls it
+    BACKGROUND_WORKERS = os.getenv('BACKGROUND_WORKERS', 'true').lower() == 'true'
+
+    # charge scheduler (schedules live in charge_info.data['schedule'])
+    SCHEDULER_ENABLED = os.getenv('SCHEDULER_ENABLED', 'true').lower() == 'true'
+    SCHEDULER_POLL_INTERVAL = float(os.getenv('SCHEDULER_POLL_INTERVAL', 60))
+    # A missed occurrence (app down at the time) is still run if it is at most this many seconds old
+    SCHEDULER_CATCH_UP = int(os.getenv('SCHEDULER_CATCH_UP', 6 * 3600))
+
+    # webhook inbox
+    WEBHOOK_INBOX_WORKER = os.getenv('WEBHOOK_INBOX_WORKER', 'true').lower() == 'true'
+    WEBHOOK_BATCH_SIZE = int(os.getenv('WEBHOOK_BATCH_SIZE', 200))
+    WEBHOOK_POLL_INTERVAL = float(os.getenv('WEBHOOK_POLL_INTERVAL', 1))
+    WEBHOOK_LEASE_SECONDS = int(os.getenv('WEBHOOK_LEASE_SECONDS', 60))
+    WEBHOOK_MAX_ATTEMPTS = int(os.getenv('WEBHOOK_MAX_ATTEMPTS', 10))
@@ -1,14 +1,155 @@
 # app/database.py
-from psycopg2 import pool
+import os
+import threading
+import time
+from collections import deque
 from contextlib import contextmanager
+from typing import Any, Dict
+
+import psycopg2
+from psycopg2 import extensions
+from psycopg2.pool import PoolError
+
+from app.config import Config
+
+
+class PoolTimeout(PoolError):
+    """Raised when no connection becomes available within the checkout timeout."""
+
 
 class Database:
-    def __init__(self, database_url):
+    def __init__(self, database_url, minconn=None, maxconn=None, timeout=None, health_check_after=None):
         """
-        Initializes the connection pool using a database URL.
+        Initializes a thread-safe connection pool using a database URL.
+        Connections are opened on demand up to maxconn and kept open for reuse when they are returned.
         :param database_url: A string containing the database connection information.
+        :param minconn: Connections opened up front. Defaults to Config.DB_POOL_MIN.
+        :param maxconn: Upper bound on open connections. Defaults to Config.DB_POOL_MAX.
+        :param timeout: Seconds to wait for a free connection before raising PoolTimeout. Defaults to Config.DB_POOL_TIMEOUT.
+        :param health_check_after: Idle seconds after which a connection is pinged before being handed out.
+                                   Defaults to Config.DB_POOL_HEALTH_CHECK_AFTER.
         """
-        self.connection_pool = pool.SimpleConnectionPool(minconn=1, maxconn=10, dsn=database_url)
+        self.database_url = database_url
+        self.minconn = Config.DB_POOL_MIN if minconn is None else minconn
+        self.maxconn = Config.DB_POOL_MAX if maxconn is None else maxconn
+        self.timeout = Config.DB_POOL_TIMEOUT if timeout is None else timeout
+        self.health_check_after = Config.DB_POOL_HEALTH_CHECK_AFTER if health_check_after is None else health_check_after
+
+        self._condition = threading.Condition()
+        self._idle = deque()  # (connection, returned_at), most recently returned on the right
+        self._size = 0
+        self._waiting = 0
+        self._closed = False
+        self._stats = {
+            'checkouts': 0,
+            'timeouts': 0,
+            'connections_opened': 0,
+            'connections_discarded': 0,
+            'wait_seconds_total': 0.0,
+            'wait_seconds_max': 0.0
+        }
+
+        for _ in range(self.minconn):
+            self._idle.append((self._connect(), time.monotonic()))
+            self._size += 1
+
+    def _connect(self):
+        connection = psycopg2.connect(self.database_url)
+        with self._condition:
+            self._stats['connections_opened'] += 1
+        return connection
+
+    def _is_healthy(self, connection, idle_since: float) -> bool:
+        if connection.closed:
+            return False
+        if time.monotonic() - idle_since < self.health_check_after:
+            return True
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            connection.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _discard(self, connection) -> None:
+        try:
+            if not connection.closed:
+                connection.close()
+        finally:
+            with self._condition:
+                self._size -= 1
+                self._stats['connections_discarded'] += 1
+                self._condition.notify()
+
+    def getconn(self, timeout: float | None = None):
+        """
+        Checks a connection out of the pool, opening a new one if the pool is below maxconn.
+        Blocks until a connection is returned when the pool is exhausted.
+        :param timeout: Overrides the pool's checkout timeout.
+        :raises PoolTimeout: If no connection is available in time.
+        """
+        timeout = self.timeout if timeout is None else timeout
+        started = time.monotonic()
+        deadline = started + timeout
+        while True:
+            with self._condition:
+                while True:
+                    if self._closed:
+                        raise PoolError('Connection pool is closed.')
+                    if self._idle:
+                        connection, idle_since = self._idle.pop()
+                        break
+                    if self._size < self.maxconn:
+                        connection, idle_since = None, None
+                        self._size += 1
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._stats['timeouts'] += 1
+                        raise PoolTimeout(f'No database connection available after {timeout}s.')
+                    self._waiting += 1
+                    try:
+                        self._condition.wait(remaining)
+                    finally:
+                        self._waiting -= 1
+
+            if connection is None:
+                try:
+                    connection = self._connect()
+                except Exception:
+                    with self._condition:
+                        self._size -= 1
+                        self._condition.notify()
+                    raise
+            elif not self._is_healthy(connection, idle_since):
+                self._discard(connection)
+                continue
+
+            waited = time.monotonic() - started
+            with self._condition:
+                self._stats['checkouts'] += 1
+                self._stats['wait_seconds_total'] += waited
+                self._stats['wait_seconds_max'] = max(self._stats['wait_seconds_max'], waited)
+            return connection
+
+    def putconn(self, connection, close: bool = False) -> None:
+        """
+        Returns a connection to the pool. Any open transaction is rolled back; broken connections are discarded.
+        :param close: Close the connection instead of keeping it for reuse.
+        """
+        if close or self._closed or connection.closed:
+            self._discard(connection)
+            return
+        try:
+            if connection.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+                connection.rollback()
+        except psycopg2.Error:
+            self._discard(connection)
+            return
+        with self._condition:
+            self._idle.append((connection, time.monotonic()))
+            self._condition.notify()
 
     @contextmanager
     def get_connection(self):
@@ -16,14 +157,69 @@ class Database:
         A context manager to acquire and release a connection from the pool.
         This allows the connection to be used with a 'with' statement, ensuring it is returned to the pool.
         """
-        connection = self.connection_pool.getconn()
+        connection = self.getconn()
         try:
             yield connection
         finally:
-            self.connection_pool.putconn(connection)
+            self.putconn(connection)
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Returns pool size, utilization and checkout wait statistics.
+        """
+        with self._condition:
+            stats = dict(self._stats)
+            idle = len(self._idle)
+            in_use = self._size - idle
+            stats.update({
+                'size': self._size,
+                'idle': idle,
+                'in_use': in_use,
+                'waiting': self._waiting,
+                'maxconn': self.maxconn,
+                'utilization': in_use / self.maxconn if self.maxconn else 0.0,
+                'wait_seconds_avg': stats['wait_seconds_total'] / stats['checkouts'] if stats['checkouts'] else 0.0
+            })
+        return stats
 
     def close_all_connections(self):
         """
         Closes all connections in the pool.
         """
-        self.connection_pool.closeall()
+        with self._condition:
+            self._closed = True
+            idle, self._idle = list(self._idle), deque()
+            self._condition.notify_all()
+        for connection, _ in idle:
+            self._discard(connection)
+
+
+_database = None
+_database_lock = threading.Lock()
+# Pools inherited from the parent process. Closing (or garbage collecting) their connections in a forked child
+# would end the parent's sessions, so they are only kept referenced and never used again.
+_inherited = []
+
+
+def _reset_after_fork() -> None:
+    # A forked child opens its own pool on first use instead of sharing the parent's sockets
+    global _database, _database_lock
+    if _database is not None:
+        _inherited.append(_database)
+    _database = None
+    _database_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def get_database() -> Database:
+    """
+    Returns the process-wide Database, creating it on first use (so after a fork, the child's first use).
+    """
+    global _database
+    if _database is None:
+        with _database_lock:
+            if _database is None:
+                _database = Database(Config.DATABASE_URL)
+    return _database
@@ -0,0 +1,91 @@
+# app/flow.py
+# Request logic shared by the Flask app (app/main.py) and the ASGI app (app/asgi.py). It is written once, as
+# generators that yield the I/O they need as Call objects; run() performs the calls with the blocking clients and
+# run_async() with the async ones, so the two serving modes only differ in how they reach Stripe and Postgres.
+from typing import Any, Awaitable, Callable, Generator
+
+from app import stripe_client
+from app.async_queries import AsyncQueries
+from app.lazy import lazy_import
+from app.queries import Queries
+
+stripe = lazy_import('stripe')
+
+queries = Queries()
+async_queries = AsyncQueries()
+
+# What the shared logic is written as: yields Calls, receives their results (or has their errors raised at the
+# yield) and returns its outcome
+Steps = Generator['Call', Any, Any]
+
+
+class Call:
+    def __init__(self, sync: Callable[..., Any] | None, async_: Callable[..., Awaitable[Any]] | None, *args, **kwargs):
+        """
+        One I/O step of shared request logic, with the blocking and the async way of performing it.
+        :param sync: Performs the step in a thread (run).
+        :param async_: Returns an awaitable performing the step on the event loop (run_async).
+        :param args: Passed to either.
+        :param kwargs: Passed to either.
+        """
+        self.sync = sync
+        self.async_ = async_
+        self.args = args
+        self.kwargs = kwargs
+
+
+def stripe_call(method: str, *args, **kwargs) -> Call:
+    """
+    A Stripe API call through stripe_client, e.g. stripe_call('Customer.retrieve', customer_id). The async variant
+    calls the method's *_async twin.
+    """
+    resource, name = method.rsplit('.', 1)
+
+    def resolve(suffix: str) -> Callable[..., Any]:
+        target = stripe
+        for part in resource.split('.'):
+            target = getattr(target, part)
+        return getattr(target, name + suffix)
+
+    return Call(lambda *a, **k: stripe_client.call(resolve(''), *a, **k),
+                lambda *a, **k: stripe_client.call_async(resolve('_async'), *a, **k), *args, **kwargs)
+
+
+def db_call(method: str, *args, **kwargs) -> Call:
+    """
+    A Queries method, e.g. db_call('fetch_charge_job_progress', job_id). The async variant calls the AsyncQueries
+    method of the same name.
+    """
+    return Call(getattr(queries, method), getattr(async_queries, method), *args, **kwargs)
+
+
+def run(steps: Steps) -> Any:
+    """
+    Runs shared logic with blocking I/O and returns its outcome.
+    """
+    result, error = None, None
+    while True:
+        try:
+            call = steps.throw(error) if error is not None else steps.send(result)
+        except StopIteration as stop:
+            return stop.value
+        try:
+            result, error = call.sync(*call.args, **call.kwargs), None
+        except Exception as e:
+            result, error = None, e
+
+
+async def run_async(steps: Steps) -> Any:
+    """
+    Runs shared logic with async I/O and returns its outcome.
+    """
+    result, error = None, None
+    while True:
+        try:
+            call = steps.throw(error) if error is not None else steps.send(result)
+        except StopIteration as stop:
+            return stop.value
+        try:
+            result, error = await call.async_(*call.args, **call.kwargs), None
+        except Exception as e:
+            result, error = None, e
@@ -0,0 +1,155 @@
+# app/handlers.py
+# The routes of the Flask app (app/main.py) and the ASGI app (app/asgi.py), written once as app.flow steps. Each
+# returns the response body (a dict for JSON, a str for text) and the status code; the apps parse the request, run
+# the steps with their own I/O and build the response.
+import logging
+from typing import Any, Dict
+
+from app import stripe_client
+from app.config import Config
+from app.flow import Steps, db_call, stripe_call
+from app.jobs import job_progress
+from app.lazy import lazy_import
+
+stripe = lazy_import('stripe')
+
+logger = logging.getLogger(__name__)
+
+
+def add_payment(data: Dict[str, Any]) -> Steps:
+    customer_id = data.get('customer_id')
+    try:
+        customer = yield stripe_call('Customer.retrieve', customer_id)
+        session = yield stripe_call(
+            'checkout.Session.create',
+            customer=customer,
+            payment_method_types=['card', 'us_bank_account'],
+            mode='setup',
+            success_url=Config.SUCCESS_URL
+        )
+    except stripe.StripeError:
+        logger.error("Failed to create checkout session.", exc_info=True)
+        return {'error': 'Failed to create checkout session.'}, 500
+    logger.debug('Checkout session created.')
+    return {'message': 'Your update payment link is ready.', 'id': customer_id, 'link': session.url}, 200
+
+
+def customer_payment_methods(data: Dict[str, Any]) -> Steps:
+    customer_id = data.get('customer_id')
+
+    if not customer_id:
+        return {'error': 'Customer ID is required.'}, 400
+
+    try:
+        customer = yield stripe_call('Customer.retrieve', customer_id)
+        payment_methods = yield stripe_call('PaymentMethod.list', customer=customer_id)
+
+        # Extract default payment method ID from the customer object
+        invoice_settings: dict = customer.get('invoice_settings', {})
+        default_payment_method_id = invoice_settings.get('default_payment_method')
+
+        # Prepare the list of payment method IDs and indicate which one is the default
+        payment_methods_info = [{'id': pm.id, 'is_default': pm.id == default_payment_method_id}
+                                for pm in payment_methods.data]
+        return {'payment_methods': payment_methods_info}, 200
+    except stripe.StripeError:
+        logger.error("Failed to retrieve payment methods from Stripe.", exc_info=True)
+        return {'error': 'Failed to retrieve payment methods from Stripe.'}, 500
+
+
+def set_default_payment_method(data: Dict[str, Any]) -> Steps:
+    customer_id = data.get('customer_id')
+    payment_method_id = data.get('payment_method_id')
+
+    if not customer_id:
+        return {'error': 'Customer ID is required.'}, 400
+    if not payment_method_id:
+        return {'error': 'Payment method ID is required.'}, 400
+
+    try:
+        # Retrieve the customer to check the current default payment method
+        customer = yield stripe_call('Customer.retrieve', customer_id)
+        invoice_settings: dict = customer.get('invoice_settings', {})
+        if payment_method_id == invoice_settings.get('default_payment_method'):
+            return {'message': 'The provided payment method is already the default.'}, 200
+
+        yield stripe_call('Customer.modify', customer_id, invoice_settings={'default_payment_method': payment_method_id})
+        return {'message': 'Default payment method updated successfully.'}, 200
+    except stripe.InvalidRequestError as e:
+        # Handle scenarios like invalid customer ID or payment method ID
+        return {'error': str(e)}, 400
+    except stripe.StripeError:
+        logger.error("Stripe API call failed.", exc_info=True)
+        return {'error': 'Failed to update the default payment method.'}, 500
+
+
+def process_charges(data: Dict[str, Any], profile: bool = False) -> Steps:
+    """
+    Queues a charge job. profile is whether the request carried an authorized X-Profile header, which profiles the
+    run itself, not just the request.
+    """
+    type_code = data.get('type_code')
+    run_id = data.get('run_id')
+    if not type_code and run_id is None:
+        return {'error': 'Either type_code or run_id is required.'}, 400
+    try:
+        # Charge runs stay below the API requests in the shared Stripe budget
+        priority = min(max(int(data.get('priority', 0)), 0), stripe_client.MAX_BACKGROUND_PRIORITY)
+    except (TypeError, ValueError):
+        return {'error': 'Priority must be an integer.'}, 400
+    try:
+        # Passing a run_id resumes that run and only charges customers it has not settled yet
+        job_id = yield db_call('enqueue_charge_job', type_code, run_id, priority=priority, profile=profile)
+        if job_id is None:
+            # One open job per type code, so the same customers are never charged by two runs at once
+            open_job = yield db_call('fetch_open_charge_job', type_code, run_id)
+            return {'error': 'A charge job for this type code is already queued or running.',
+                    'job_id': open_job['id'] if open_job else None}, 409
+        return {'message': 'Charge job queued.', 'job_id': job_id, 'status_url': f'/charge-jobs/{job_id}'}, 202
+    except Exception:
+        logger.error("Failed to queue charge job.", exc_info=True)
+        return {'error': 'Failed to queue charge job.'}, 500
+
+
+def charge_job_status(job_id: int) -> Steps:
+    try:
+        job = yield db_call('fetch_charge_job_progress', job_id)
+    except Exception:
+        logger.error("Failed to fetch charge job.", exc_info=True)
+        return {'error': 'Failed to fetch charge job.'}, 500
+    if job is None:
+        return {'error': 'Charge job not found.'}, 404
+    return job_progress(job), 200
+
+
+def webhook(payload: bytes, sig_header: str) -> Steps:
+    logger.debug("Received webhook.")
+    try:
+        event = stripe.Webhook.construct_event(payload, sig_header, Config.WEBHOOK_SIGNING_SECRET)
+    except ValueError as e:
+        logger.error(f'Invalid payload: {e}')
+        return 'Invalid payload', 400
+    except stripe.SignatureVerificationError as e:
+        logger.error(f'Invalid signature: {e}')
+        return 'Invalid signature', 400
+    except Exception as e:
+        logger.error(f'Unhandled exception: {e}')
+        return 'Internal server error', 500
+
+    # Only persist the event here; the inbox worker applies it in batches. Redeliveries are no-ops.
+    try:
+        if not (yield db_call('insert_webhook_event', event)):
+            logger.debug(f"Duplicate webhook event {event['id']} ignored.")
+    except Exception as e:
+        logger.error(f"Failed to store webhook event: {e}")
+        return 'Internal server error', 500
+
+    return {'success': True}, 200
+
+
+def webhook_inbox_stats() -> Steps:
+    try:
+        return (yield db_call('webhook_inbox_stats', Config.WEBHOOK_MAX_ATTEMPTS)), 200
+    except Exception:
+        logger.error("Failed to fetch webhook inbox stats.", exc_info=True)
+        return {'error': 'Failed to fetch webhook inbox stats.'}, 500
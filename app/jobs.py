@@ -0,0 +1,216 @@
+# app/jobs.py
+import argparse
+import logging
+import os
+import socket
+import threading
+import time
+from typing import Any, Dict
+
+from flask import Flask
+
+from app.charge_calendar import ChargeRunLocked, chunk_worker_name, process_charges, work_chunk
+from app.config import Config
+from app.queries import Queries
+from app import profiling, stripe_client
+
+queries = Queries()
+
+logger = logging.getLogger(__name__)
+
+
+class ChargeJobRunner:
+    def __init__(self, app: Flask, workers: int | None = None):
+        """
+        Runs queued charge jobs in background threads. The queue lives in the charge_jobs table, so jobs survive
+        an app restart: orphaned running jobs are requeued and resume their charge run.
+        :param app: The Flask app, used to provide an app context to the worker threads.
+        :param workers: Number of jobs executed concurrently. Defaults to Config.JOB_WORKERS.
+        """
+        self.app = app
+        self.workers = Config.JOB_WORKERS if workers is None else workers
+        self.name = f"{socket.gethostname()}:{os.getpid()}"
+        self._stop = threading.Event()
+        self._threads = []
+
+    def _run_with_connection(self, fn, *args):
+        # An app context pins one pooled connection for the whole unit of work (checked out lazily by Queries
+        # and returned when the context is torn down) instead of one checkout per query
+        with self.app.app_context():
+            return fn(*args)
+
+    def start(self) -> None:
+        """
+        Starts the worker threads. The charge_jobs table is created by the migrations (python -m app.migrate upgrade).
+        """
+        if self.workers <= 0:
+            return
+        for index in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f"charge-job-{index}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        logger.info(f"Started {self.workers} charge job workers.")
+
+    def stop(self, timeout: float | None = None) -> None:
+        """
+        Asks the workers to stop after their current job and waits for them.
+        """
+        self._stop.set()
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def _work(self) -> None:
+        worker = f"{self.name}:{threading.current_thread().name}"
+        while not self._stop.is_set():
+            try:
+                job = self._run_with_connection(self._claim, worker)
+            except Exception:
+                logger.error("Failed to poll the charge job queue.", exc_info=True)
+                job = None
+            if job is None:
+                self._stop.wait(Config.JOB_POLL_INTERVAL)
+                continue
+            self._run_with_connection(self._execute, job)
+
+    def _claim(self, worker: str) -> Dict[str, Any] | None:
+        queries.requeue_stale_charge_jobs(Config.JOB_STALE_AFTER)
+        return queries.claim_charge_job(worker)
+
+    def _execute(self, job: Dict[str, Any]) -> None:
+        job_id = job['id']
+        last_heartbeat = 0.0
+
+        def progress(stats: Dict[str, Any]) -> None:
+            nonlocal last_heartbeat
+            now = time.monotonic()
+            # The first call carries the new run_id, later ones only keep the job alive
+            if last_heartbeat and now - last_heartbeat < Config.JOB_HEARTBEAT_INTERVAL:
+                return
+            last_heartbeat = now
+            queries.heartbeat_charge_job(job_id, stats['run_id'], stats['expected_customers'])
+
+        logger.info(f"Running charge job {job_id}.")
+        try:
+            with profiling.profile(f"charge-job-{job_id}", enabled=job['profile'] or Config.PROFILE_CHARGE_RUNS):
+                process_charges(job['type_code'], run_id=job['run_id'], progress=progress, priority=job['priority'],
+                                window_ends_at=job['window_ends_at'])
+        except ChargeRunLocked:
+            # Another worker still holds the type code (e.g. this job was requeued while its first worker is alive).
+            # Left as is: that worker finishes the job, otherwise the missing heartbeats get it requeued later.
+            logger.warning(f"Charge job {job_id} skipped, its type code is already being charged.", exc_info=True)
+        except Exception as e:
+            logger.error(f"Charge job {job_id} failed.", exc_info=True)
+            queries.finish_charge_job(job_id, 'failed', str(e))
+        else:
+            queries.finish_charge_job(job_id, 'completed')
+
+
+class ChargeChunkRunner:
+    def __init__(self, workers: int | None = None):
+        """
+        Helps with running charge runs from background threads: each thread claims a chunk of any running run
+        (highest priority first), charges it and claims the next. Runs can then be spread over several processes and
+        hosts; a chunk whose worker dies is taken over once its lease expires. Does not need an app context.
+        :param workers: Number of chunks charged concurrently. Defaults to Config.CHARGE_CHUNK_WORKERS.
+        """
+        self.workers = Config.CHARGE_CHUNK_WORKERS if workers is None else workers
+        self._stop = threading.Event()
+        self._threads = []
+
+    def start(self) -> None:
+        """
+        Starts the worker threads.
+        """
+        if self.workers <= 0:
+            return
+        for index in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f"charge-chunk-{index}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        logger.info(f"Started {self.workers} charge chunk workers.")
+
+    def stop(self, timeout: float | None = None) -> None:
+        """
+        Asks the workers to stop after their current chunk and waits for them.
+        """
+        self._stop.set()
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def _work(self) -> None:
+        worker = chunk_worker_name()
+        while not self._stop.is_set():
+            try:
+                worked = self.work_once(worker)
+            except Exception:
+                logger.error("Failed to work on a charge chunk.", exc_info=True)
+                worked = False
+            if not worked:
+                self._stop.wait(Config.JOB_POLL_INTERVAL)
+
+    def work_once(self, worker: str | None = None) -> bool:
+        """
+        Claims and charges one chunk.
+
+        Returns:
+        - bool: False if no chunk was claimable.
+        """
+        worker = worker or chunk_worker_name()
+        chunk = queries.claim_charge_chunk(worker, Config.CHARGE_CHUNK_LEASE)
+        if chunk is None:
+            return False
+        logger.info(f"Charging chunk {chunk['chunk']} of charge run {chunk['run_id']}.")
+        # The chunks of a profiled run are profiled wherever they are charged
+        with profiling.profile(f"charge-run-{chunk['run_id']}-chunk-{chunk['chunk']}",
+                               enabled=chunk['profile'] or Config.PROFILE_CHARGE_RUNS):
+            work_chunk(chunk, worker)
+        return True
+
+
+def job_progress(job: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Turns a job row from Queries.fetch_charge_job_progress into the progress report served by the API.
+    """
+    elapsed = float(job['elapsed_seconds'] or 0)
+    throughput = job['processed'] / elapsed if elapsed > 0 else 0.0
+    eta = None
+    if job['status'] == 'running' and throughput > 0 and job['expected_customers'] is not None:
+        eta = max(0, job['expected_customers'] - job['processed']) / throughput
+    return {
+        'id': job['id'],
+        'type_code': job['type_code'],
+        'run_id': job['run_id'],
+        'status': job['status'],
+        'error': job['error'],
+        'expected': job['expected_customers'],
+        'processed': job['processed'],
+        'successes': job['successes'],
+        'failures': job['failures'],
+        'elapsed_seconds': round(elapsed, 1),
+        'throughput_per_second': round(throughput, 2),
+        'eta_seconds': round(eta, 1) if eta is not None else None,
+        'priority': job['priority'],
+        'scheduled_for': job['scheduled_for'].isoformat() if job['scheduled_for'] else None,
+        'window_ends_at': job['window_ends_at'].isoformat() if job['window_ends_at'] else None
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Charge the chunks of running charge runs (for dedicated worker hosts).')
+    parser.add_argument('--workers', type=int, default=max(Config.CHARGE_CHUNK_WORKERS, 1),
+                        help='Chunks charged concurrently.')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    stripe_client.configure()
+    runner = ChargeChunkRunner(args.workers)
+    runner.start()
+    try:
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        runner.stop()
+
+
+if __name__ == "__main__":
+    main()
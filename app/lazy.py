@@ -0,0 +1,41 @@
+# app/lazy.py
+import importlib
+from types import ModuleType
+from typing import Any
+
+
+class LazyModule:
+    def __init__(self, name: str):
+        """
+        Stands in for a module that is only imported on first attribute access. Reads and writes go to the real
+        module (e.g. stripe.api_key = ... sets the library's global), so it can replace a plain `import`.
+        :param name: The dotted module name, e.g. 'stripe' or 'sendgrid.helpers.mail'.
+        """
+        object.__setattr__(self, '_name', name)
+        object.__setattr__(self, '_module', None)
+
+    def _load(self) -> ModuleType:
+        module = self._module
+        if module is None:
+            # The import system's own lock makes concurrent first accesses import it once
+            module = importlib.import_module(self._name)
+            object.__setattr__(self, '_module', module)
+        return module
+
+    def __getattr__(self, attr: str) -> Any:
+        return getattr(self._load(), attr)
+
+    def __setattr__(self, attr: str, value: Any) -> None:
+        setattr(self._load(), attr, value)
+
+    def __repr__(self) -> str:
+        state = 'loaded' if self._module is not None else 'not loaded'
+        return f"<lazy module {self._name!r} ({state})>"
+
+
+def lazy_import(name: str) -> LazyModule:
+    """
+    Returns a stand-in for a heavy SDK (stripe, sendgrid, httpx) that imports it on first use, keeping it out of the
+    startup of processes and CLI commands that never call it.
+    """
+    return LazyModule(name)
@@ -1,14 +1,56 @@
-from sendgrid import SendGridAPIClient
-from sendgrid.helpers.mail import Mail
 import logging
-from flask import current_app
+import os
+import random
+import threading
+from typing import Any, Dict, List
+from app import metrics
+from app.config import Config
+from app.lazy import lazy_import
+from app.queries import Queries
+
+# The SendGrid SDK is imported when the first email is built or sent
+sendgrid = lazy_import('sendgrid')
+mail = lazy_import('sendgrid.helpers.mail')
+http_client_exceptions = lazy_import('python_http_client.exceptions')
+
+queries = Queries()
 
-    
 logger = logging.getLogger(__name__)
-        
-def construct_email(to_emails: list, template_id: str, template_data: dict) -> Mail:
-    from_email = (current_app.config['SUPPORT_EMAIL'], current_app.config['COMPANY_NAME'])
-    message = Mail(
+
+# SendGrid accepts at most this many personalizations (recipients with their own template data) per request
+MAX_PERSONALIZATIONS = 1000
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def _reset_after_fork() -> None:
+    # A forked child builds its own client instead of reusing the parent's connections
+    global _client, _client_lock
+    _client = None
+    _client_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def get_client() -> 'sendgrid.SendGridAPIClient':
+    """
+    Returns the process-wide SendGrid client, creating it on first use. Configured from Config, so it works
+    the same inside a request, a background job or a script.
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                client = sendgrid.SendGridAPIClient(Config.SENDGRID_API_KEY)
+                client.client.timeout = Config.SENDGRID_TIMEOUT
+                _client = client
+    return _client
+
+def construct_email(to_emails: list, template_id: str, template_data: dict) -> 'mail.Mail':
+    from_email = (Config.SUPPORT_EMAIL, Config.COMPANY_NAME)
+    message = mail.Mail(
         from_email=from_email,
         to_emails=to_emails,
         is_multiple=True
@@ -17,9 +59,146 @@ def construct_email(to_emails: list, template_id: str, template_data: dict) -> M
     message.dynamic_template_data = template_data
     return message
 
-def send_email(message: Mail) -> None:
+def construct_batch(template_id: str, recipients: List[Dict[str, Any]]) -> 'mail.Mail':
+    """
+    Builds one message that sends a dynamic template to many recipients, each with their own template data.
+
+    Parameters:
+    - template_id (str): The SendGrid dynamic template.
+    - recipients (List[Dict[str, Any]]): Up to MAX_PERSONALIZATIONS dicts with 'to_email' and 'template_data'.
+
+    Returns:
+    - Mail: The message, one personalization per recipient.
+    """
+    if len(recipients) > MAX_PERSONALIZATIONS:
+        raise ValueError(f"A batch holds at most {MAX_PERSONALIZATIONS} recipients.")
+    message = mail.Mail(from_email=(Config.SUPPORT_EMAIL, Config.COMPANY_NAME))
+    message.template_id = template_id
+    for index, recipient in enumerate(recipients):
+        personalization = mail.Personalization()
+        personalization.add_to(mail.To(recipient['to_email']))
+        personalization.dynamic_template_data = recipient.get('template_data') or {}
+        message.add_personalization(personalization, index)
+    return message
+
+def send_email(message: 'mail.Mail') -> None:
     try:
-        sendgrid_client = SendGridAPIClient(current_app.config['SENDGRID_API_KEY'])
-        sendgrid_client.send(message)
+        get_client().send(message)
     except Exception as e:
         logger.error(f"Failed to send email: {e}")
+
+def queue_email(to_email: str, template_id: str, template_data: dict | None = None, dedupe_key: str | None = None) -> bool:
+    """
+    Adds one email to the outbox; the outbox worker sends it. Returns False if the dedupe_key was already queued.
+    """
+    return queries.enqueue_emails([{
+        'to_email': to_email,
+        'template_id': template_id,
+        'template_data': template_data,
+        'dedupe_key': dedupe_key
+    }]) == 1
+
+def queue_charge_failure_emails(run_id: int) -> int:
+    """
+    Queues an UPDATE_PAYMENT_TEMPLATE_ID email to every customer whose charge failed in the run.
+    The template receives the customer's name, the failure reason and the amount.
+
+    Returns:
+    - int: The number of emails queued.
+    """
+    queued = queries.enqueue_charge_failure_emails(run_id, Config.UPDATE_PAYMENT_TEMPLATE_ID)
+    logger.info(f"Queued {queued} update payment emails for charge run {run_id}.")
+    return queued
+
+
+def _is_permanent(error: Exception) -> bool:
+    # 4xx other than rate limiting will fail the same way on every retry
+    status = getattr(error, 'status_code', None)
+    return isinstance(error, http_client_exceptions.HTTPError) and status is not None and 400 <= status < 500 and status != 429
+
+
+def _retry_delay(attempts: int) -> float:
+    delay = min(Config.EMAIL_BACKOFF_MAX, Config.EMAIL_BACKOFF_BASE * 2 ** (attempts - 1))
+    return random.uniform(delay / 2, delay)
+
+
+class OutboxWorker:
+    def __init__(self, batch_size: int | None = None):
+        """
+        Sends the emails queued in the outbox from a background thread, batching recipients of the same template
+        into one SendGrid request. Needs no Flask app, so it also runs inside scripts and charge jobs.
+        :param batch_size: Emails claimed per round. Defaults to Config.EMAIL_BATCH_SIZE.
+        """
+        self.batch_size = batch_size or Config.EMAIL_BATCH_SIZE
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self) -> None:
+        """
+        Starts the sender thread.
+        """
+        if not Config.EMAIL_OUTBOX_WORKER:
+            return
+        self._thread = threading.Thread(target=self._work, name='email-outbox', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float | None = None) -> None:
+        """
+        Asks the sender thread to stop after its current round and waits for it.
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _work(self) -> None:
+        while not self._stop.is_set():
+            try:
+                claimed = self.drain_once()
+            except Exception:
+                logger.error("Failed to drain the email outbox.", exc_info=True)
+                claimed = 0
+            # Keep going while there is a backlog, otherwise poll
+            if claimed < self.batch_size:
+                self._stop.wait(Config.EMAIL_POLL_INTERVAL)
+
+    def drain_once(self) -> int:
+        """
+        Claims one round of due emails and sends them, one request per template and MAX_PERSONALIZATIONS recipients.
+
+        Returns:
+        - int: The number of emails claimed.
+        """
+        records = queries.claim_emails(self.batch_size, Config.EMAIL_LEASE_SECONDS)
+        by_template: Dict[str, List[Dict[str, Any]]] = {}
+        for record in records:
+            by_template.setdefault(record['template_id'], []).append(record)
+        for template_id, group in by_template.items():
+            for start in range(0, len(group), MAX_PERSONALIZATIONS):
+                self._send(template_id, group[start:start + MAX_PERSONALIZATIONS])
+        return len(records)
+
+    def _send(self, template_id: str, batch: List[Dict[str, Any]]) -> None:
+        email_ids = [record['id'] for record in batch]
+        try:
+            get_client().send(construct_batch(template_id, batch))
+        except Exception as e:
+            if _is_permanent(e) and len(batch) > 1:
+                # One bad address rejects the whole request; bisect so only the offending email ends up failed
+                logger.warning(f"SendGrid rejected a batch of {len(batch)} emails, splitting it.")
+                middle = len(batch) // 2
+                self._send(template_id, batch[:middle])
+                self._send(template_id, batch[middle:])
+                return
+            attempts = max(record['attempts'] for record in batch)
+            if _is_permanent(e) or attempts >= Config.EMAIL_MAX_ATTEMPTS:
+                logger.error(f"Giving up on {len(batch)} emails: {e}")
+                queries.finish_emails(email_ids, 'failed', error=str(e))
+                metrics.EMAILS.inc('failed', amount=len(batch))
+                return
+            delay = _retry_delay(attempts)
+            logger.warning(f"Failed to send {len(batch)} emails, retrying in {delay:.0f}s: {e}")
+            queries.finish_emails(email_ids, 'queued', error=str(e), retry_in=delay)
+            metrics.EMAILS.inc('retried', amount=len(batch))
+            return
+        queries.finish_emails(email_ids, 'sent')
+        metrics.EMAILS.inc('sent', amount=len(batch))
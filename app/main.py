@@ -1,253 +1,187 @@
 # app/main.py
-from flask import Flask, request, jsonify, g
+from flask import Blueprint, Flask, Response, current_app, request, jsonify, g
 from app.config import Config
-from app.database import Database
-import stripe
+from app.database import get_database
 import logging
-import json
-from app.charge_calendar import process_charges
-from app.queries import Queries
-
-queries = Queries()
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from app.jobs import ChargeChunkRunner, ChargeJobRunner
+from app import flow, handlers, metrics, profiling, signup
+from app.webhook_inbox import WebhookInboxWorker
+from app.mailer import OutboxWorker
+from app.scheduler import ChargeScheduler
 
 logger = logging.getLogger(__name__)
 
-app = Flask(__name__)
-app.config.from_object(Config)
-db = Database(app.config['DATABASE_URL'])
-
-# Set Stripe's secret key
-stripe.api_key = app.config['STRIPE_SECRET_KEY']
-
-
-def create_checkout_session(customer_id) -> stripe.checkout.Session:
-    customer = stripe.Customer.retrieve(customer_id)
-    session = stripe.checkout.Session.create(
-        customer=customer,
-        payment_method_types=['card', 'us_bank_account'],
-        mode='setup',
-        success_url=app.config['SUCCESS_URL']
-    )
-    return session
-
-def customer_exists_in_stripe(email: str) -> bool | dict:
-    try:
-        # Check for existing customer by email in Stripe
-        existing_customers = stripe.Customer.list(email=email).data
-        if existing_customers:
-            return True
-    except stripe.StripeError as e:
-        logger.error("Failed to query Stripe for existing customer.", exc_info=True)
-        return jsonify({'error': 'Failed to communicate with Stripe.'}), 500
-    return False
-    
-def create_customer(name: dict, email: str, phone: str) -> str:
-    database_check = queries.check_existence(
-        table_name='customers',
-        fields=['email', 'phone'], 
-        values=[email, phone]
-    )
-    if isinstance(database_check, dict):
-        return database_check
-    
-    stripe_check = customer_exists_in_stripe(email)
-    if isinstance(stripe_check, dict):
-        return stripe_check
-
-    try:
-        customer = stripe.Customer.create(
-            name=f"{name.get('first')}, {name.get('last')}",
-            email=email,
-            phone=phone,
-        )
-        return customer.id
-    except stripe.StripeError:
-        logger.error("Failed to create Stripe customer.", exc_info=True)
-        return jsonify({'error': 'Failed to create customer in Stripe.'}), 500
-   
-   
-@app.route('/')
+api = Blueprint('api', __name__)
+
+
+class BackgroundWorkers:
+    def __init__(self, app: Flask):
+        """
+        The background threads of one process: the charge job runner that executes the jobs queued by
+        /process-charges, the chunk runner that helps with the chunks of any running charge run, the webhook inbox
+        worker that applies the events persisted by /webhook, the email outbox worker and the charge scheduler.
+        Threads do not survive a fork, so start them in the process that serves (e.g. gunicorn's post_fork hook
+        when the app is preloaded).
+        :param app: The Flask app whose context the job and webhook workers run in.
+        """
+        self.job_runner = ChargeJobRunner(app)
+        self.chunk_runner = ChargeChunkRunner()
+        self.webhook_worker = WebhookInboxWorker(app)
+        self.email_worker = OutboxWorker()
+        self.charge_scheduler = ChargeScheduler()
+
+    @property
+    def workers(self) -> tuple:
+        return self.job_runner, self.chunk_runner, self.webhook_worker, self.email_worker, self.charge_scheduler
+
+    def start(self) -> None:
+        """
+        Starts every worker (each one checks its own Config switch).
+        """
+        for worker in self.workers:
+            worker.start()
+
+    def stop(self, timeout: float | None = None) -> None:
+        """
+        Asks every worker to stop and waits up to timeout for each.
+        """
+        for worker in self.workers:
+            worker.stop(timeout)
+
+
+def create_app(start_workers: bool | None = None) -> Flask:
+    """
+    Builds the Flask app. Nothing connects here: the Postgres pool, the Stripe client and the SendGrid client are
+    created on first use in the process that uses them, and again in a forked child, so the factory is cheap and
+    safe to call before a pre-fork server forks.
+
+    Parameters:
+    - start_workers (bool | None): Start the background workers in this process. Defaults to Config.BACKGROUND_WORKERS.
+
+    Returns:
+    - Flask: The app, with its BackgroundWorkers in app.extensions['background_workers'].
+    """
+    app = Flask(__name__)
+    app.config.from_object(Config)
+    app.register_blueprint(api)
+    app.before_request(start_request_profile)
+    app.before_request(start_request_timer)
+    app.after_request(observe_request_latency)
+    app.after_request(tag_request_profile)
+    app.teardown_request(stop_request_profile)
+    app.teardown_appcontext(release_db_connection)
+
+    # Runs the Stripe duplicate check of a signup while the request thread runs the database one. Its threads are
+    # only started by the first signup, so they belong to the process that serves it.
+    app.extensions['signup_checks'] = ThreadPoolExecutor(max_workers=Config.SIGNUP_CHECK_WORKERS,
+                                                         thread_name_prefix='signup-check')
+
+    workers = BackgroundWorkers(app)
+    app.extensions['background_workers'] = workers
+    if Config.BACKGROUND_WORKERS if start_workers is None else start_workers:
+        workers.start()
+    return app
+
+
+def respond(outcome: tuple):
+    # Builds the response of shared route logic (app/handlers.py): a dict body is JSON, a str is sent as is
+    body, status = outcome
+    return (jsonify(body) if isinstance(body, dict) else body), status
+
+
+@api.route('/')
 def hello_world():
     return 'Hello, World!'
  
-@app.route('/submit-application', methods=['POST'])
+@api.route('/submit-application', methods=['POST'])
 def submit_application():
-    data: dict = request.json
-    email = data.get('email')
-    phone = data.get('phone')
-    name = data.get('name', {})
-    address = data.get('address', {})
-    metadata = data.get('metadata', {})
-
-    if not email or not phone:
-        return jsonify({'error': 'Both email and phone number are required.'}), 400
-
-    if not all(key in name for key in ['first', 'last']):
-        return jsonify({'error': 'Name must include "first" and "last" fields.'}), 400
-    if not all(key in address for key in ['state', 'city', 'address1', 'zip']):
-        return jsonify({'error': 'Address must include State, City, Address1, and Zip fields.'}), 400
-    
-    stripe_check = customer_exists_in_stripe(email)
-    if not isinstance(stripe_check, bool):
-        return stripe_check
-    database_check = queries.check_existence(
-        table_name='customers',
-        fields=['email', 'phone'], 
-        values=[email, phone]
-    )
-    if not isinstance(database_check, bool):
-        return database_check 
-    if stripe_check is True or database_check is True:
-        return jsonify({'error': 'Customer already exists.'}), 409
-
-    response = create_customer(name, email, phone)
-    if not isinstance(response, str):
-        return response
-    customer_id = response
+    form, error = signup.parse_signup(request.json, request.headers.get(signup.SIGNUP_KEY_HEADER))
+    if error:
+        return jsonify({'error': error}), 400
+    # The two duplicate checks are independent, the Stripe one (mirror, else Customer.list) runs on signup_checks
+    stripe_check = current_app.extensions['signup_checks'].submit(profiling.bind(flow.run), signup.stripe_check(form))
+    return respond(flow.run(signup.submit(form, flow.Call(stripe_check.result, None))))
     
-    try:
-        data={
-            'customer_id': customer_id,
-            'email': email,
-            'phone': phone,
-            'name': json.dumps(name),
-            'address': json.dumps(address),
-            'metadata': json.dumps(metadata)
-        }
-        queries.insert_record(table_name='customers', data=data)
-        return jsonify({'message': 'Application submitted successfully.', 'id': customer_id}), 201
-    except Exception as e:
-        stripe.Customer.delete(customer_id)
-        return jsonify({'error': 'An error occurred. Please try again later.'}), 409
-    
-@app.route('/add-payment', methods=['POST'])
+@api.route('/add-payment', methods=['POST'])
 def add_payment():
-    data: dict = request.json
-    customer_id = data.get('customer_id')
-    try:
-        session = create_checkout_session(customer_id)
-    except stripe.StripeError as e:
-        logger.error("Failed to create checkout session.", exc_info=True)
-        return jsonify({'error': 'Failed to create checkout session.'}), 500
-    logger.debug('Checkout session created.')
-    return jsonify({'message': 'Your update payment link is ready.', 'id': customer_id, 'link': session.url})
-
-@app.route('/customer-payment-methods', methods=['POST'])
+    return respond(flow.run(handlers.add_payment(request.json)))
+
+@api.route('/customer-payment-methods', methods=['POST'])
 def customer_payment_methods():
-    data: dict = request.json
-    customer_id = data.get('customer_id')
-
-    if not customer_id:
-        return jsonify({'error': 'Customer ID is required.'}), 400
-
-    try:
-        customer = stripe.Customer.retrieve(customer_id)
-        payment_methods = stripe.PaymentMethod.list(customer=customer_id)
-
-        # Extract default payment method ID from the customer object
-        invoice_settings: dict = customer.get('invoice_settings', {})
-        default_payment_method_id = invoice_settings.get('default_payment_method')
-
-        # Prepare the list of payment method IDs and indicate which one is the default
-        payment_methods_info = []
-        for pm in payment_methods.data:
-            payment_methods_info.append({
-                'id': pm.id,
-                'is_default': pm.id == default_payment_method_id
-            })
-
-        return jsonify({'payment_methods': payment_methods_info}), 200
-    except stripe.StripeError as e:
-        logger.error("Failed to retrieve payment methods from Stripe.", exc_info=True)
-        return jsonify({'error': 'Failed to retrieve payment methods from Stripe.'}), 500
+    return respond(flow.run(handlers.customer_payment_methods(request.json)))
     
-@app.route('/set-default-payment-method', methods=['POST'])
+@api.route('/set-default-payment-method', methods=['POST'])
 def set_default_payment_method():
-    data: dict = request.json
-    customer_id = data.get('customer_id')
-    payment_method_id = data.get('payment_method_id')
-
-    if not customer_id:
-        return jsonify({'error': 'Customer ID is required.'}), 400
-    if not payment_method_id:
-        return jsonify({'error': 'Payment method ID is required.'}), 400
-
-    try:
-        # Retrieve the customer to check the current default payment method
-        customer = stripe.Customer.retrieve(customer_id)
-        invoice_settings: dict = customer.get('invoice_settings', {})
-        current_default_payment_method_id = invoice_settings.get('default_payment_method')
-
-        # Check if the provided payment method ID is already the default
-        if payment_method_id == current_default_payment_method_id:
-            return jsonify({'message': 'The provided payment method is already the default.'}), 200
-
-        # Attempt to update the default payment method
-        stripe.Customer.modify(customer_id, 
-                               invoice_settings={'default_payment_method': payment_method_id})
-
-        return jsonify({'message': 'Default payment method updated successfully.'}), 200
-    except stripe.InvalidRequestError as e:
-        # Handle scenarios like invalid customer ID or payment method ID
-        return jsonify({'error': str(e)}), 400
-    except stripe.StripeError as e:
-        logger.error("Stripe API call failed.", exc_info=True)
-        return jsonify({'error': 'Failed to update the default payment method.'}), 500
+    return respond(flow.run(handlers.set_default_payment_method(request.json)))
     
-@app.route('/process-charges', methods=['POST'])
+@api.route('/process-charges', methods=['POST'])
 def process_charges_route():
-    data: dict = request.json
-    type_code = data.get('type_code')
-    try:
-        process_charges(type_code)
-        return jsonify({'message': 'Charges processed successfully.'}), 200
-    except Exception as e:
-        logger.error("Failed to process charges.", exc_info=True)
-        return jsonify({'error': 'Failed to process charges.'}), 500
+    # An authorized X-Profile header profiles the run itself, not just this request
+    profile = profiling.authorized(request.headers.get(profiling.PROFILE_HEADER))
+    return respond(flow.run(handlers.process_charges(request.json, profile)))
+
+@api.route('/charge-jobs/<int:job_id>', methods=['GET'])
+def charge_job_status(job_id: int):
+    return respond(flow.run(handlers.charge_job_status(job_id)))
     
-@app.route('/webhook', methods=['POST'])
+@api.route('/webhook', methods=['POST'])
 def webhook():
-    logger.debug("Received webhook.")
-    payload = request.data
-    sig_header = request.headers['STRIPE_SIGNATURE']
-    try:
-        event = stripe.Webhook.construct_event(
-            payload, sig_header, app.config["WEBHOOK_SIGNING_SECRET"]
-        )
-    except ValueError as e:
-        logger.error(f'Invalid payload: {e}')
-        return 'Invalid payload', 400
-    except stripe.SignatureVerificationError as e:
-        logger.error(f'Invalid signature: {e}')
-        return 'Invalid signature', 400
-    except Exception as e:
-        logger.error(f'Unhandled exception: {e}')
-        return 'Internal server error', 500
-    
-    if event['type'] == 'customer.deleted':
-        event_object = event['data']['object']
-        customer_id = event_object['id']
-        logger.debug(f"Customer ID: {customer_id}")
-        queries.delete_record('customers', {'customer_id': customer_id})
-    
-    return jsonify(success=True), 200
-    
-    # Add event handling logic here
-
-
-@app.before_request
-def before_request():
-    # Acquire a connection
-    g.db_conn = db.connection_pool.getconn()
-
-@app.teardown_request
-def teardown_request(exception=None):
-    # Put back into the pool
-    db_conn = getattr(g, 'db_conn', None)
+    return respond(flow.run(handlers.webhook(request.data, request.headers['STRIPE_SIGNATURE'])))
+
+@api.route('/webhook-inbox-stats', methods=['GET'])
+def webhook_inbox_stats():
+    return respond(flow.run(handlers.webhook_inbox_stats()))
+
+
+@api.route('/pool-stats', methods=['GET'])
+def pool_stats():
+    return jsonify(get_database().stats()), 200
+
+@api.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    metrics.update_pool_metrics(get_database().stats())
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+def start_request_profile():
+    # Opt-in sampling profile and span timings of this one request, see app/profiling.py
+    if profiling.request_profiled(request.headers.get(profiling.PROFILE_HEADER)):
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        g.profile = ExitStack()
+        g.profile_trace = g.profile.enter_context(profiling.profile(f"request-{request.method}-{route}"))
+
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+def observe_request_latency(response):
+    started = g.pop('request_started', None)
+    if started is not None:
+        # Label by the route pattern, not the path, so /charge-jobs/<id> stays a single series
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        metrics.HTTP_REQUEST_DURATION.observe(time.perf_counter() - started, route, request.method, str(response.status_code))
+    return response
+
+def tag_request_profile(response):
+    # Tells the caller which files in PROFILE_DIR hold the profile
+    trace = g.get('profile_trace')
+    if trace is not None:
+        response.headers[profiling.PROFILE_ID_HEADER] = trace.name
+    return response
+
+def stop_request_profile(exception=None):
+    profile = g.pop('profile', None)
+    if profile is not None:
+        profile.close()
+
+def release_db_connection(exception=None):
+    # Queries checks a connection out lazily on first use; hand it back for reuse
+    db_conn = g.pop('db_conn', None)
     if db_conn is not None:
-        db.connection_pool.putconn(db_conn, close=True)
+        get_database().putconn(db_conn)
 
 
 if __name__ == "__main__":
-    app.run(debug=True)
+    create_app().run(debug=True)
     
\ No newline at end of file
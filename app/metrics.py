@@ -0,0 +1,181 @@
+# app/metrics.py
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Tuple
+
+# Latency buckets in seconds, from a warm index lookup up to a Stripe call that hits the read timeout
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_registry: List['_Metric'] = []
+
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class _Metric:
+    kind = ''
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        """
+        Base class of the process-local metrics rendered by /metrics. Registers itself on creation.
+        :param name: The Prometheus metric name.
+        :param documentation: The HELP text.
+        :param labelnames: The label names; every sample passes values for them in the same order.
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values: Dict[Tuple[str, ...], float] = {}
+        _registry.append(self)
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            values = dict(self._values)
+        return [f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}"
+                for labels, value in sorted(values.items())]
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self._samples())
+        return '\n'.join(lines)
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, *labels: str, amount: float = 1.0) -> None:
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def set_total(self, value: float, *labels: str) -> None:
+        # For totals counted elsewhere (e.g. Database.stats) and copied in at scrape time
+        with self._lock:
+            self._values[labels] = value
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def set(self, value: float, *labels: str) -> None:
+        with self._lock:
+            self._values[labels] = value
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (), buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        """
+        A cumulative histogram. Observing is one bisect and one locked list update, cheap enough for every query.
+        :param buckets: Sorted upper bounds; +Inf is implied.
+        """
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+        # labels -> [per-bucket counts (last one is +Inf), sum]
+        self._series: Dict[Tuple[str, ...], list] = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    @contextmanager
+    def time(self, *labels: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labels)
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            series = {labels: (list(counts), total) for labels, (counts, total) in self._series.items()}
+        lines = []
+        for labels, (counts, total) in sorted(series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = 'le="+Inf"' if bound == float('inf') else f'le="{bound!r}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}")
+            label_text = _format_labels(self.labelnames, labels)
+            lines.append(f"{self.name}_sum{label_text} {_format_value(total)}")
+            lines.append(f"{self.name}_count{label_text} {cumulative}")
+        return lines
+
+
+def render() -> str:
+    """
+    Renders every registered metric in the Prometheus text exposition format (version 0.0.4).
+    Metrics are per process; with several server processes each one is scraped separately.
+    """
+    return '\n'.join(metric.render() for metric in _registry) + '\n'
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+HTTP_REQUEST_DURATION = Histogram(
+    'paysync_http_request_duration_seconds', 'Flask request latency by route.', ('route', 'method', 'status'))
+
+STRIPE_REQUESTS = Counter(
+    'paysync_stripe_requests_total', 'Stripe API requests by API method, every retry included.', ('method',))
+STRIPE_ERRORS = Counter(
+    'paysync_stripe_errors_total', 'Stripe API errors by API method and error class.', ('method', 'error'))
+STRIPE_REQUEST_DURATION = Histogram(
+    'paysync_stripe_request_duration_seconds', 'Stripe API request latency by API method.', ('method',))
+
+DB_QUERY_DURATION = Histogram(
+    'paysync_db_query_duration_seconds', 'Queries method latency, connection checkout included.', ('query',))
+DB_QUERY_ERRORS = Counter(
+    'paysync_db_query_errors_total', 'Queries methods that raised.', ('query',))
+DB_POOL_CONNECTIONS = Gauge(
+    'paysync_db_pool_connections', 'Open pool connections by state.', ('state',))
+DB_POOL_WAITING = Gauge(
+    'paysync_db_pool_waiting_threads', 'Threads currently blocked waiting for a pool connection.')
+DB_POOL_CHECKOUTS = Counter(
+    'paysync_db_pool_checkouts_total', 'Connections handed out by the pool since it was created.')
+DB_POOL_TIMEOUTS = Counter(
+    'paysync_db_pool_timeouts_total', 'Checkouts that gave up waiting for a connection.')
+DB_POOL_WAIT_SECONDS = Counter(
+    'paysync_db_pool_wait_seconds_total', 'Time spent waiting for pool connections.')
+
+CHARGE_ATTEMPTS = Counter(
+    'paysync_charge_attempts_total', 'Settled charge attempts by outcome.', ('status',))
+CHARGE_AMOUNT = Counter(
+    'paysync_charge_amount_cents_total', 'Amount charged successfully, in cents.')
+CHARGE_RUNS = Counter(
+    'paysync_charge_runs_total', 'Finished charge runs by final status.', ('status',))
+
+EMAILS = Counter(
+    'paysync_emails_total', 'Outbox emails by outcome of their send attempt.', ('status',))
+
+
+def update_pool_metrics(stats: Dict[str, float]) -> None:
+    """
+    Copies a Database.stats() snapshot into the pool metrics; called right before rendering.
+    """
+    DB_POOL_CONNECTIONS.set(stats['in_use'], 'in_use')
+    DB_POOL_CONNECTIONS.set(stats['idle'], 'idle')
+    DB_POOL_CONNECTIONS.set(stats['maxconn'], 'max')
+    DB_POOL_WAITING.set(stats['waiting'])
+    DB_POOL_CHECKOUTS.set_total(stats['checkouts'])
+    DB_POOL_TIMEOUTS.set_total(stats['timeouts'])
+    DB_POOL_WAIT_SECONDS.set_total(stats['wait_seconds_total'])
@@ -0,0 +1,180 @@
+# app/migrate.py
+import argparse
+import json
+import logging
+import os
+import re
+from typing import Any, Dict, List, Tuple
+
+from app import sql
+from app.database import get_database
+
+logger = logging.getLogger(__name__)
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(__file__), 'migrations')
+MIGRATION_FILE = re.compile(r'^(\d+)_([\w-]+)\.sql$')
+# Arbitrary constant shared by every migrator so two processes never apply migrations at the same time
+MIGRATION_LOCK_ID = 7261534
+
+# The statements Queries runs on hot paths, with representative parameters, checked by `explain`
+HOT_QUERIES: List[Tuple[str, str, tuple]] = [
+    ('check_existence customers by email/phone',
+     sql.compile_query('exists', 'customers', ('email', 'phone')), ('someone@example.com', '+15555550100')),
+    ('customers by type code',
+     sql.compile_query('select', 'customers', ('customer_type',), ('customer_id', 'email', 'phone', 'name')), ('type',)),
+    ('charge_info by type code',
+     sql.compile_query('select', 'charge_info', ('type_code',), ('label', 'data')), ('type',)),
+    ('delete customer by id',
+     sql.compile_query('delete', 'customers', ('customer_id',)), ('cus_example',)),
+    ('settled customers of a run',
+     "SELECT customer_id FROM charge_attempts WHERE run_id = %s AND status IN ('success', 'failure', 'skipped')", (1,)),
+    ('due charge retries',
+     "SELECT run_id FROM charge_attempts WHERE status = 'failure' AND failure_type = 'transient' AND next_retry_at <= now()", ()),
+    ('charge attempt by PaymentIntent',
+     "SELECT run_id FROM charge_attempts WHERE payment_intent_id = %s", ('pi_example',)),
+    ('charge blocks of a chunk',
+     "SELECT customer_id FROM charge_blocks WHERE customer_id = ANY(%s)", (['cus_example'],)),
+    ('stripe mirror by email/phone',
+     "SELECT customer_id, signup_key FROM stripe_customers WHERE NOT deleted AND (email_normalized = %s OR phone_normalized = %s) "
+     "ORDER BY signup_key IS NOT DISTINCT FROM %s DESC LIMIT 1",
+     ('someone@example.com', '15555550100', 'signup-example')),
+    ('webhook inbox backlog',
+     "SELECT event_id FROM webhook_events WHERE processed_at IS NULL ORDER BY received_at LIMIT 200", ()),
+    ('due outbox emails',
+     "SELECT id FROM email_outbox WHERE status = 'queued' AND next_attempt_at <= now() ORDER BY next_attempt_at LIMIT 1000", ()),
+    ('next queued charge job',
+     "SELECT id FROM charge_jobs WHERE status = 'queued' ORDER BY priority DESC, id LIMIT 1", ()),
+    ('next claimable charge chunk',
+     "SELECT run_id, chunk FROM charge_chunks WHERE status IN ('queued', 'running') AND available_at <= now() "
+     "ORDER BY priority DESC, available_at LIMIT 1", ()),
+]
+
+
+def available_migrations() -> List[Tuple[int, str, str]]:
+    """
+    Lists the migration files shipped with the package.
+
+    Returns:
+    - List[Tuple[int, str, str]]: (version, name, path) tuples sorted by version.
+    """
+    migrations = []
+    for filename in os.listdir(MIGRATIONS_DIR):
+        match = MIGRATION_FILE.match(filename)
+        if match:
+            migrations.append((int(match.group(1)), match.group(2), os.path.join(MIGRATIONS_DIR, filename)))
+    return sorted(migrations)
+
+
+def _ensure_migrations_table(cursor) -> None:
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS schema_migrations (
+        version INTEGER PRIMARY KEY,
+        name TEXT NOT NULL,
+        applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+    )
+    """)
+
+
+def applied_versions() -> Dict[int, Any]:
+    """
+    Returns the applied migration versions mapped to when they were applied.
+    """
+    with get_database().get_connection() as conn:
+        with conn:
+            with conn.cursor() as cursor:
+                _ensure_migrations_table(cursor)
+                cursor.execute("SELECT version, applied_at FROM schema_migrations")
+                return dict(cursor.fetchall())
+
+
+def upgrade(target: int | None = None) -> List[int]:
+    """
+    Applies every pending migration up to target, each in its own transaction.
+
+    Parameters:
+    - target (int | None): The last version to apply. Defaults to the newest one.
+
+    Returns:
+    - List[int]: The versions that were applied.
+
+    Raises:
+    - Exception: Propagates the error of the failing migration. Earlier migrations stay applied.
+    """
+    applied = []
+    with get_database().get_connection() as conn:
+        for version, name, path in available_migrations():
+            if target is not None and version > target:
+                break
+            with conn:
+                with conn.cursor() as cursor:
+                    cursor.execute("SELECT pg_advisory_xact_lock(%s)", (MIGRATION_LOCK_ID,))
+                    _ensure_migrations_table(cursor)
+                    cursor.execute("SELECT 1 FROM schema_migrations WHERE version = %s", (version,))
+                    if cursor.fetchone():
+                        continue
+                    logger.info(f"Applying migration {version:04d}_{name}.")
+                    with open(path) as file:
+                        cursor.execute(file.read())
+                    cursor.execute("INSERT INTO schema_migrations (version, name) VALUES (%s, %s)", (version, name))
+            applied.append(version)
+    return applied
+
+
+def _plan_nodes(plan: Dict[str, Any]):
+    yield plan
+    for child in plan.get('Plans', []):
+        yield from _plan_nodes(child)
+
+
+def explain() -> List[Dict[str, Any]]:
+    """
+    EXPLAINs every hot query and reports the scans it uses. Each query is planned twice: as the planner would run
+    it today, and with sequential scans disabled, which shows whether a usable index exists even while the table
+    is still too small for the planner to prefer it.
+
+    Returns:
+    - List[Dict[str, Any]]: One entry per query with its scan node types and whether it can use an index.
+    """
+    report = []
+    with get_database().get_connection() as conn:
+        with conn.cursor() as cursor:
+            for label, query, params in HOT_QUERIES:
+                entry = {'query': label}
+                for key, seqscan in (('scans', 'on'), ('scans_without_seqscan', 'off')):
+                    cursor.execute(f"SET LOCAL enable_seqscan = {seqscan}")
+                    cursor.execute(f"EXPLAIN (FORMAT JSON) {query}", params)
+                    plan = cursor.fetchone()[0][0]['Plan']
+                    entry[key] = [node['Node Type'] for node in _plan_nodes(plan) if 'Scan' in node['Node Type']]
+                entry['uses_index'] = 'Seq Scan' not in entry['scans_without_seqscan']
+                report.append(entry)
+        conn.rollback()
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Manage the database schema.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    upgrade_parser = subparsers.add_parser('upgrade', help='Apply pending migrations.')
+    upgrade_parser.add_argument('--target', type=int, help='Last migration version to apply.')
+    subparsers.add_parser('status', help='Show applied and pending migrations.')
+    subparsers.add_parser('explain', help='Check that the hot queries can use an index.')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.command == 'upgrade':
+        applied = upgrade(args.target)
+        logger.info(f"Applied {len(applied)} migrations." if applied else "Database is up to date.")
+    elif args.command == 'status':
+        applied = applied_versions()
+        for version, name, _ in available_migrations():
+            state = f"applied {applied[version]:%Y-%m-%d %H:%M}" if version in applied else 'pending'
+            print(f"{version:04d}_{name}: {state}")
+    else:
+        report = explain()
+        print(json.dumps(report, indent=4))
+        if not all(entry['uses_index'] for entry in report):
+            raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
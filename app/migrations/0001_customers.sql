@@ -0,0 +1,27 @@
+-- Core tables. IF NOT EXISTS keeps this safe on databases created before migrations existed.
+CREATE TABLE IF NOT EXISTS customers (
+    customer_id TEXT NOT NULL,
+    email TEXT NOT NULL,
+    phone TEXT NOT NULL,
+    name JSONB,
+    address JSONB,
+    metadata JSONB,
+    customer_type TEXT,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+CREATE TABLE IF NOT EXISTS charge_info (
+    type_code TEXT NOT NULL,
+    label TEXT,
+    data JSONB NOT NULL
+);
+
+-- webhook deletes and charge lookups by Stripe id
+CREATE UNIQUE INDEX IF NOT EXISTS customers_customer_id_key ON customers (customer_id);
+-- check_existence: email = %s OR phone = %s (bitmap OR of both indexes), and no duplicate signups
+CREATE UNIQUE INDEX IF NOT EXISTS customers_email_key ON customers (email);
+CREATE UNIQUE INDEX IF NOT EXISTS customers_phone_key ON customers (phone);
+-- customers_from_type_code / stream_customers_from_type_code
+CREATE INDEX IF NOT EXISTS customers_customer_type_idx ON customers (customer_type);
+-- fetch_charge_info: exactly one charge_info row per type code
+CREATE UNIQUE INDEX IF NOT EXISTS charge_info_type_code_key ON charge_info (type_code);
@@ -0,0 +1,40 @@
+-- Charge run ledger and background job queue (previously created on demand by Queries).
+CREATE TABLE IF NOT EXISTS charge_runs (
+    id SERIAL PRIMARY KEY,
+    type_code TEXT NOT NULL,
+    charge_info JSONB NOT NULL,
+    status TEXT NOT NULL DEFAULT 'running',
+    total_customers INTEGER,
+    charged_customers INTEGER,
+    started_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    finished_at TIMESTAMPTZ
+);
+
+CREATE TABLE IF NOT EXISTS charge_attempts (
+    run_id INTEGER NOT NULL REFERENCES charge_runs (id),
+    customer_id TEXT NOT NULL,
+    idempotency_key TEXT NOT NULL,
+    status TEXT NOT NULL,
+    charge_type TEXT,
+    amount_charged INTEGER,
+    reason TEXT,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    PRIMARY KEY (run_id, customer_id)
+);
+
+CREATE TABLE IF NOT EXISTS charge_jobs (
+    id SERIAL PRIMARY KEY,
+    type_code TEXT,
+    run_id INTEGER REFERENCES charge_runs (id),
+    status TEXT NOT NULL DEFAULT 'queued',
+    expected_customers INTEGER,
+    worker TEXT,
+    error TEXT,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    started_at TIMESTAMPTZ,
+    heartbeat_at TIMESTAMPTZ,
+    finished_at TIMESTAMPTZ
+);
+
+-- claim_charge_job polls queued jobs, requeue_stale_charge_jobs scans running ones
+CREATE INDEX IF NOT EXISTS charge_jobs_open_idx ON charge_jobs (status, id) WHERE status IN ('queued', 'running');
@@ -0,0 +1,20 @@
+-- Local mirror of Stripe customers, answered instead of stripe.Customer.list on signup.
+CREATE TABLE IF NOT EXISTS stripe_customers (
+    customer_id TEXT PRIMARY KEY,
+    email_normalized TEXT,
+    phone_normalized TEXT,
+    deleted BOOLEAN NOT NULL DEFAULT false,
+    default_payment_method TEXT,
+    stripe_created TIMESTAMPTZ,
+    synced_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+-- Stripe allows duplicate emails, so these are not unique. Deleted customers never count as duplicates.
+CREATE INDEX IF NOT EXISTS stripe_customers_email_idx ON stripe_customers (email_normalized) WHERE NOT deleted;
+CREATE INDEX IF NOT EXISTS stripe_customers_phone_idx ON stripe_customers (phone_normalized) WHERE NOT deleted;
+
+-- When the mirror was last fully synced ('full_sync') and last touched by a webhook ('event')
+CREATE TABLE IF NOT EXISTS stripe_mirror_state (
+    name TEXT PRIMARY KEY,
+    synced_at TIMESTAMPTZ NOT NULL
+);
@@ -0,0 +1,3 @@
+-- customers tables created before 0001 have no created_at; incremental reconciliation filters on it.
+ALTER TABLE customers ADD COLUMN IF NOT EXISTS created_at TIMESTAMPTZ NOT NULL DEFAULT now();
+CREATE INDEX IF NOT EXISTS customers_created_at_idx ON customers (created_at);
@@ -0,0 +1,18 @@
+-- Durable inbox for Stripe webhooks. The event id primary key turns redeliveries into no-ops.
+CREATE TABLE IF NOT EXISTS webhook_events (
+    event_id TEXT PRIMARY KEY,
+    type TEXT NOT NULL,
+    payload JSONB NOT NULL,
+    stripe_created TIMESTAMPTZ,
+    received_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    locked_until TIMESTAMPTZ,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT,
+    processed_at TIMESTAMPTZ
+);
+
+-- The drain loop and the backlog stats only ever look at unprocessed events
+CREATE INDEX IF NOT EXISTS webhook_events_backlog_idx ON webhook_events (received_at) WHERE processed_at IS NULL;
+
+-- Bumped by payment_method.* events so charging can tell when a customer's payment info changed
+ALTER TABLE stripe_customers ADD COLUMN IF NOT EXISTS payment_info_updated_at TIMESTAMPTZ;
@@ -0,0 +1,19 @@
+-- Outbox of transactional emails, sent in batches by the mailer worker.
+CREATE TABLE IF NOT EXISTS email_outbox (
+    id BIGSERIAL PRIMARY KEY,
+    -- Optional; makes re-queuing the same email (e.g. when a charge run is resumed) a no-op
+    dedupe_key TEXT UNIQUE,
+    to_email TEXT NOT NULL,
+    template_id TEXT NOT NULL,
+    template_data JSONB NOT NULL DEFAULT '{}',
+    status TEXT NOT NULL DEFAULT 'queued',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    locked_until TIMESTAMPTZ,
+    last_error TEXT,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    sent_at TIMESTAMPTZ
+);
+
+-- claim_emails only looks at queued emails that are due
+CREATE INDEX IF NOT EXISTS email_outbox_due_idx ON email_outbox (next_attempt_at) WHERE status = 'queued';
@@ -0,0 +1,27 @@
+-- Scheduled charge jobs, and at most one queued or running job per type code.
+ALTER TABLE charge_jobs ADD COLUMN IF NOT EXISTS priority INTEGER NOT NULL DEFAULT 0;
+-- The schedule occurrence a job was queued for, NULL for jobs queued through the API
+ALTER TABLE charge_jobs ADD COLUMN IF NOT EXISTS scheduled_for TIMESTAMPTZ;
+-- Charges are paced to finish around this time instead of as fast as the Stripe quota allows
+ALTER TABLE charge_jobs ADD COLUMN IF NOT EXISTS window_ends_at TIMESTAMPTZ;
+
+-- Jobs resuming a run used to be queued without their type code
+UPDATE charge_jobs j SET type_code = r.type_code
+FROM charge_runs r
+WHERE j.type_code IS NULL AND j.run_id = r.id;
+
+-- Keep one open job per type code (a running one if there is one) so the unique index below can be built
+UPDATE charge_jobs j SET status = 'failed', error = 'Superseded by charge job ' || keep.id, finished_at = now()
+FROM (
+    SELECT DISTINCT ON (type_code) type_code, id
+    FROM charge_jobs
+    WHERE status IN ('queued', 'running')
+    ORDER BY type_code, status = 'running' DESC, id
+) keep
+WHERE j.type_code = keep.type_code AND j.status IN ('queued', 'running') AND j.id <> keep.id;
+
+CREATE UNIQUE INDEX IF NOT EXISTS charge_jobs_open_type_code_key ON charge_jobs (type_code) WHERE status IN ('queued', 'running');
+-- Every scheduler instance tries to queue each occurrence; only the first insert wins
+CREATE UNIQUE INDEX IF NOT EXISTS charge_jobs_scheduled_key ON charge_jobs (type_code, scheduled_for) WHERE scheduled_for IS NOT NULL;
+-- claim_charge_job takes the highest priority first
+CREATE INDEX IF NOT EXISTS charge_jobs_queued_priority_idx ON charge_jobs (priority DESC, id) WHERE status = 'queued';
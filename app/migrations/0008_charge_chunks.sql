@@ -0,0 +1,25 @@
+-- Work table of charge runs: each run's customers split into chunks that any worker process can claim.
+CREATE TABLE IF NOT EXISTS charge_chunks (
+    run_id INTEGER NOT NULL REFERENCES charge_runs (id),
+    chunk INTEGER NOT NULL,
+    customer_ids TEXT[] NOT NULL,
+    priority INTEGER NOT NULL DEFAULT 0,
+    -- Spreads a windowed run over its window: a chunk is not claimed before this
+    available_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    status TEXT NOT NULL DEFAULT 'queued',
+    worker TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    lease_until TIMESTAMPTZ,
+    last_error TEXT,
+    -- Result counts of the worker that finished the chunk
+    summary JSONB,
+    started_at TIMESTAMPTZ,
+    finished_at TIMESTAMPTZ,
+    PRIMARY KEY (run_id, chunk)
+);
+
+-- claim_charge_chunk: queued chunks and running ones whose lease may have expired, highest priority first
+CREATE INDEX IF NOT EXISTS charge_chunks_open_idx ON charge_chunks (priority DESC, available_at) WHERE status IN ('queued', 'running');
+
+-- The merged summary of a finished run (ledger aggregates plus chunks per worker)
+ALTER TABLE charge_runs ADD COLUMN IF NOT EXISTS summary JSONB;
@@ -0,0 +1,19 @@
+-- Failure classification of charge attempts and the delayed retry queue of transient failures.
+ALTER TABLE charge_attempts ADD COLUMN IF NOT EXISTS failure_type TEXT;
+ALTER TABLE charge_attempts ADD COLUMN IF NOT EXISTS failure_code TEXT;
+ALTER TABLE charge_attempts ADD COLUMN IF NOT EXISTS retry_attempts INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE charge_attempts ADD COLUMN IF NOT EXISTS next_retry_at TIMESTAMPTZ;
+
+-- fetch_charge_retries and fetch_runs_with_due_retries only look at transient failures
+CREATE INDEX IF NOT EXISTS charge_attempts_retry_idx ON charge_attempts (next_retry_at)
+    WHERE status = 'failure' AND failure_type = 'transient';
+
+-- Customers whose last failure was permanent. Runs skip them until the customer's payment info changes
+-- (stripe_customers.payment_info_updated_at moves past blocked_at).
+CREATE TABLE IF NOT EXISTS charge_blocks (
+    customer_id TEXT PRIMARY KEY,
+    reason TEXT,
+    failure_code TEXT,
+    run_id INTEGER REFERENCES charge_runs (id),
+    blocked_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
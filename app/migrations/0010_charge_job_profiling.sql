@@ -0,0 +1,3 @@
+-- Jobs queued with a valid X-Profile header are run under the sampling profiler, and so are the chunks of their run
+-- that chunk workers claim.
+ALTER TABLE charge_jobs ADD COLUMN IF NOT EXISTS profile BOOLEAN NOT NULL DEFAULT false;
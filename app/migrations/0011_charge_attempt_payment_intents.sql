@@ -0,0 +1,8 @@
+-- The PaymentIntent behind each ledger entry, so payment_intent.* webhooks update the attempt that created it and
+-- not a later retry of the same customer.
+ALTER TABLE charge_attempts ADD COLUMN IF NOT EXISTS payment_intent_id TEXT;
+-- The PaymentIntent's status when the attempt was recorded ('processing' for bank debits that settle later)
+ALTER TABLE charge_attempts ADD COLUMN IF NOT EXISTS payment_intent_status TEXT;
+
+CREATE INDEX IF NOT EXISTS charge_attempts_payment_intent_idx ON charge_attempts (payment_intent_id)
+    WHERE payment_intent_id IS NOT NULL;
@@ -0,0 +1,3 @@
+-- The signup key in the metadata of customers created by /submit-application, so the duplicate check can tell a
+-- retried signup's own customer apart from someone else's without listing customers in Stripe.
+ALTER TABLE stripe_customers ADD COLUMN IF NOT EXISTS signup_key TEXT;
@@ -0,0 +1,6 @@
+-- As of when each mirrored customer's state is: the created time of the webhook event it came from, or when the full
+-- sync requested the page it was on. Upserts only ever move it forward, so an event the inbox applies late (a retry,
+-- or a later batch) cannot overwrite a newer state, e.g. revive a deleted customer. Rows written before it existed
+-- are as of their last sync.
+ALTER TABLE stripe_customers ADD COLUMN IF NOT EXISTS stripe_updated TIMESTAMPTZ;
+UPDATE stripe_customers SET stripe_updated = synced_at WHERE stripe_updated IS NULL;
@@ -0,0 +1,134 @@
+# app/payment_profiles.py
+import logging
+from typing import Any, Dict, Iterable, Iterator
+from app import charge_errors, profiling, stripe_client
+from app.lazy import lazy_import
+
+stripe = lazy_import('stripe')
+
+logger = logging.getLogger(__name__)
+
+# Expanding the default payment method on the customer replaces a separate PaymentMethod.retrieve
+DEFAULT_PAYMENT_METHOD_EXPAND = 'invoice_settings.default_payment_method'
+
+
+def profile_from_customer(customer: Any) -> Dict[str, Any]:
+    """
+    Builds a payment profile from a Stripe customer whose default payment method has been expanded.
+
+    Parameters:
+    - customer (stripe.Customer): The customer object.
+
+    Returns:
+    - Dict[str, Any]: The profile with 'customer_id', 'deleted', 'payment_method_id', 'payment_method_type' and 'error'.
+    """
+    profile = {
+        'customer_id': customer.id,
+        'deleted': bool(getattr(customer, 'deleted', False)),
+        'payment_method_id': None,
+        'payment_method_type': None,
+        'error': ''
+    }
+    if profile['deleted']:
+        return profile
+
+    default_payment_method = customer.invoice_settings.default_payment_method
+    if isinstance(default_payment_method, str):
+        # Not expanded (e.g. a list page without the expansion), only the ID is known
+        profile['payment_method_id'] = default_payment_method
+    elif default_payment_method:
+        profile['payment_method_id'] = default_payment_method.id
+        profile['payment_method_type'] = default_payment_method.type
+    return profile
+
+
+def resolve_payment_profile(customer_id: str) -> Dict[str, Any]:
+    """
+    Resolves a customer's default payment method and its type with as few Stripe calls as possible.
+    If the customer has no default payment method, the first one on file is promoted to default.
+
+    Parameters:
+    - customer_id (str): The Stripe customer ID.
+
+    Returns:
+    - Dict[str, Any]: The payment profile. Lookup failures are reported in 'error' (with their 'failure_type' and
+      'failure_code', see charge_errors.classify) instead of being raised.
+    """
+    try:
+        with profiling.span('charge.retrieve_customer', customer_id=customer_id):
+            customer = stripe_client.call(stripe.Customer.retrieve, customer_id, expand=[DEFAULT_PAYMENT_METHOD_EXPAND])
+    except stripe.StripeError as e:
+        return {'customer_id': customer_id, **_lookup_failure(e)}
+    return complete_payment_profile(profile_from_customer(customer))
+
+
+def _lookup_failure(error: 'stripe.StripeError') -> Dict[str, str]:
+    classified = charge_errors.classify(error)
+    return {'error': classified['reason'], 'failure_type': classified['failure_type'], 'failure_code': classified['failure_code']}
+
+
+def complete_payment_profile(profile: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Fills in whatever a profile is still missing: the default payment method when none is set,
+    or the payment method type when the default payment method was not expanded.
+
+    Parameters:
+    - profile (Dict[str, Any]): A profile built by profile_from_customer.
+
+    Returns:
+    - Dict[str, Any]: The same profile, completed in place.
+    """
+    if profile.get('error') or profile['deleted'] or profile['payment_method_type']:
+        return profile
+
+    customer_id = profile['customer_id']
+    try:
+        with profiling.span('charge.resolve_payment_method', customer_id=customer_id):
+            if not profile['payment_method_id']:
+                # Retrieve and set the first available payment method
+                payment_methods = stripe_client.call(stripe.PaymentMethod.list, customer=customer_id, limit=1)
+                if not payment_methods.data:
+                    return profile
+                first_payment_method = payment_methods.data[0]
+                stripe_client.call(stripe.Customer.modify, customer_id, invoice_settings={'default_payment_method': first_payment_method.id})
+                profile['payment_method_id'] = first_payment_method.id
+                profile['payment_method_type'] = first_payment_method.type
+            else:
+                payment_method = stripe_client.call(stripe.PaymentMethod.retrieve, profile['payment_method_id'])
+                profile['payment_method_type'] = payment_method.type
+    except stripe.StripeError as e:
+        profile.update(_lookup_failure(e))
+    return profile
+
+
+def listing_pays_off(customer_count: int, account_size: int) -> bool:
+    """
+    Whether list_payment_profiles resolves customer_count customers in fewer Stripe calls than one retrieve each:
+    the listing may have to page through the whole account. False when the account size is unknown (0).
+    """
+    return account_size > 0 and -(-account_size // stripe_client.LIST_PAGE_SIZE) < customer_count
+
+
+def list_payment_profiles(customer_ids: Iterable[str]) -> Iterator[Dict[str, Any]]:
+    """
+    Resolves payment profiles by paging through every Stripe customer 100 at a time with the default payment method
+    expanded, which costs one API call per page instead of one per customer. Worth it when the customers being
+    charged make up a large share of the Stripe account (see listing_pays_off).
+    Customers that never show up in the listing (deleted or unknown) are resolved individually at the end.
+
+    Parameters:
+    - customer_ids (Iterable[str]): The customer IDs to resolve.
+
+    Returns:
+    - Iterator[Dict[str, Any]]: One payment profile per requested customer, in listing order.
+    """
+    wanted = set(customer_ids)
+    for customer in stripe_client.list_all(stripe.Customer.list, expand=[f'data.{DEFAULT_PAYMENT_METHOD_EXPAND}']):
+        if not wanted:
+            break
+        if customer.id in wanted:
+            wanted.discard(customer.id)
+            yield complete_payment_profile(profile_from_customer(customer))
+
+    for customer_id in wanted:
+        yield resolve_payment_profile(customer_id)
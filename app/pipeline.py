@@ -0,0 +1,39 @@
+# app/pipeline.py
+from concurrent.futures import Executor, FIRST_COMPLETED, wait
+from typing import Any, Callable, Iterable, Iterator
+
+
+def imap_unordered(executor: Executor, fn: Callable[[Any], Any], items: Iterable[Any], max_in_flight: int) -> Iterator[Any]:
+    """
+    Maps fn over items on an executor and yields results as they complete.
+    Items are pulled lazily, so at most max_in_flight calls are queued at any time. This lets a
+    generator (another stage, a database cursor) feed the executor without being materialized.
+
+    Parameters:
+    - executor (Executor): The executor that runs fn.
+    - fn (Callable): The function to apply to each item.
+    - items (Iterable): The items to process. Consumed lazily from the calling thread.
+    - max_in_flight (int): The maximum number of submitted but not yet yielded calls.
+
+    Returns:
+    - Iterator[Any]: The results of fn, in completion order.
+
+    Raises:
+    - Exception: Re-raises the first exception raised by fn when its result is collected.
+    """
+    iterator = iter(items)
+    in_flight = set()
+    exhausted = False
+    while True:
+        while not exhausted and len(in_flight) < max_in_flight:
+            try:
+                item = next(iterator)
+            except StopIteration:
+                exhausted = True
+                break
+            in_flight.add(executor.submit(fn, item))
+        if not in_flight:
+            return
+        done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+        for future in done:
+            yield future.result()
@@ -0,0 +1,269 @@
+# app/profiling.py
+import contextvars
+import datetime
+import functools
+import hmac
+import itertools
+import json
+import logging
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator
+
+from app.config import Config
+
+logger = logging.getLogger(__name__)
+
+# Header that opts a request (and the charge run queued by /process-charges) into profiling, see authorized()
+PROFILE_HEADER = 'X-Profile'
+# Response header naming the files of the request's profile
+PROFILE_ID_HEADER = 'X-Profile-Id'
+
+_active = contextvars.ContextVar('profiling_trace', default=None)
+_ids = itertools.count(1)
+
+
+class Trace:
+    def __init__(self, name: str, directory: str | None = None, interval: float | None = None):
+        """
+        The profile of one request or charge run, written to <directory>/<name>-<timestamp>-<pid>-<n>.*:
+        - .spans.jsonl: one timing record per span (Queries call, Stripe call, charge step) as it finishes, with its
+          'name', 'start' (seconds into the trace), 'duration', 'thread' and attributes.
+        - .folded: the stacks of the threads working for the trace, sampled every interval, in folded format
+          ('outer;...;inner count' per line, for flamegraph.pl or speedscope).
+        - .summary.json: sample count and the count, total and max seconds per span name, written by stop().
+        :param name: What is profiled, e.g. 'charge-job-12'.
+        :param directory: Where the files go. Defaults to Config.PROFILE_DIR.
+        :param interval: Seconds between stack samples. Defaults to Config.PROFILE_INTERVAL.
+        """
+        timestamp = datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
+        self.name = f"{re.sub(r'[^A-Za-z0-9_.-]+', '_', name).strip('_')}-{timestamp}-{os.getpid()}-{next(_ids)}"
+        self.directory = directory or Config.PROFILE_DIR
+        self.interval = interval or Config.PROFILE_INTERVAL
+        os.makedirs(self.directory, exist_ok=True)
+        self.path = os.path.join(self.directory, self.name)
+        self._spans = open(f"{self.path}.spans.jsonl", 'w')
+        self._lock = threading.Lock()
+        self._totals = {}  # span name -> [count, seconds, max seconds]
+        self._threads = Counter()  # thread ident -> activations of the trace on it
+        self._stacks = Counter()
+        self._samples = 0
+        self._stop = threading.Event()
+        self._sampler = None
+        self._summary = None
+        self.started = time.perf_counter()
+
+    def start(self) -> None:
+        """
+        Starts the sampler thread.
+        """
+        self._sampler = threading.Thread(target=self._sample, name=f"profiler-{self.name}", daemon=True)
+        self._sampler.start()
+
+    def stop(self) -> Dict[str, Any]:
+        """
+        Stops sampling and writes the stacks and the summary. Calling it again returns the same summary.
+
+        Returns:
+        - Dict[str, Any]: The summary: 'name', 'duration', 'samples', 'interval' and 'spans' (slowest total first).
+        """
+        if self._summary is not None:
+            return self._summary
+        self._stop.set()
+        if self._sampler is not None:
+            self._sampler.join()
+        with self._lock:
+            self._spans.close()
+            spans = sorted(self._totals.items(), key=lambda item: item[1][1], reverse=True)
+            self._summary = {
+                'name': self.name,
+                'duration': round(time.perf_counter() - self.started, 6),
+                'samples': self._samples,
+                'interval': self.interval,
+                'spans': {name: {'count': count, 'seconds': round(seconds, 6), 'max': round(longest, 6)}
+                          for name, (count, seconds, longest) in spans}
+            }
+            stacks = self._stacks.most_common()
+        with open(f"{self.path}.folded", 'w') as file:
+            for stack, count in stacks:
+                file.write(f"{stack} {count}\n")
+        with open(f"{self.path}.summary.json", 'w') as file:
+            json.dump(self._summary, file, indent=2)
+        return self._summary
+
+    def record(self, name: str, started: float, duration: float, attributes: Dict[str, Any]) -> None:
+        """
+        Appends a span that started at the perf_counter value started and lasted duration seconds.
+        """
+        line = json.dumps({
+            'name': name,
+            'start': round(started - self.started, 6),
+            'duration': round(duration, 6),
+            'thread': threading.current_thread().name,
+            **attributes
+        }, default=str)
+        with self._lock:
+            if self._spans.closed:
+                # A worker thread still finishing after the trace was stopped
+                return
+            self._spans.write(line + '\n')
+            totals = self._totals.setdefault(name, [0, 0.0, 0.0])
+            totals[0] += 1
+            totals[1] += duration
+            totals[2] = max(totals[2], duration)
+
+    def _enter(self, ident: int) -> None:
+        with self._lock:
+            self._threads[ident] += 1
+
+    def _leave(self, ident: int) -> None:
+        with self._lock:
+            self._threads[ident] -= 1
+            if self._threads[ident] <= 0:
+                del self._threads[ident]
+
+    def _sample(self) -> None:
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            frames = sys._current_frames()
+            with self._lock:
+                idents = [ident for ident in self._threads if ident != own]
+            stacks = []
+            for ident in idents:
+                frame = frames.get(ident)
+                labels = []
+                while frame is not None:
+                    labels.append(f"{frame.f_globals.get('__name__', '?')}:{frame.f_code.co_name}")
+                    frame = frame.f_back
+                if labels:
+                    stacks.append(';'.join(reversed(labels)))
+            del frames
+            with self._lock:
+                self._samples += 1
+                self._stacks.update(stacks)
+
+
+def authorized(header_value: str | None) -> bool:
+    """
+    Whether a request carries the X-Profile header with Config.PROFILE_TOKEN. Always False without a token.
+    """
+    if not Config.PROFILE_TOKEN or not header_value:
+        return False
+    return hmac.compare_digest(header_value.encode(), Config.PROFILE_TOKEN.encode())
+
+
+def request_profiled(header_value: str | None) -> bool:
+    """
+    Whether a request is profiled: all of them with Config.PROFILE_REQUESTS, otherwise the authorized ones.
+    """
+    return Config.PROFILE_REQUESTS or authorized(header_value)
+
+
+def current() -> Trace | None:
+    """
+    Returns the trace the current thread (or task) records into, if any.
+    """
+    return _active.get()
+
+
+@contextmanager
+def activate(trace: Trace | None) -> Iterator[None]:
+    """
+    Makes the current thread (or task) record its spans into trace and be sampled for it. Worker pool threads do not
+    inherit the active trace, so enter it inside the function the pool runs (see bind). A None trace is a no-op.
+    """
+    if trace is None:
+        yield
+        return
+    token = _active.set(trace)
+    ident = threading.get_ident()
+    trace._enter(ident)
+    try:
+        yield
+    finally:
+        trace._leave(ident)
+        _active.reset(token)
+
+
+def bind(fn: Callable[..., Any]) -> Callable[..., Any]:
+    """
+    Returns fn running under the trace active where bind is called, for handing it to a worker pool.
+    Returns fn itself when nothing is being profiled.
+    """
+    trace = _active.get()
+    if trace is None:
+        return fn
+
+    @functools.wraps(fn)
+    def bound(*args, **kwargs):
+        with activate(trace):
+            return fn(*args, **kwargs)
+    return bound
+
+
+@contextmanager
+def profile(name: str, enabled: bool = True) -> Iterator[Trace | None]:
+    """
+    Profiles the block: starts a Trace, activates it on the current thread (or task) and writes it out at the end.
+    Profiling never fails the work it profiles: a trace that cannot be written is logged and dropped.
+
+    Parameters:
+    - name (str): What is profiled, the prefix of the files.
+    - enabled (bool): When False, the block runs unprofiled and gets None.
+
+    Returns:
+    - Iterator[Trace | None]: The trace, or None when disabled or the directory is not writable.
+    """
+    if not enabled:
+        yield None
+        return
+    try:
+        trace = Trace(name)
+        trace.start()
+    except OSError:
+        logger.error(f"Failed to start profiling {name}.", exc_info=True)
+        yield None
+        return
+    try:
+        with activate(trace):
+            yield trace
+    finally:
+        try:
+            summary = trace.stop()
+            logger.info(f"Profile of {name} written to {trace.path}.* ({summary['samples']} samples).")
+        except OSError:
+            logger.error(f"Failed to write the profile of {name}.", exc_info=True)
+
+
+@contextmanager
+def span(name: str, **attributes) -> Iterator[None]:
+    """
+    Times the block as a span of the active trace, with the given attributes (and 'error' if it raises).
+    Costs a context variable lookup when nothing is being profiled.
+    """
+    trace = _active.get()
+    if trace is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception as e:
+        attributes['error'] = e.__class__.__name__
+        raise
+    finally:
+        trace.record(name, started, time.perf_counter() - started, attributes)
+
+
+def record_span(name: str, started: float, duration: float, **attributes) -> None:
+    """
+    Records an already timed span (started is a perf_counter value) into the active trace, if any.
+    """
+    trace = _active.get()
+    if trace is not None:
+        trace.record(name, started, duration, attributes)
@@ -1,15 +1,60 @@
+import json
 import logging
-from typing import Any, Dict, List
-from psycopg2.extras import DictCursor
-from flask import g
+import time
+import uuid
+from typing import Any, Dict, Iterator, List, Set
+from psycopg2.extras import DictCursor, Json, execute_values
+from contextlib import contextmanager
+from flask import g, has_app_context
+from app.config import Config
+from app.database import Database, get_database
+from app import metrics, profiling, sql
 
 logger = logging.getLogger(__name__)
 
-# Assuming g.db_conn is a global database connection object
+# First key of the per type code advisory locks (the second is the hashed type code)
+CHARGE_LOCK_NAMESPACE = 7261535
+
 class Queries:
-    def __init__(self):
-        pass
-    
+    def __init__(self, db: Database | None = None):
+        """
+        :param db: The database to run queries against. Defaults to the process-wide database.
+        """
+        self._db = db
+
+    @property
+    def db(self) -> Database:
+        return self._db or get_database()
+
+    @contextmanager
+    def _connection(self, query: str):
+        """
+        Yields a connection inside a transaction block (committed on success, rolled back on error).
+        Inside a Flask app context the connection is checked out lazily on first use and kept on g until the
+        context is torn down, so requests that never touch the database never take a connection.
+        Outside an app context (scripts, worker threads) a connection is borrowed from the pool for the call.
+        The block's duration, checkout included, is recorded under the query label, and as a 'db.<query>' span
+        when profiling.
+        """
+        started = time.perf_counter()
+        try:
+            if has_app_context():
+                if 'db_conn' not in g:
+                    g.db_conn = self.db.getconn()
+                with g.db_conn as conn:
+                    yield conn
+            else:
+                with self.db.get_connection() as conn:
+                    with conn:
+                        yield conn
+        except Exception:
+            metrics.DB_QUERY_ERRORS.inc(query)
+            raise
+        finally:
+            duration = time.perf_counter() - started
+            metrics.DB_QUERY_DURATION.observe(duration, query)
+            profiling.record_span(f"db.{query}", started, duration)
+
     def check_existence(self, table_name: str, fields: List[str], values: List[Any]) -> bool:
         """
         Checks if any records match the specified fields and values in the specified table of the database.
@@ -28,13 +73,12 @@ class Queries:
         if len(fields) != len(values):
             raise ValueError('Fields and values count mismatch.')
 
-        query_parts = [f"{field} = %s" for field in fields]  # Safe field placeholder
-        query = f"SELECT 1 FROM {table_name} WHERE {' OR '.join(query_parts)} LIMIT 1"
+        query = sql.compile_query('exists', table_name, tuple(fields))
         
         try:
-            with g.db_conn as conn:
+            with self._connection('check_existence') as conn:
                 with conn.cursor() as cursor:
-                    cursor.execute(query, tuple(values))
+                    sql.execute(cursor, query, values, prepare=True)
                     return bool(cursor.fetchone())
         except Exception as e:
             logger.error(f"Failed to communicate with database: {e}")
@@ -59,19 +103,112 @@ class Queries:
         if len(fields) != len(values):
             raise ValueError('Fields and values count mismatch.')
 
-        query_parts = [f"{field} = %s" for field in fields]
-        query = f"SELECT {', '.join(return_fields)} FROM {table_name} WHERE {' OR '.join(query_parts)}"
+        query = sql.compile_query('select', table_name, tuple(fields), tuple(return_fields))
         
         try:
-            with g.db_conn as conn:
+            with self._connection('fetch_records') as conn:
                 with conn.cursor(cursor_factory=DictCursor) as cursor:
-                    cursor.execute(query, tuple(values))
+                    sql.execute(cursor, query, values, prepare=True)
                     records = cursor.fetchall()
                     return [dict(record) for record in records] if records else []
         except Exception as e:
             logger.error(f"Failed to communicate with database: {e}")
             raise
 
+    def stream_records(self, table_name: str, fields: List[str], values: List[Any], return_fields: List[str],
+                       itersize: int | None = None) -> Iterator[Dict[str, Any]]:
+        """
+        Streams records from the specified table matching the specified fields and values. Unlike fetch_records,
+        rows are read through a named (server-side) cursor and fetched itersize at a time, so memory stays flat and
+        the first row is available before the whole result set has been transferred.
+
+        The cursor is declared WITH HOLD, so the connection can commit other work (e.g. ledger writes) while the
+        stream is still being consumed.
+
+        Parameters:
+        - table_name (str): The name of the table to search.
+        - fields (List[str]): The fields to query against. An empty list streams the whole table.
+        - values (List[Any]): The values corresponding to each field.
+        - return_fields (List[str]): The fields to return for matching records.
+        - itersize (int | None): Rows fetched per round trip. Defaults to Config.DB_STREAM_ITERSIZE.
+
+        Returns:
+        - Iterator[Dict[str, Any]]: A lazy iterator of dictionaries, each representing a matching record.
+
+        Raises:
+        - Exception: Propagates any exceptions caught during database operations.
+        """
+        if len(fields) != len(values):
+            raise ValueError('Fields and values count mismatch.')
+
+        query = sql.compile_query('select', table_name, tuple(fields), tuple(return_fields))
+
+        try:
+            with self._connection('stream_records') as conn:
+                cursor_name = f"stream_{table_name}_{uuid.uuid4().hex}"
+                with conn.cursor(name=cursor_name, cursor_factory=DictCursor, withhold=True) as cursor:
+                    cursor.itersize = itersize or Config.DB_STREAM_ITERSIZE
+                    cursor.execute(query, tuple(values))
+                    for record in cursor:
+                        yield dict(record)
+        except Exception as e:
+            logger.error(f"Failed to communicate with database: {e}")
+            raise
+
+    def fetch_existing_keys(self, table_name: str, key_field: str, keys: List[Any]) -> Set[Any]:
+        """
+        Returns which of the given keys exist in the specified table, with one set-based lookup.
+
+        Parameters:
+        - table_name (str): The name of the table to search.
+        - key_field (str): The column matched against the keys.
+        - keys (List[Any]): The key values to look up.
+
+        Returns:
+        - Set[Any]: The keys that have a matching record.
+
+        Raises:
+        - Exception: Propagates any exceptions caught during database operations.
+        """
+        if not keys:
+            return set()
+        query = sql.compile_select_any(table_name, key_field)
+
+        try:
+            with self._connection('fetch_existing_keys') as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute(query, (list(keys),))
+                    return {record[0] for record in cursor.fetchall()}
+        except Exception as e:
+            logger.error(f"Failed to communicate with database: {e}")
+            raise
+
+    def stream_customer_ids_created_since(self, since: Any) -> Iterator[str]:
+        """
+        Streams the IDs of customers inserted at or after the given time.
+
+        Parameters:
+        - since (datetime): The lower bound on customers.created_at.
+
+        Returns:
+        - Iterator[str]: The matching customer IDs.
+
+        Raises:
+        - Exception: Propagates any exceptions caught during database operations.
+        """
+        query = "SELECT customer_id FROM customers WHERE created_at >= %s"
+
+        try:
+            with self._connection('stream_customer_ids_created_since') as conn:
+                with conn.cursor(name=f"stream_customers_{uuid.uuid4().hex}", withhold=True) as cursor:
+                    cursor.itersize = Config.DB_STREAM_ITERSIZE
+                    cursor.execute(query, (since,))
+                    for record in cursor:
+                        yield record[0]
+        except Exception as e:
+            logger.error(f"Failed to communicate with database: {e}")
+            raise
+
     def insert_record(self, table_name: str, data: Dict[str, Any]) -> Dict[str, Any]:
         """
         Inserts a record into the specified table in the database.
@@ -88,15 +225,10 @@ class Queries:
         """
         fields = list(data.keys())
         values = list(data.values())
-        placeholders = ["%s" for _ in fields]  # Create placeholders for the values
-
-        query = f"""
-        INSERT INTO {table_name} ({', '.join(fields)})
-        VALUES ({', '.join(placeholders)})
-        """
+        query = sql.compile_query('insert', table_name, tuple(fields))
         
         try:
-            with g.db_conn as conn:
+            with self._connection('insert_record') as conn:
                 with conn.cursor() as cursor:
                     cursor.execute(query, tuple(values))
                     conn.commit()
@@ -122,11 +254,10 @@ class Queries:
         if not conditions:
             raise ValueError("No conditions provided for deletion.")
 
-        condition_parts = [f"{field} = %s" for field in conditions]
-        query = f"DELETE FROM {table_name} WHERE {' AND '.join(condition_parts)} RETURNING *;"
+        query = sql.compile_query('delete', table_name, tuple(conditions))
         
         try:
-            with g.db_conn as conn:
+            with self._connection('delete_record') as conn:
                 with conn.cursor() as cursor:
                     cursor.execute(query, tuple(conditions.values()))
                     deleted_records = cursor.rowcount  # Number of rows affected by the delete operation
@@ -135,3 +266,1389 @@ class Queries:
         except Exception as e:
             logger.error(f"Failed to delete records from database: {e}")
             raise
+
+    def insert_many(self, table_name: str, rows: List[Dict[str, Any]], batch_size: int | None = None) -> Dict[str, Any]:
+        """
+        Inserts many records, one multi-row statement and one transaction per batch.
+        Batches of at least Config.DB_COPY_THRESHOLD rows are loaded with COPY instead.
+
+        Parameters:
+        - table_name (str): The name of the table where the data will be inserted.
+        - rows (List[Dict[str, Any]]): The records to insert. Every record must have the same keys.
+        - batch_size (int | None): Rows per batch. Defaults to Config.DB_BATCH_SIZE.
+
+        Returns:
+        - Dict[str, Any]: The status, the total number of inserted rows and the row count of each batch.
+
+        Raises:
+        - Exception: Propagates any exceptions caught during database operations. Batches committed before the failure stay committed.
+        """
+        return self._write_many(table_name, rows, batch_size, conflict_fields=None, update_fields=())
+
+    def upsert_many(self, table_name: str, rows: List[Dict[str, Any]], conflict_fields: List[str],
+                    update_fields: List[str] | None = None, batch_size: int | None = None,
+                    update_where: str | None = None) -> Dict[str, Any]:
+        """
+        Inserts many records, updating the ones that conflict on conflict_fields (INSERT ... ON CONFLICT).
+        Batches of at least Config.DB_COPY_THRESHOLD rows are COPY-ed into a staging table and merged from there.
+
+        Parameters:
+        - table_name (str): The name of the table where the data will be inserted.
+        - rows (List[Dict[str, Any]]): The records to upsert. Every record must have the same keys.
+        - conflict_fields (List[str]): The columns of the unique constraint that identifies a record.
+        - update_fields (List[str] | None): The columns overwritten on conflict. Defaults to every non-conflict column;
+          an empty list skips conflicting records instead (DO NOTHING).
+        - batch_size (int | None): Rows per batch. Defaults to Config.DB_BATCH_SIZE.
+        - update_where (str | None): A condition on the stored record and EXCLUDED; conflicting records that do not
+          meet it are left as they are (e.g. to keep a newer version).
+
+        Returns:
+        - Dict[str, Any]: The status, the total number of inserted or updated rows and the row count of each batch.
+
+        Raises:
+        - Exception: Propagates any exceptions caught during database operations. Batches committed before the failure stay committed.
+        """
+        if not conflict_fields:
+            raise ValueError("No conflict fields provided for upsert.")
+        if update_fields is None and rows:
+            update_fields = [field for field in rows[0] if field not in conflict_fields]
+        return self._write_many(table_name, rows, batch_size, tuple(conflict_fields), tuple(update_fields or ()),
+                                update_where)
+
+    def delete_many(self, table_name: str, key_field: str, keys: List[Any], batch_size: int | None = None) -> Dict[str, Any]:
+        """
+        Deletes every record whose key_field is in keys, with one set-based statement and transaction per batch.
+
+        Parameters:
+        - table_name (str): The name of the table from which to delete records.
+        - key_field (str): The column matched against the keys.
+        - keys (List[Any]): The key values to delete.
+        - batch_size (int | None): Keys per batch. Defaults to Config.DB_BATCH_SIZE.
+
+        Returns:
+        - Dict[str, Any]: The status, the total number of deleted rows and the row count of each batch.
+
+        Raises:
+        - Exception: Propagates any exceptions caught during database operations. Batches committed before the failure stay committed.
+        """
+        batch_size = batch_size or Config.DB_BATCH_SIZE
+        query = sql.compile_delete_any(table_name, key_field)
+        batches = []
+
+        try:
+            for start in range(0, len(keys), batch_size):
+                with self._connection('delete_many') as conn:
+                    with conn.cursor() as cursor:
+                        cursor.execute(query, (list(keys[start:start + batch_size]),))
+                        batches.append(cursor.rowcount)
+            return {'status': 'success', 'rows_deleted': sum(batches), 'batches': batches}
+        except Exception as e:
+            logger.error(f"Failed to delete records from database: {e}")
+            raise
+
+    def _write_many(self, table_name: str, rows: List[Dict[str, Any]], batch_size: int | None,
+                    conflict_fields: tuple | None, update_fields: tuple, update_where: str | None = None) -> Dict[str, Any]:
+        if not rows:
+            return {'status': 'success', 'rows_written': 0, 'batches': []}
+        batch_size = batch_size or Config.DB_BATCH_SIZE
+        fields = tuple(rows[0].keys())
+        operation = 'insert_many' if conflict_fields is None else 'upsert_many'
+        batches = []
+
+        try:
+            for start in range(0, len(rows), batch_size):
+                batch = [tuple(row[field] for field in fields) for row in rows[start:start + batch_size]]
+                with self._connection(operation) as conn:
+                    with conn.cursor() as cursor:
+                        if len(batch) >= Config.DB_COPY_THRESHOLD:
+                            batches.append(self._copy_batch(cursor, table_name, fields, batch, conflict_fields, update_fields,
+                                                             update_where))
+                        else:
+                            query = sql.compile_insert_values(table_name, fields, conflict_fields, update_fields, update_where)
+                            execute_values(cursor, query, batch, page_size=len(batch))
+                            batches.append(cursor.rowcount)
+            return {'status': 'success', 'rows_written': sum(batches), 'batches': batches}
+        except Exception as e:
+            logger.error(f"Failed to write records to database: {e}")
+            raise
+
+    def _copy_batch(self, cursor, table_name: str, fields: tuple, batch: List[tuple],
+                    conflict_fields: tuple | None, update_fields: tuple, update_where: str | None = None) -> int:
+        # None goes in as an unquoted empty field, which COPY reads as NULL; strings are always quoted
+        buffer = sql.copy_rows(batch)
+
+        if conflict_fields is None:
+            cursor.copy_expert(sql.compile_copy(table_name, fields), buffer)
+            return cursor.rowcount
+
+        # COPY cannot resolve conflicts, so stage the batch and merge it with a single INSERT ... SELECT
+        staging_table = f"staging_{uuid.uuid4().hex}"
+        cursor.execute(f"CREATE TEMP TABLE {sql.quote_identifier(staging_table)} "
+                       f"(LIKE {sql.quote_identifier(table_name)} INCLUDING DEFAULTS) ON COMMIT DROP")
+        cursor.copy_expert(sql.compile_copy(staging_table, fields), buffer)
+        cursor.execute(sql.compile_insert_select(table_name, staging_table, fields, conflict_fields, update_fields,
+                                                 update_where))
+        return cursor.rowcount
+
+    def create_charge_run(self, type_code: str, charge_info: Dict[str, Any]) -> int:
+        """
+        Opens a new charge run in the ledger.
+
+        Parameters:
+        - type_code (str): The customer type code being charged.
+        - charge_info (Dict[str, Any]): The charge info used for the run. It is stored so a resumed run charges the same amounts.
+
+        Returns:
+        - int: The ID of the new run.
+
+        Raises:
+        - Exception: Propagates any exceptions caught during database operations.
+        """
+        query = "INSERT INTO charge_runs (type_code, charge_info) VALUES (%s, %s) RETURNING id"
+
+        try:
+            with self._connection('create_charge_run') as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute(query, (type_code, Json(charge_info)))
+                    run_id = cursor.fetchone()[0]
+                    conn.commit()
+                    return run_id
+        except Exception as e:
+            logger.error(f"Failed to create charge run: {e}")
+            raise
+
+    def fetch_charge_run(self, run_id: int) -> Dict[str, Any] | None:
+        """
+        Fetches a charge run from the ledger.
+
+        Parameters:
+        - run_id (int): The ID of the run.
+
+        Returns:
+        - Dict[str, Any] | None: The run record, or None if no run has that ID.
+
+        Raises:
+        - Exception: Propagates any exceptions caught during database operations.
+        """
+        query = "SELECT * FROM charge_runs WHERE id = %s"
+
+        try:
+            with self._connection('fetch_charge_run') as conn:
+                with conn.cursor(cursor_factory=DictCursor) as cursor:
+                    cursor.execute(query, (run_id,))
+                    record = cursor.fetchone()
+                    return dict(record) if record else None
+        except Exception as e:
+            logger.error(f"Failed to communicate with database: {e}")
+            raise
+
+    def fetch_settled_customer_ids(self, run_id: int, customer_ids: List[str] | None = None) -> Set[str]:
+        """
+        Fetches the customers that already have a final (success or failure) attempt in a run.
+
+        Parameters:
+        - run_id (int): The ID of the run.
+        - customer_ids (List[str] | None): Only look at these customers (e.g. those of one chunk). Defaults to the whole run.
+
+        Returns:
+        - Set[str]: The customer IDs that must not be charged again in this run (transient failures are retried
+          from the retry queue, see fetch_charge_retries).
+
+        Raises:
+        - Exception: Propagates any exceptions caught during database operations.
+        """
+        query = "SELECT customer_id FROM charge_attempts WHERE run_id = %s AND status IN ('success', 'failure', 'skipped')"
+        values = (run_id,)
+        if customer_ids is not None:
+            query += " AND customer_id = ANY(%s)"
+            values = (run_id, list(customer_ids))
+
+        try:
+            with self._connection('fetch_settled_customer_ids') as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute(query, values)
+                    return {record[0] for record in cursor.fetchall()}
+        except Exception as e:
+            logger.error(f"Failed to communicate with database: {e}")
+            raise
+
+    def record_charge_attempt(self, run_id: int, idempotency_key: str, result: Dict[str, Any]) -> None:
+        """
+        Writes the outcome of charging one customer to the ledger, replacing any earlier attempt in the same run
+        unless that one succeeded (e.g. recorded by the worker that took over the chunk). A transient failure is scheduled for a retry with exponential backoff (Config.CHARGE_RETRY_BACKOFF_BASE doubled
+        per earlier retry, up to Config.CHARGE_RETRY_BACKOFF_MAX); a permanent one blocks the customer in charge_blocks.
+
+        Parameters:
+        - run_id (int): The ID of the run.
+        - idempotency_key (str): The Stripe idempotency key used for the customer's PaymentIntent.
+        - result (Dict[str, Any]): The result dict returned by charge_customer.
+
+        Raises:
+        - Exception: Propagates any exceptions caught during database operations.
+        """
+        query = """
+        INSERT INTO charge_attempts (run_id, customer_id, idempotency_key, status, charge_type, amount_charged, reason,
+                                     failure_type, failure_code, next_retry_at, payment_intent_id, payment_intent_status)
+        VALUES (%(run_id)s, %(customer_id)s, %(idempotency_key)s, %(status)s, %(charge_type)s, %(amount_charged)s,
+                %(reason)s, %(failure_type)s, %(failure_code)s,
+                CASE WHEN %(failure_type)s = 'transient' THEN now() + make_interval(secs => least(%(backoff_max)s, %(backoff)s)) END,
+                %(payment_intent_id)s, %(payment_intent_status)s)
+        ON CONFLICT (run_id, customer_id) DO UPDATE SET
+            idempotency_key = EXCLUDED.idempotency_key,
+            payment_intent_id = EXCLUDED.payment_intent_id,
+            payment_intent_status = EXCLUDED.payment_intent_status,
+            status = EXCLUDED.status,
+            charge_type = EXCLUDED.charge_type,
+            amount_charged = EXCLUDED.amount_charged,
+            reason = EXCLUDED.reason,
+            failure_type = EXCLUDED.failure_type,
+            failure_code = EXCLUDED.failure_code,
+            -- Counts the retries of a transient failure; the backoff doubles with each of them
+            retry_attempts = charge_attempts.retry_attempts
+                + CASE WHEN charge_attempts.failure_type = 'transient' THEN 1 ELSE 0 END,
+            next_retry_at = CASE WHEN EXCLUDED.failure_type = 'transient' THEN now() + make_interval(secs => least(
+                %(backoff_max)s,
+                %(backoff)s * 2 ^ (charge_attempts.retry_attempts
+                    + CASE WHEN charge_attempts.failure_type = 'transient' THEN 1 ELSE 0 END)
+            )) END,
+            updated_at = now()
+        WHERE charge_attempts.status <> 'success'
+        """
+        block = """
+        INSERT INTO charge_blocks (customer_id, reason, failure_code, run_id)
+        VALUES (%(customer_id)s, %(reason)s, %(failure_code)s, %(run_id)s)
+        ON CONFLICT (customer_id) DO UPDATE SET
+            reason = EXCLUDED.reason, failure_code = EXCLUDED.failure_code, run_id = EXCLUDED.run_id, blocked_at = now()
+        """
+        values = {
+            'run_id': run_id,
+            'customer_id': result['customer_id'],
+            'idempotency_key': idempotency_key,
+            'status': result['status'],
+            'charge_type': result['charge_type'],
+            'amount_charged': result['amount_charged'],
+            'reason': result['reason'],
+            'failure_type': result.get('failure_type'),
+            'failure_code': result.get('failure_code'),
+            'payment_intent_id': result.get('payment_intent_id'),
+            'payment_intent_status': result.get('payment_intent_status'),
+            'backoff': Config.CHARGE_RETRY_BACKOFF_BASE,
+            'backoff_max': Config.CHARGE_RETRY_BACKOFF_MAX
+        }
+
+        try:
+            with self._connection('record_charge_attempt') as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute(query, values)
+                    # No row means the customer was already charged in this run: nothing to block
+                    if cursor.rowcount and result['status'] == 'failure' and result.get('failure_type') == 'permanent':
+                        cursor.execute(block, values)
+                    conn.commit()
+        except Exception as e:
+            logger.error(f"Failed to record charge attempt: {e}")
+            raise
+
+    def fetch_charge_blocks(self, customer_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+        """
+        Fetches the customers among the given ones that are blocked from charging: their last failure was permanent
+        and their payment info has not changed since (per the Stripe customer mirror).
+
+        Parameters:
+        - customer_ids (List[str]): The customer IDs to check.
+
+        Returns:
+        - Dict[str, Dict[str, Any]]: Blocked customer IDs mapped to their block's 'reason' and 'failure_code'.
+
+        Raises:
+        - Exception: Propagates any exceptions caught during database operations.
+        """
+        query = """
+        SELECT b.customer_id, b.reason, b.failure_code
+        FROM charge_blocks b
+        LEFT JOIN stripe_customers s ON s.customer_id = b.customer_id
+        WHERE b.customer_id = ANY(%s)
+          AND (s.payment_info_updated_at IS NULL OR s.payment_info_updated_at < b.blocked_at)
+        """
+
+        try:
+            with self._connection('fetch_charge_blocks') as conn:
+                with conn.cursor(cursor_factory=DictCursor) as cursor:
+                    cursor.execute(query, (list(customer_ids),))
+                    return {record['customer_id']: dict(record) for record in cursor.fetchall()}
+        except Exception as e:
+            logger.error(f"Failed to communicate with database: {e}")
+            raise
+
+    def fetch_charge_retries(self, run_id: int, max_attempts: int) -> List[Dict[str, Any]]:
+        """
+        Fetches the retry queue of a run: its transient failures that have been retried fewer than max_attempts times.
+
+        Parameters:
+        - run_id (int): The ID of the run.
+        - max_attempts (int): Retries after which a transient failure is left as it is.
+
+        Returns:
+        - List[Dict[str, Any]]: 'customer_id', 'idempotency_key', 'failure_code', 'retry_attempts' and 'due_in'
+          (seconds until the retry is due, zero or less when it is due) per queued retry.
+
+        Raises:
+        - Exception: Propagates any exceptions caught during database operations.
+        """
+        query = """
+        SELECT customer_id, idempotency_key, failure_code, retry_attempts,
+               extract(epoch FROM next_retry_at - now()) AS due_in
+        FROM charge_attempts
+        WHERE run_id = %s AND status = 'failure' AND failure_type = 'transient' AND retry_attempts < %s
+        ORDER BY next_retry_at
+        """
+
+        try:
+            with self._connection('fetch_charge_retries') as conn:
+                with conn.cursor(cursor_factory=DictCursor) as cursor:
+                    cursor.execute(query, (run_id, max_attempts))
+                    return [{**dict(record), 'due_in': float(record['due_in'])} for record in cursor.fetchall()]
+        except Exception as e:
+            logger.error(f"Failed to communicate with database: {e}")
+            raise
+
+    def fetch_runs_with_due_retries(self, max_attempts: int) -> List[Dict[str, Any]]:
+        """
+        Fetches the completed runs that have transient failures due for a retry.
+
+        Parameters:
+        - max_attempts (int): Retries after which a transient failure is left as it is.
+
+        Returns:
+        - List[Dict[str, Any]]: 'run_id' and 'type_code' per run.
+
+        Raises:
+        - Exception: Propagates any exceptions caught during database operations.
+        """
+        query = """
+        SELECT DISTINCT r.id AS run_id, r.type_code
+        FROM charge_attempts a
+        JOIN charge_runs r ON r.id = a.run_id
+        WHERE a.status = 'failure' AND a.failure_type = 'transient' AND a.retry_attempts < %s
+          AND a.next_retry_at <= now() AND r.status = 'completed'
+        """
+
+        try:
+            with self._connection('fetch_runs_with_due_retries') as conn:
+                with conn.cursor(cursor_factory=DictCursor) as cursor:
+                    cursor.execute(query, (max_attempts,))
+                    return [dict(record) for record in cursor.fetchall()]
+        except Exception as e:
+            logger.error(f"Failed to communicate with database: {e}")
+            raise
+
+    def finish_charge_run(self, run_id: int, total_customers: int, status: str = 'completed',
+                          summary: Dict[str, Any] | None = None) -> None:
+        """
+        Closes a charge run in the ledger. The charged customer count is taken from the run's successful attempts,
+        so it stays correct across resumed runs.
+
+        Parameters:
+        - run_id (int): The ID of the run.
+        - total_customers (int): The number of customers in the run's type code.
+        - status (str): The final status of the run.
+        - summary (Dict[str, Any] | None): The merged summary of the run, as written to its report.
+
+        Raises:
+        - Exception: Propagates any exceptions caught during database operations.
+        """
+        query = """
+        UPDATE charge_runs
+        SET status = %s,
+            total_customers = %s,
+            charged_customers = (SELECT count(*) FROM charge_attempts WHERE run_id = %s AND status = 'success'),
+            summary = coalesce(%s, summary),
+            finished_at = now()
+        WHERE id = %s
+        """
+
+        try:
+            with self._connection('finish_charge_run') as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute(query, (status, total_customers, run_id, Json(summary) if summary is not None else None, run_id))
+                    conn.commit()
+        except Exception as e:
+            logger.error(f"Failed to finish charge run: {e}")
+            raise
+
+    def open_charge_chunks(self, run_id: int, type_code: str, chunk_size: int, priority: int = 0,
+                           window_seconds: float = 0) -> int:
+        """
+        Opens a run for the chunk workers: marks it running, materializes its customers into charge_chunks (once per
+        run, so a resumed run keeps its original customers) and requeues chunks that failed in an earlier attempt.
+
+        Parameters:
+        - run_id (int): The ID of the run.
+        - type_code (str): The customer type code of the run.
+        - chunk_size (int): The number of customers per chunk.
+        - priority (int): Claim order of the chunks; higher goes first.
+        - window_seconds (float): When positive, the chunks become claimable one after another over this many seconds
+          instead of all at once.
+
+        Returns:
+        - int: The number of customers in the run's chunks.
+
+        Raises:
+        - Exception: Propagates any exceptions caught during database operations.
+        """
+        reopen = "UPDATE charge_runs SET status = 'running', finished_at = NULL WHERE id = %(run_id)s"
+        materialize = """
+        INSERT INTO charge_chunks (run_id, chunk, customer_ids, priority, available_at)
+        SELECT %(run_id)s, chunk, array_agg(customer_id ORDER BY customer_id), %(priority)s,
+               now() + make_interval(secs => (chunk * %(window)s / ceil(max(total)::numeric / %(size)s))::float8)
+        FROM (
+            SELECT customer_id,
+                   (row_number() OVER (ORDER BY customer_id) - 1) / %(size)s AS chunk,
+                   count(*) OVER () AS total
+            FROM customers
+            WHERE customer_type = %(type_code)s
+        ) numbered
+        WHERE NOT EXISTS (SELECT 1 FROM charge_chunks WHERE run_id = %(run_id)s)
+        GROUP BY chunk
+        """
+        requeue = """
+        UPDATE charge_chunks
+        SET status = 'queued', attempts = 0, worker = NULL, lease_until = NULL, priority = %(priority)s
+        WHERE run_id = %(run_id)s AND status = 'failed'
+        """
+        count = "SELECT coalesce(sum(cardinality(customer_ids)), 0) FROM charge_chunks WHERE run_id = %(run_id)s"
+        values = {'run_id': run_id, 'type_code': type_code, 'size': chunk_size, 'priority': priority,
+                  'window': max(window_seconds, 0)}
+
+        try:
+            with self._connection('open_charge_chunks') as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute(reopen, values)
+                    cursor.execute(materialize, values)
+                    cursor.execute(requeue, values)
+                    cursor.execute(count, values)
+                    total = cursor.fetchone()[0]
+                    conn.commit()
+                    return int(total)
+        except Exception as e:
+            logger.error(f"Failed to open charge chunks: {e}")
+            raise
+
+    def claim_charge_chunk(self, worker: str, lease_seconds: int, run_id: int | None = None) -> Dict[str, Any] | None:
+        """
+        Leases the claimable chunk with the highest priority: a queued one, or a running one whose worker stopped
+        renewing its lease (a dead worker's chunk is taken over). Only chunks of running runs are claimed. SKIP LOCKED
+        lets any number of workers, on any host, poll the table without ever claiming the same chunk twice.
+
+        Parameters:
+        - worker (str): A name identifying the claiming worker.
+        - lease_seconds (int): How long the claim holds unless renewed.
+        - run_id (int | None): Only claim chunks of this run.
+
+        Returns:
+        - Dict[str, Any] | None: The claimed chunk with its run's 'charge_info' and whether its job is profiled
+          ('profile'), or None if nothing is claimable.
+
+        Raises:
+        - Exception: Propagates any exceptions caught during database operations.
+        """
+        query = """
+        UPDATE charge_chunks c
+        SET status = 'running', worker = %s, attempts = attempts + 1,
+            lease_until = now() + make_interval(secs => %s), started_at = coalesce(started_at, now())
+        FROM charge_runs r
+        WHERE r.id = c.run_id AND (c.run_id, c.chunk) = (
+            SELECT c2.run_id, c2.chunk FROM charge_chunks c2
+            JOIN charge_runs r2 ON r2.id = c2.run_id AND r2.status = 'running'
+            WHERE (c2.status = 'queued' OR (c2.status = 'running' AND c2.lease_until < now()))
+              AND c2.available_at <= now()
+              AND (%s::integer IS NULL OR c2.run_id = %s)
+            ORDER BY c2.priority DESC, c2.available_at, c2.run_id, c2.chunk
+            FOR UPDATE OF c2 SKIP LOCKED
+            LIMIT 1
+        )
+        RETURNING c.run_id, c.chunk, c.customer_ids, c.priority, c.attempts, r.charge_info,
+                  EXISTS (SELECT 1 FROM charge_jobs j WHERE j.run_id = c.run_id AND j.status = 'running' AND j.profile) AS profile
+        """
+
+        try:
+            with self._connection('claim_charge_chunk') as conn:
+                with conn.cursor(cursor_factory=DictCursor) as cursor:
+                    cursor.execute(query, (worker, lease_seconds, run_id, run_id))
+                    record = cursor.fetchone()
+                    conn.commit()
+                    return dict(record) if record else None
+        except Exception as e:
+            logger.error(f"Failed to claim charge chunk: {e}")
+            raise
+
+    def renew_charge_chunk(self, run_id: int, chunk: int, worker: str, lease_seconds: int) -> bool:
+        """
+        Extends the lease of a chunk the worker is still working on.
+
+        Parameters:
+        - run_id (int): The ID of the run.
+        - chunk (int): The chunk number.
+        - worker (str): The worker holding the lease.
+        - lease_seconds (int): How long the renewed lease holds.
+
+        Returns:
+        - bool: False if the worker lost the chunk (its lease expired and another worker took it over).
+
+        Raises:
+        - Exception: Propagates any exceptions caught during database operations.
+        """
+        query = """
+        UPDATE charge_chunks SET lease_until = now() + make_interval(secs => %s)
+        WHERE run_id = %s AND chunk = %s AND worker = %s AND status = 'running'
+        """
+
+        try:
+            with self._connection('renew_charge_chunk') as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute(query, (lease_seconds, run_id, chunk, worker))
+                    renewed = cursor.rowcount == 1
+                    conn.commit()
+                    return renewed
+        except Exception as e:
+            logger.error(f"Failed to renew charge chunk lease: {e}")
+            raise
+
+    def finish_charge_chunk(self, run_id: int, chunk: int, worker: str, summary: Dict[str, Any] | None = None,
+                            error: str | None = None, max_attempts: int | None = None) -> None:
+        """
+        Marks a chunk as done with the worker's result counts, or releases it after an error: back to the queue, or
+        failed once it has been attempted max_attempts times. Does nothing if the worker no longer holds the chunk.
+
+        Parameters:
+        - run_id (int): The ID of the run.
+        - chunk (int): The chunk number.
+        - worker (str): The worker holding the lease.
+        - summary (Dict[str, Any] | None): The worker's result counts for the chunk.
+        - error (str | None): The failure to record. When given, the chunk is released instead of marked done.
+        - max_attempts (int | None): Attempts after which a released chunk is failed instead of requeued.
+
+        Raises:
+        - Exception: Propagates any exceptions caught during database operations.
+        """
+        if error is None:
+            query = """
+            UPDATE charge_chunks
+            SET status = 'done', summary = %s, last_error = NULL, lease_until = NULL, finished_at = now()
+            WHERE run_id = %s AND chunk = %s AND worker = %s AND status = 'running'
+            """
+            values = (Json(summary or {}), run_id, chunk, worker)
+        else:
+            query = """
+            UPDATE charge_chunks
+            SET status = CASE WHEN attempts >= %s THEN 'failed' ELSE 'queued' END, last_error = %s, lease_until = NULL
+            WHERE run_id = %s AND chunk = %s AND worker = %s AND status = 'running'
+            """
+            values = (max_attempts or 1, error, run_id, chunk, worker)
+
+        try:
+            with self._connection('finish_charge_chunk') as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute(query, values)
+                    conn.commit()
+        except Exception as e:
+            logger.error(f"Failed to finish charge chunk: {e}")
+            raise
+
+    def fetch_charge_chunk_counts(self, run_id: int) -> Dict[str, int]:
+        """
+        Counts the chunks of a run by status.
+
+        Parameters:
+        - run_id (int): The ID of the run.
+
+        Returns:
+        - Dict[str, int]: Statuses ('queued', 'running', 'done', 'failed') mapped to their chunk counts.
+
+        Raises:
+        - Exception: Propagates any exceptions caught during database operations.
+        """
+        query = "SELECT status, count(*) FROM charge_chunks WHERE run_id = %s GROUP BY status"
+
+        try:
+            with self._connection('fetch_charge_chunk_counts') as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute(query, (run_id,))
+                    return {status: count for status, count in cursor.fetchall()}
+        except Exception as e:
+            logger.error(f"Failed to communicate with database: {e}")
+            raise
+
+    def fetch_charge_chunk_workers(self, run_id: int) -> List[Dict[str, Any]]:
+        """
+        Summarizes which workers finished the chunks of a run.
+
+        Parameters:
+        - run_id (int): The ID of the run.
+
+        Returns:
+        - List[Dict[str, Any]]: 'worker', 'chunks', 'customers' and 'seconds' (summed chunk durations) per worker.
+
+        Raises:
+        - Exception: Propagates any exceptions caught during database operations.
+        """
+        query = """
+        SELECT worker, count(*) AS chunks, sum(cardinality(customer_ids)) AS customers,
+               coalesce(extract(epoch FROM sum(finished_at - started_at)), 0) AS seconds
+        FROM charge_chunks
+        WHERE run_id = %s AND status = 'done'
+        GROUP BY worker
+        ORDER BY worker
+        """
+
+        try:
+            with self._connection('fetch_charge_chunk_workers') as conn:
+                with conn.cursor(cursor_factory=DictCursor) as cursor:
+                    cursor.execute(query, (run_id,))
+                    return [
+                        {**dict(record), 'customers': int(record['customers']), 'seconds': float(record['seconds'])}
+                        for record in cursor.fetchall()
+                    ]
+        except Exception as e:
+            logger.error(f"Failed to communicate with database: {e}")
+            raise
+
+    def enqueue_charge_job(self, type_code: str | None, run_id: int | None = None, priority: int = 0,
+                           scheduled_for: Any = None, window_ends_at: Any = None, profile: bool = False) -> int | None:
+        """
+        Adds a charge job to the queue, unless the type code already has a queued or running job (or, for a scheduled
+        job, the occurrence was already queued).
+
+        Parameters:
+        - type_code (str | None): The customer type code to charge. Looked up from the run when resuming.
+        - run_id (int | None): An existing charge run to resume instead of starting a new one.
+        - priority (int): Claim order and Stripe limiter priority of the job; higher goes first.
+        - scheduled_for (Any): The schedule occurrence the job was queued for.
+        - window_ends_at (Any): When set, the run is paced to finish around this time.
+        - profile (bool): Run the job, and the chunks of its run, under the sampling profiler.
+
+        Returns:
+        - int | None: The ID of the queued job, or None if it would have duplicated an open or already scheduled job.
+
+        Raises:
+        - Exception: Propagates any exceptions caught during database operations.
+        """
+        query = """
+        INSERT INTO charge_jobs (type_code, run_id, priority, scheduled_for, window_ends_at, profile)
+        SELECT coalesce(%s, (SELECT type_code FROM charge_runs WHERE id = %s)), %s, %s, %s, %s, %s
+        ON CONFLICT DO NOTHING
+        RETURNING id
+        """
+
+        try:
+            with self._connection('enqueue_charge_job') as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute(query, (type_code, run_id, run_id, priority, scheduled_for, window_ends_at, profile))
+                    record = cursor.fetchone()
+                    conn.commit()
+                    return record[0] if record else None
+        except Exception as e:
+            logger.error(f"Failed to enqueue charge job: {e}")
+            raise
+
+    def fetch_open_charge_job(self, type_code: str | None, run_id: int | None = None) -> Dict[str, Any] | None:
+        """
+        Fetches the queued or running charge job of a type code (or of the type code of a run).
+
+        Parameters:
+        - type_code (str | None): The customer type code.
+        - run_id (int | None): A charge run whose type code is used when type_code is None.
+
+        Returns:
+        - Dict[str, Any] | None: The open job, or None if there is none.
+
+        Raises:
+        - Exception: Propagates any exceptions caught during database operations.
+        """
+        query = """
+        SELECT * FROM charge_jobs
+        WHERE type_code = coalesce(%s, (SELECT type_code FROM charge_runs WHERE id = %s))
+          AND status IN ('queued', 'running')
+        """
+
+        try:
+            with self._connection('fetch_open_charge_job') as conn:
+                with conn.cursor(cursor_factory=DictCursor) as cursor:
+                    cursor.execute(query, (type_code, run_id))
+                    record = cursor.fetchone()
+                    return dict(record) if record else None
+        except Exception as e:
+            logger.error(f"Failed to communicate with database: {e}")
+            raise
+
+    def claim_charge_job(self, worker: str) -> Dict[str, Any] | None:
+        """
+        Claims the queued charge job with the highest priority, oldest first. SKIP LOCKED lets several workers (and
+        processes) poll the same queue without ever claiming the same job twice.
+
+        Parameters:
+        - worker (str): A name identifying the claiming worker.
+
+        Returns:
+        - Dict[str, Any] | None: The claimed job, or None if the queue is empty.
+
+        Raises:
+        - Exception: Propagates any exceptions caught during database operations.
+        """
+        query = """
+        UPDATE charge_jobs
+        SET status = 'running', worker = %s, started_at = coalesce(started_at, now()), heartbeat_at = now()
+        WHERE id = (
+            SELECT id FROM charge_jobs WHERE status = 'queued'
+            ORDER BY priority DESC, id
+            FOR UPDATE SKIP LOCKED
+            LIMIT 1
+        )
+        RETURNING *
+        """
+
+        try:
+            with self._connection('claim_charge_job') as conn:
+                with conn.cursor(cursor_factory=DictCursor) as cursor:
+                    cursor.execute(query, (worker,))
+                    record = cursor.fetchone()
+                    conn.commit()
+                    return dict(record) if record else None
+        except Exception as e:
+            logger.error(f"Failed to claim charge job: {e}")
+            raise
+
+    def heartbeat_charge_job(self, job_id: int, run_id: int | None, expected_customers: int | None) -> None:
+        """
+        Marks a running job as alive and stores the charge run it is working on, so it can be resumed if its worker dies.
+
+        Parameters:
+        - job_id (int): The ID of the job.
+        - run_id (int | None): The charge run the job opened.
+        - expected_customers (int | None): The number of customers the run is expected to process.
+
+        Raises:
+        - Exception: Propagates any exceptions caught during database operations.
+        """
+        query = """
+        UPDATE charge_jobs
+        SET run_id = coalesce(%s, run_id), expected_customers = coalesce(%s, expected_customers), heartbeat_at = now()
+        WHERE id = %s
+        """
+
+        try:
+            with self._connection('heartbeat_charge_job') as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute(query, (run_id, expected_customers, job_id))
+                    conn.commit()
+        except Exception as e:
+            logger.error(f"Failed to update charge job: {e}")
+            raise
+
+    def finish_charge_job(self, job_id: int, status: str, error: str | None = None) -> None:
+        """
+        Marks a charge job as completed or failed.
+
+        Parameters:
+        - job_id (int): The ID of the job.
+        - status (str): 'completed' or 'failed'.
+        - error (str | None): The error message for failed jobs.
+
+        Raises:
+        - Exception: Propagates any exceptions caught during database operations.
+        """
+        query = "UPDATE charge_jobs SET status = %s, error = %s, finished_at = now() WHERE id = %s"
+
+        try:
+            with self._connection('finish_charge_job') as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute(query, (status, error, job_id))
+                    conn.commit()
+        except Exception as e:
+            logger.error(f"Failed to finish charge job: {e}")
+            raise
+
+    def requeue_stale_charge_jobs(self, stale_after_seconds: int) -> int:
+        """
+        Puts running jobs whose worker stopped sending heartbeats (e.g. the app was restarted) back in the queue.
+        They keep their run_id, so the next worker resumes the run instead of starting over.
+
+        Parameters:
+        - stale_after_seconds (int): How long a job may go without a heartbeat before it is considered orphaned.
+
+        Returns:
+        - int: The number of requeued jobs.
+
+        Raises:
+        - Exception: Propagates any exceptions caught during database operations.
+        """
+        query = """
+        UPDATE charge_jobs SET status = 'queued', worker = NULL
+        WHERE status = 'running' AND heartbeat_at < now() - make_interval(secs => %s)
+        """
+
+        try:
+            with self._connection('requeue_stale_charge_jobs') as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute(query, (stale_after_seconds,))
+                    requeued = cursor.rowcount
+                    conn.commit()
+                    return requeued
+        except Exception as e:
+            logger.error(f"Failed to requeue charge jobs: {e}")
+            raise
+
+    def fetch_charge_job_progress(self, job_id: int) -> Dict[str, Any] | None:
+        """
+        Fetches a charge job together with its run's progress, counted from the run ledger so it stays exact across
+        restarts and resumes.
+
+        Parameters:
+        - job_id (int): The ID of the job.
+
+        Returns:
+        - Dict[str, Any] | None: The job with 'processed', 'successes', 'failures' and 'elapsed_seconds', or None if no job has that ID.
+
+        Raises:
+        - Exception: Propagates any exceptions caught during database operations.
+        """
+        query = """
+        SELECT j.*,
+               count(a.customer_id) AS processed,
+               count(a.customer_id) FILTER (WHERE a.status = 'success') AS successes,
+               count(a.customer_id) FILTER (WHERE a.status = 'failure') AS failures,
+               extract(epoch FROM coalesce(j.finished_at, now()) - j.started_at) AS elapsed_seconds
+        FROM charge_jobs j
+        LEFT JOIN charge_attempts a ON a.run_id = j.run_id
+        WHERE j.id = %s
+        GROUP BY j.id
+        """
+
+        try:
+            with self._connection('fetch_charge_job_progress') as conn:
+                with conn.cursor(cursor_factory=DictCursor) as cursor:
+                    cursor.execute(query, (job_id,))
+                    record = cursor.fetchone()
+                    return dict(record) if record else None
+        except Exception as e:
+            logger.error(f"Failed to communicate with database: {e}")
+            raise
+
+    def fetch_charge_schedules(self) -> List[Dict[str, Any]]:
+        """
+        Fetches the charge info of every type code that has a billing schedule.
+
+        Returns:
+        - List[Dict[str, Any]]: 'type_code' and 'data' (the charge info, schedule included) per scheduled type code.
+
+        Raises:
+        - Exception: Propagates any exceptions caught during database operations.
+        """
+        query = "SELECT type_code, data FROM charge_info WHERE data ? 'schedule'"
+
+        try:
+            with self._connection('fetch_charge_schedules') as conn:
+                with conn.cursor(cursor_factory=DictCursor) as cursor:
+                    cursor.execute(query)
+                    return [dict(record) for record in cursor.fetchall()]
+        except Exception as e:
+            logger.error(f"Failed to communicate with database: {e}")
+            raise
+
+    @contextmanager
+    def charge_lock(self, type_code: str) -> Iterator[bool]:
+        """
+        Tries to take the Postgres advisory lock of a type code and holds it for the duration of the block, on a
+        connection of its own so the lock lives exactly as long as the block (or the session, if the process dies).
+        Guards against a type code being charged twice at once, e.g. by a job requeued while its worker still runs.
+
+        Parameters:
+        - type_code (str): The customer type code.
+
+        Returns:
+        - Iterator[bool]: Yields whether the lock was taken; the block should not charge when it was not.
+
+        Raises:
+        - Exception: Propagates any exceptions caught while taking the lock.
+        """
+        conn = self.db.getconn()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT pg_try_advisory_lock(%s, hashtext(%s))", (CHARGE_LOCK_NAMESPACE, type_code))
+                acquired = cursor.fetchone()[0]
+            conn.commit()
+        except Exception as e:
+            logger.error(f"Failed to take the charge lock of {type_code}: {e}")
+            self.db.putconn(conn, close=True)
+            raise
+
+        close = False
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                try:
+                    with conn.cursor() as cursor:
+                        cursor.execute("SELECT pg_advisory_unlock(%s, hashtext(%s))", (CHARGE_LOCK_NAMESPACE, type_code))
+                    conn.commit()
+                except Exception as e:
+                    # Ending the session is the other way to release a session-level lock
+                    logger.error(f"Failed to release the charge lock of {type_code}: {e}")
+                    close = True
+            self.db.putconn(conn, close=close)
+
+    def mirror_customer_lookup(self, email: str | None, phone: str | None,
+                               signup_key: str | None = None) -> Dict[str, Any] | None:
+        """
+        Looks up a live customer with the given normalized email or phone in the local Stripe customer mirror,
+        preferring the one created by the signup with signup_key.
+
+        Parameters:
+        - email (str | None): The normalized email.
+        - phone (str | None): The normalized phone number.
+        - signup_key (str | None): The idempotency key of the signup being checked.
+
+        Returns:
+        - Dict[str, Any] | None: The matching customer's 'customer_id' and 'signup_key', or None if none matches.
+
+        Raises:
+        - Exception: Propagates any exceptions caught during database operations.
+        """
+        query = """
+        SELECT customer_id, signup_key FROM stripe_customers
+        WHERE NOT deleted AND (email_normalized = %s OR phone_normalized = %s)
+        ORDER BY signup_key IS NOT DISTINCT FROM %s DESC
+        LIMIT 1
+        """
+
+        try:
+            with self._connection('mirror_customer_lookup') as conn:
+                with conn.cursor(cursor_factory=DictCursor) as cursor:
+                    sql.execute(cursor, query, (email, phone, signup_key), prepare=True)
+                    record = cursor.fetchone()
+                    return dict(record) if record else None
+        except Exception as e:
+            logger.error(f"Failed to communicate with database: {e}")
+            raise
+
+    def mark_mirror_customers_deleted(self, customer_ids: List[str] | None = None, synced_before: Any = None) -> int:
+        """
+        Flags mirrored customers as deleted, either by ID or because a full sync started at synced_before did not see them.
+
+        Parameters:
+        - customer_ids (List[str] | None): The Stripe customer IDs to flag.
+        - synced_before (datetime | None): Flag every live customer last synced before this time.
+
+        Returns:
+        - int: The number of flagged customers.
+
+        Raises:
+        - Exception: Propagates any exceptions caught during database operations.
+        """
+        if customer_ids is not None:
+            query = "UPDATE stripe_customers SET deleted = true, synced_at = now() WHERE customer_id = ANY(%s)"
+            values = (list(customer_ids),)
+        elif synced_before is not None:
+            query = "UPDATE stripe_customers SET deleted = true WHERE NOT deleted AND synced_at < %s"
+            values = (synced_before,)
+        else:
+            raise ValueError("Either customer_ids or synced_before is required.")
+
+        try:
+            with self._connection('mark_mirror_customers_deleted') as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute(query, values)
+                    return cursor.rowcount
+        except Exception as e:
+            logger.error(f"Failed to update Stripe customer mirror: {e}")
+            raise
+
+    def estimate_mirror_customers(self) -> int:
+        """
+        Estimates the number of customers in the Stripe account from the planner statistics of the mirror table,
+        without scanning it.
+
+        Returns:
+        - int: The estimate, 0 if the table has never been analyzed.
+
+        Raises:
+        - Exception: Propagates any exceptions caught during database operations.
+        """
+        query = "SELECT greatest(reltuples, 0)::bigint FROM pg_class WHERE oid = 'stripe_customers'::regclass"
+
+        try:
+            with self._connection('estimate_mirror_customers') as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute(query)
+                    record = cursor.fetchone()
+                    return record[0] if record else 0
+        except Exception as e:
+            logger.error(f"Failed to communicate with database: {e}")
+            raise
+
+    def fetch_mirror_state(self) -> Dict[str, Any]:
+        """
+        Fetches when the Stripe customer mirror was last synced.
+
+        Returns:
+        - Dict[str, Any]: State names ('full_sync', 'event') mapped to their timestamps.
+
+        Raises:
+        - Exception: Propagates any exceptions caught during database operations.
+        """
+        try:
+            with self._connection('fetch_mirror_state') as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute("SELECT name, synced_at FROM stripe_mirror_state")
+                    return dict(cursor.fetchall())
+        except Exception as e:
+            logger.error(f"Failed to communicate with database: {e}")
+            raise
+
+    def set_mirror_state(self, name: str, synced_at: Any = None) -> None:
+        """
+        Records when the Stripe customer mirror was synced.
+
+        Parameters:
+        - name (str): The state name, 'full_sync' or 'event'.
+        - synced_at (datetime | None): The sync time. Defaults to now.
+
+        Raises:
+        - Exception: Propagates any exceptions caught during database operations.
+        """
+        query = """
+        INSERT INTO stripe_mirror_state (name, synced_at) VALUES (%s, coalesce(%s, now()))
+        ON CONFLICT (name) DO UPDATE SET synced_at = EXCLUDED.synced_at
+        """
+
+        try:
+            with self._connection('set_mirror_state') as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute(query, (name, synced_at))
+        except Exception as e:
+            logger.error(f"Failed to update Stripe customer mirror state: {e}")
+            raise
+
+    def insert_webhook_event(self, event: Dict[str, Any]) -> bool:
+        """
+        Persists a verified Stripe event to the webhook inbox. Redeliveries of an event already in the inbox are ignored.
+
+        Parameters:
+        - event (Dict[str, Any]): The verified Stripe event.
+
+        Returns:
+        - bool: True if the event is new, False if it was a duplicate delivery.
+
+        Raises:
+        - Exception: Propagates any exceptions caught during database operations.
+        """
+        query = """
+        INSERT INTO webhook_events (event_id, type, payload, stripe_created)
+        VALUES (%s, %s, %s, to_timestamp(%s))
+        ON CONFLICT (event_id) DO NOTHING
+        """
+
+        try:
+            with self._connection('insert_webhook_event') as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute(query, (event['id'], event['type'], Json(event), event.get('created')))
+                    return cursor.rowcount == 1
+        except Exception as e:
+            logger.error(f"Failed to store webhook event: {e}")
+            raise
+
+    def claim_webhook_events(self, batch_size: int, lease_seconds: int, max_attempts: int) -> List[Dict[str, Any]]:
+        """
+        Leases a batch of unprocessed webhook events, oldest first. SKIP LOCKED and the lease keep concurrent drainers
+        from taking the same events; events of a drainer that dies become claimable again once the lease expires.
+
+        Parameters:
+        - batch_size (int): The maximum number of events to claim.
+        - lease_seconds (int): How long the claim holds.
+        - max_attempts (int): Events that already failed this many times are left alone.
+
+        Returns:
+        - List[Dict[str, Any]]: The claimed events with 'event_id', 'type' and 'payload'.
+
+        Raises:
+        - Exception: Propagates any exceptions caught during database operations.
+        """
+        query = """
+        UPDATE webhook_events
+        SET locked_until = now() + make_interval(secs => %s), attempts = attempts + 1
+        WHERE event_id IN (
+            SELECT event_id FROM webhook_events
+            WHERE processed_at IS NULL
+              AND attempts < %s
+              AND (locked_until IS NULL OR locked_until < now())
+            ORDER BY received_at
+            FOR UPDATE SKIP LOCKED
+            LIMIT %s
+        )
+        RETURNING event_id, type, payload, stripe_created
+        """
+
+        try:
+            with self._connection('claim_webhook_events') as conn:
+                with conn.cursor(cursor_factory=DictCursor) as cursor:
+                    cursor.execute(query, (lease_seconds, max_attempts, batch_size))
+                    records = [dict(record) for record in cursor.fetchall()]
+                    return sorted(records, key=lambda record: (record['stripe_created'] is None, record['stripe_created'] or 0))
+        except Exception as e:
+            logger.error(f"Failed to claim webhook events: {e}")
+            raise
+
+    def finish_webhook_events(self, event_ids: List[str], error: str | None = None) -> None:
+        """
+        Marks claimed webhook events as processed, or releases them with the error that made their batch fail.
+
+        Parameters:
+        - event_ids (List[str]): The IDs of the claimed events.
+        - error (str | None): The failure to record. When given, the events stay in the backlog for a retry.
+
+        Raises:
+        - Exception: Propagates any exceptions caught during database operations.
+        """
+        if error is None:
+            query = "UPDATE webhook_events SET processed_at = now(), locked_until = NULL, last_error = NULL WHERE event_id = ANY(%s)"
+            values = (list(event_ids),)
+        else:
+            query = "UPDATE webhook_events SET locked_until = NULL, last_error = %s WHERE event_id = ANY(%s)"
+            values = (error, list(event_ids))
+
+        try:
+            with self._connection('finish_webhook_events') as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute(query, values)
+        except Exception as e:
+            logger.error(f"Failed to update webhook events: {e}")
+            raise
+
+    def webhook_inbox_stats(self, max_attempts: int) -> Dict[str, Any]:
+        """
+        Summarizes the webhook inbox backlog.
+
+        Parameters:
+        - max_attempts (int): The attempt count after which an event is considered dead.
+
+        Returns:
+        - Dict[str, Any]: 'backlog' (unprocessed events), 'dead' (events that exhausted their attempts) and
+          'lag_seconds' (age of the oldest unprocessed event, 0 when the inbox is drained).
+
+        Raises:
+        - Exception: Propagates any exceptions caught during database operations.
+        """
+        query = """
+        SELECT count(*) FILTER (WHERE attempts < %s) AS backlog,
+               count(*) FILTER (WHERE attempts >= %s) AS dead,
+               coalesce(extract(epoch FROM now() - min(received_at) FILTER (WHERE attempts < %s)), 0) AS lag_seconds
+        FROM webhook_events
+        WHERE processed_at IS NULL
+        """
+
+        try:
+            with self._connection('webhook_inbox_stats') as conn:
+                with conn.cursor(cursor_factory=DictCursor) as cursor:
+                    cursor.execute(query, (max_attempts, max_attempts, max_attempts))
+                    record = dict(cursor.fetchone())
+                    record['lag_seconds'] = float(record['lag_seconds'])
+                    return record
+        except Exception as e:
+            logger.error(f"Failed to communicate with database: {e}")
+            raise
+
+    def touch_payment_info(self, customer_ids: List[str]) -> int:
+        """
+        Records that the payment info of the given Stripe customers changed just now. Customers missing from the
+        mirror get a row holding only the timestamp (the next sync fills in the rest), so the change still lifts
+        their charge block (see fetch_charge_blocks).
+
+        Parameters:
+        - customer_ids (List[str]): The Stripe customer IDs.
+
+        Returns:
+        - int: The number of inserted or updated mirror rows.
+
+        Raises:
+        - Exception: Propagates any exceptions caught during database operations.
+        """
+        query = """
+        INSERT INTO stripe_customers (customer_id, payment_info_updated_at)
+        SELECT DISTINCT unnest(%s::text[]), now()
+        ON CONFLICT (customer_id) DO UPDATE SET payment_info_updated_at = EXCLUDED.payment_info_updated_at
+        """
+
+        try:
+            with self._connection('touch_payment_info') as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute(query, (list(customer_ids),))
+                    return cursor.rowcount
+        except Exception as e:
+            logger.error(f"Failed to update Stripe customer mirror: {e}")
+            raise
+
+    def update_charge_attempt_outcomes(self, outcomes: List[Dict[str, Any]]) -> int:
+        """
+        Applies the final outcome of asynchronously settling PaymentIntents (e.g. bank debits) to the run ledger,
+        with a single set-based UPDATE. An outcome only touches the attempt that created its PaymentIntent, so a late
+        event for an earlier try of a retried customer changes nothing. A recorded success is only overturned when
+        its PaymentIntent was still processing.
+
+        Parameters:
+        - outcomes (List[Dict[str, Any]]): Dicts with 'payment_intent_id', 'payment_intent_status', 'status',
+          'reason', 'failure_type' and 'failure_code'.
+
+        Returns:
+        - int: The number of updated attempts.
+
+        Raises:
+        - Exception: Propagates any exceptions caught during database operations.
+        """
+        if not outcomes:
+            return 0
+        query = """
+        UPDATE charge_attempts AS a
+        SET status = v.status, reason = v.reason, failure_type = v.failure_type, failure_code = v.failure_code,
+            payment_intent_status = v.payment_intent_status, next_retry_at = NULL, updated_at = now()
+        FROM (VALUES %s) AS v (payment_intent_id, payment_intent_status, status, reason, failure_type, failure_code)
+        WHERE a.payment_intent_id = v.payment_intent_id
+          AND (a.status <> 'success' OR v.status = 'success' OR a.payment_intent_status = 'processing')
+        """
+        values = [(o['payment_intent_id'], o['payment_intent_status'], o['status'], o['reason'], o['failure_type'],
+                   o['failure_code']) for o in outcomes]
+
+        try:
+            with self._connection('update_charge_attempt_outcomes') as conn:
+                with conn.cursor() as cursor:
+                    execute_values(cursor, query, values, page_size=len(values))
+                    return cursor.rowcount
+        except Exception as e:
+            logger.error(f"Failed to update charge attempts: {e}")
+            raise
+
+    def enqueue_emails(self, emails: List[Dict[str, Any]]) -> int:
+        """
+        Adds emails to the outbox. Emails whose dedupe_key is already in the outbox are skipped.
+
+        Parameters:
+        - emails (List[Dict[str, Any]]): Dicts with 'to_email', 'template_id', 'template_data' and an optional 'dedupe_key'.
+
+        Returns:
+        - int: The number of emails queued.
+
+        Raises:
+        - Exception: Propagates any exceptions caught during database operations.
+        """
+        rows = [{
+            'dedupe_key': email.get('dedupe_key'),
+            'to_email': email['to_email'],
+            'template_id': email['template_id'],
+            'template_data': json.dumps(email.get('template_data') or {})
+        } for email in emails]
+        return self.upsert_many('email_outbox', rows, ['dedupe_key'], update_fields=[])['rows_written']
+
+    def enqueue_charge_failure_emails(self, run_id: int, template_id: str) -> int:
+        """
+        Queues one email per customer whose charge failed in a run, with a single INSERT ... SELECT. Transient failures
+        are left out: they are retried, and updating the payment method would not help them.
+        The dedupe key makes queuing the same run again (e.g. after a resume) a no-op for customers already queued.
+
+        Parameters:
+        - run_id (int): The ID of the run.
+        - template_id (str): The SendGrid dynamic template to send.
+
+        Returns:
+        - int: The number of emails queued.
+
+        Raises:
+        - Exception: Propagates any exceptions caught during database operations.
+        """
+        query = """
+        INSERT INTO email_outbox (dedupe_key, to_email, template_id, template_data)
+        SELECT 'charge-run-' || a.run_id || '-' || a.customer_id || '-' || %s,
+               c.email,
+               %s,
+               jsonb_build_object('name', c.name, 'reason', a.reason, 'amount', a.amount_charged)
+        FROM charge_attempts a
+        JOIN customers c ON c.customer_id = a.customer_id
+        WHERE a.run_id = %s AND a.status = 'failure' AND a.failure_type IS DISTINCT FROM 'transient'
+        ON CONFLICT (dedupe_key) DO NOTHING
+        """
+
+        try:
+            with self._connection('enqueue_charge_failure_emails') as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute(query, (template_id, template_id, run_id))
+                    return cursor.rowcount
+        except Exception as e:
+            logger.error(f"Failed to queue charge failure emails: {e}")
+            raise
+
+    def claim_emails(self, batch_size: int, lease_seconds: int) -> List[Dict[str, Any]]:
+        """
+        Leases a batch of due emails from the outbox, oldest first. SKIP LOCKED and the lease keep concurrent
+        senders from taking the same emails; emails of a sender that dies become claimable again once the lease expires.
+
+        Parameters:
+        - batch_size (int): The maximum number of emails to claim.
+        - lease_seconds (int): How long the claim holds.
+
+        Returns:
+        - List[Dict[str, Any]]: The claimed emails with 'id', 'to_email', 'template_id', 'template_data' and 'attempts'.
+
+        Raises:
+        - Exception: Propagates any exceptions caught during database operations.
+        """
+        query = """
+        UPDATE email_outbox
+        SET locked_until = now() + make_interval(secs => %s), attempts = attempts + 1
+        WHERE id IN (
+            SELECT id FROM email_outbox
+            WHERE status = 'queued'
+              AND next_attempt_at <= now()
+              AND (locked_until IS NULL OR locked_until < now())
+            ORDER BY next_attempt_at
+            FOR UPDATE SKIP LOCKED
+            LIMIT %s
+        )
+        RETURNING id, to_email, template_id, template_data, attempts
+        """
+
+        try:
+            with self._connection('claim_emails') as conn:
+                with conn.cursor(cursor_factory=DictCursor) as cursor:
+                    cursor.execute(query, (lease_seconds, batch_size))
+                    return [dict(record) for record in cursor.fetchall()]
+        except Exception as e:
+            logger.error(f"Failed to claim emails: {e}")
+            raise
+
+    def finish_emails(self, email_ids: List[int], status: str, error: str | None = None, retry_in: float = 0) -> None:
+        """
+        Settles claimed emails: 'sent', 'failed' (given up on), or 'queued' again for another attempt after retry_in seconds.
+
+        Parameters:
+        - email_ids (List[int]): The IDs of the claimed emails.
+        - status (str): 'sent', 'failed' or 'queued'.
+        - error (str | None): The failure to record.
+        - retry_in (float): Seconds until a re-queued email is due again.
+
+        Raises:
+        - Exception: Propagates any exceptions caught during database operations.
+        """
+        query = """
+        UPDATE email_outbox
+        SET status = %s,
+            last_error = %s,
+            locked_until = NULL,
+            next_attempt_at = now() + make_interval(secs => %s),
+            sent_at = CASE WHEN %s = 'sent' THEN now() END
+        WHERE id = ANY(%s)
+        """
+
+        try:
+            with self._connection('finish_emails') as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute(query, (status, error, retry_in, status, list(email_ids)))
+        except Exception as e:
+            logger.error(f"Failed to update emails: {e}")
+            raise
@@ -0,0 +1,104 @@
+# app/rate_limiter.py
+import asyncio
+import threading
+import time
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: int | None = None, min_rate: float = 1.0):
+        """
+        Initializes a thread-safe token bucket shared by every worker that calls a rate-limited API.
+        :param rate: Tokens refilled per second, i.e. the sustained request ceiling.
+        :param burst: Maximum number of tokens the bucket can hold. Defaults to one second worth of tokens.
+        :param min_rate: Lower bound the adaptive rate is never throttled below.
+        """
+        self.max_rate = float(rate)
+        self.min_rate = min(float(min_rate), self.max_rate)
+        self.rate = self.max_rate
+        self.capacity = float(burst or max(1, int(rate)))
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+        self._waiting = {}  # priority -> number of callers waiting at it
+
+    def _refill(self, now: float) -> None:
+        elapsed = now - self._updated
+        self._tokens = min(self.capacity, self._tokens + elapsed * self.rate)
+        self._updated = now
+
+    def _attempt(self, tokens: float, priority: int, register: bool) -> float:
+        # Takes the tokens and returns 0, or returns how long to sleep. Callers waiting at a higher priority go
+        # first: while one is registered, lower priorities leave the refilled tokens to it.
+        with self._lock:
+            self._refill(time.monotonic())
+            outranked = any(level > priority for level in self._waiting)
+            if not outranked and self._tokens >= tokens:
+                self._tokens -= tokens
+                return 0.0
+            if register:
+                self._waiting[priority] = self._waiting.get(priority, 0) + 1
+            return max(tokens - self._tokens, tokens if outranked else 0.0) / self.rate
+
+    def _leave(self, priority: int) -> None:
+        with self._lock:
+            self._waiting[priority] -= 1
+            if not self._waiting[priority]:
+                del self._waiting[priority]
+
+    def acquire(self, tokens: float = 1.0, priority: int = 0) -> float:
+        """
+        Blocks until the requested number of tokens is available and consumes them.
+        While callers with a higher priority are waiting, lower priorities keep waiting.
+        Returns the number of seconds spent waiting.
+        """
+        waited = 0.0
+        registered = False
+        try:
+            while True:
+                delay = self._attempt(tokens, priority, not registered)
+                if not delay:
+                    return waited
+                registered = True
+                time.sleep(delay)
+                waited += delay
+        finally:
+            if registered:
+                self._leave(priority)
+
+    async def acquire_async(self, tokens: float = 1.0, priority: int = 0) -> float:
+        """
+        acquire for coroutines: waits on the event loop instead of blocking the thread, drawing from the same bucket
+        as the threads calling acquire.
+        """
+        waited = 0.0
+        registered = False
+        try:
+            while True:
+                delay = self._attempt(tokens, priority, not registered)
+                if not delay:
+                    return waited
+                registered = True
+                await asyncio.sleep(delay)
+                waited += delay
+        finally:
+            if registered:
+                self._leave(priority)
+
+    def throttle(self, factor: float = 0.5) -> None:
+        """
+        Multiplicatively lowers the refill rate and drains the bucket.
+        Called when the upstream API answers with a rate-limit error.
+        """
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate * factor)
+            self._tokens = 0.0
+            self._updated = time.monotonic()
+
+    def recover(self) -> None:
+        """
+        Additively raises the refill rate back towards the configured ceiling after a successful call.
+        """
+        if self.rate >= self.max_rate:
+            return
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 100)
@@ -0,0 +1,103 @@
+# app/reports.py
+import csv
+import datetime
+import gzip
+import json
+import logging
+import os
+from collections import Counter
+from typing import Any, Dict
+
+from app.config import Config
+
+logger = logging.getLogger(__name__)
+
+REPORT_FIELDS = ['customer_id', 'amount_charged', 'charge_type', 'status', 'reason', 'failure_type']
+
+
+class ChargeReportWriter:
+    def __init__(self, name: str | None = None, directory: str | None = None, fmt: str | None = None, compress: bool | None = None):
+        """
+        Opens the report of a charge run, written from the run's ledger rows (charge_attempts) once the run finishes.
+        The ledger is what survives a crash: a run that dies before finishing loses no results, and resuming it writes
+        its report. Only running aggregates are kept in memory. The file only appears under its name once complete.
+        :param name: Suffix for the report files. Defaults to the current timestamp.
+        :param directory: Directory the report is written to. Defaults to Config.REPORT_DIR.
+        :param fmt: 'jsonl' or 'csv'. Defaults to Config.REPORT_FORMAT.
+        :param compress: Whether to gzip the report. Defaults to Config.REPORT_COMPRESS.
+        """
+        self.name = name or datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+        self.directory = directory or Config.REPORT_DIR
+        self.fmt = fmt or Config.REPORT_FORMAT
+        self.compress = Config.REPORT_COMPRESS if compress is None else compress
+        if self.fmt not in ('jsonl', 'csv'):
+            raise ValueError(f"Unsupported report format: {self.fmt}")
+
+        os.makedirs(self.directory, exist_ok=True)
+        extension = f".{self.fmt}.gz" if self.compress else f".{self.fmt}"
+        self.path = os.path.join(self.directory, f"charge_report_{self.name}{extension}")
+        self.summary_path = os.path.join(self.directory, f"charge_summary_{self.name}.json")
+
+        self._partial_path = self.path + '.partial'
+        if self.compress:
+            self._file = gzip.open(self._partial_path, 'wt', newline='')
+        else:
+            self._file = open(self._partial_path, 'w', newline='')
+        self._csv = None
+        if self.fmt == 'csv':
+            self._csv = csv.DictWriter(self._file, fieldnames=REPORT_FIELDS, extrasaction='ignore')
+            self._csv.writeheader()
+
+        self.total = 0
+        self.by_status = Counter()
+        self.by_reason = Counter()
+        self.by_charge_type = Counter()
+        self.amount_cents_by_status = Counter()
+
+    def write(self, result: Dict[str, Any]) -> None:
+        """
+        Appends one ledger row to the report and folds it into the aggregates.
+        """
+        if self._csv is not None:
+            self._csv.writerow(result)
+        else:
+            self._file.write(json.dumps(result, separators=(',', ':')) + '\n')
+
+        self.total += 1
+        self.by_status[result['status']] += 1
+        if result['reason']:
+            self.by_reason[result['reason']] += 1
+        if result['charge_type']:
+            self.by_charge_type[result['charge_type']] += 1
+        self.amount_cents_by_status[result['status']] += result['amount_charged'] or 0
+
+    def close(self, extra: Dict[str, Any] | None = None) -> Dict[str, Any]:
+        """
+        Closes the report, moves it under its name and writes the summary file next to it.
+        :param extra: Additional fields (e.g. run stats) merged into the summary.
+        :return: The summary that was written.
+        """
+        self._file.close()
+        os.replace(self._partial_path, self.path)
+        summary = {
+            **(extra or {}),
+            'report': self.path,
+            'results': self.total,
+            'by_status': dict(self.by_status),
+            'by_reason': dict(self.by_reason),
+            'by_charge_type': dict(self.by_charge_type),
+            'amount_cents_by_status': dict(self.amount_cents_by_status)
+        }
+        with open(self.summary_path, 'w') as file:
+            json.dump(summary, file, indent=4)
+        logger.info(f"Charge report written to {self.path}")
+        return summary
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if not self._file.closed:
+            # Left unfinished (e.g. the ledger read failed): drop it, the next attempt writes it from scratch
+            self._file.close()
+            os.remove(self._partial_path)
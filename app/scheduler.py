@@ -0,0 +1,165 @@
+# app/scheduler.py
+import datetime
+import logging
+import threading
+from typing import Any, Dict
+from zoneinfo import ZoneInfo
+
+from app.config import Config
+from app.queries import Queries
+
+queries = Queries()
+
+logger = logging.getLogger(__name__)
+
+# How far back latest_occurrence looks for a matching day
+LOOKBACK_DAYS = 62
+
+
+def parse_schedule(schedule: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Validates the 'schedule' object of a charge_info row and fills in its defaults:
+
+        {
+            "days_of_month": [1, 15],   # or "weekdays": [0, 3] (Monday is 0); days past a month's end fall on its last day
+            "at": "06:00",              # local time of day, default midnight
+            "timezone": "America/New_York",
+            "window_minutes": 240,      # spread the run over this long; 0 (default) charges as fast as the quota allows
+            "priority": 10              # higher runs are queued and served by the Stripe limiter first; default 0
+        }
+
+    Returns:
+    - Dict[str, Any]: The schedule with 'days_of_month', 'weekdays', 'at' (datetime.time), 'timezone' (ZoneInfo),
+      'window' (timedelta) and 'priority'.
+
+    Raises:
+    - ValueError: If the schedule is malformed.
+    """
+    days_of_month = [int(day) for day in schedule.get('days_of_month', [])]
+    weekdays = [int(day) for day in schedule.get('weekdays', [])]
+    if not days_of_month and not weekdays:
+        raise ValueError('A schedule needs days_of_month or weekdays.')
+    if any(not 1 <= day <= 31 for day in days_of_month) or any(not 0 <= day <= 6 for day in weekdays):
+        raise ValueError('days_of_month must be within 1-31 and weekdays within 0-6.')
+    window_minutes = float(schedule.get('window_minutes', 0))
+    if window_minutes < 0:
+        raise ValueError('window_minutes cannot be negative.')
+    return {
+        'days_of_month': set(days_of_month),
+        'weekdays': set(weekdays),
+        'at': datetime.time.fromisoformat(schedule.get('at', '00:00')),
+        'timezone': ZoneInfo(schedule.get('timezone', 'UTC')),
+        'window': datetime.timedelta(minutes=window_minutes),
+        'priority': int(schedule.get('priority', 0))
+    }
+
+
+def _matches(schedule: Dict[str, Any], day: datetime.date) -> bool:
+    if day.weekday() in schedule['weekdays']:
+        return True
+    next_day = day + datetime.timedelta(days=1)
+    if next_day.month != day.month:
+        # The last day of the month also stands in for the days it does not have (e.g. 31 in April)
+        return any(wanted >= day.day for wanted in schedule['days_of_month'])
+    return day.day in schedule['days_of_month']
+
+
+def latest_occurrence(schedule: Dict[str, Any], now: datetime.datetime) -> datetime.datetime | None:
+    """
+    Returns the most recent occurrence of a parsed schedule at or before now (timezone aware), or None if there is
+    none within LOOKBACK_DAYS.
+    """
+    local_now = now.astimezone(schedule['timezone'])
+    for days_back in range(LOOKBACK_DAYS):
+        day = local_now.date() - datetime.timedelta(days=days_back)
+        if not _matches(schedule, day):
+            continue
+        occurrence = datetime.datetime.combine(day, schedule['at'], tzinfo=schedule['timezone'])
+        if occurrence <= local_now:
+            return occurrence.astimezone(datetime.timezone.utc)
+    return None
+
+
+class ChargeScheduler:
+    def __init__(self, poll_interval: float | None = None):
+        """
+        Queues a charge job for every billing schedule occurrence, from a background thread. Schedules are read
+        from charge_info.data['schedule'] on every round, so edits apply without a restart. Several app instances
+        can run a scheduler: an occurrence is queued at most once (unique per type code and occurrence), and a type
+        code with a queued or running job is not queued again until that job is done. Completed runs with transient
+        failures due for a retry are resumed the same way.
+        :param poll_interval: Seconds between rounds. Defaults to Config.SCHEDULER_POLL_INTERVAL.
+        """
+        self.poll_interval = Config.SCHEDULER_POLL_INTERVAL if poll_interval is None else poll_interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self) -> None:
+        """
+        Starts the scheduler thread.
+        """
+        if not Config.SCHEDULER_ENABLED:
+            return
+        self._thread = threading.Thread(target=self._work, name='charge-scheduler', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float | None = None) -> None:
+        """
+        Asks the scheduler thread to stop after its current round and waits for it.
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _work(self) -> None:
+        while not self._stop.is_set():
+            try:
+                self.schedule_once()
+                self.queue_due_retries()
+            except Exception:
+                logger.error("Failed to queue scheduled charge jobs.", exc_info=True)
+            self._stop.wait(self.poll_interval)
+
+    def schedule_once(self, now: datetime.datetime | None = None) -> int:
+        """
+        Queues the latest due occurrence of every schedule that has not been queued yet and is at most
+        Config.SCHEDULER_CATCH_UP seconds old.
+
+        Returns:
+        - int: The number of jobs queued.
+        """
+        now = now or datetime.datetime.now(datetime.timezone.utc)
+        catch_up = datetime.timedelta(seconds=Config.SCHEDULER_CATCH_UP)
+        queued = 0
+        for record in queries.fetch_charge_schedules():
+            type_code = record['type_code']
+            try:
+                schedule = parse_schedule(record['data']['schedule'])
+            except (ValueError, TypeError, KeyError) as e:
+                logger.error(f"Invalid charge schedule for {type_code}: {e}")
+                continue
+            occurrence = latest_occurrence(schedule, now)
+            if occurrence is None or now - occurrence > catch_up:
+                continue
+            window_ends_at = occurrence + schedule['window'] if schedule['window'] else None
+            job_id = queries.enqueue_charge_job(type_code, priority=schedule['priority'], scheduled_for=occurrence,
+                                                window_ends_at=window_ends_at)
+            if job_id is not None:
+                queued += 1
+                logger.info(f"Queued charge job {job_id} for {type_code}, scheduled for {occurrence.isoformat()}.")
+        return queued
+
+    def queue_due_retries(self) -> int:
+        """
+        Queues a resume of every completed run that has transient charge failures due for a retry.
+
+        Returns:
+        - int: The number of jobs queued.
+        """
+        queued = 0
+        for run in queries.fetch_runs_with_due_retries(Config.CHARGE_RETRY_MAX_ATTEMPTS):
+            job_id = queries.enqueue_charge_job(run['type_code'], run_id=run['run_id'])
+            if job_id is not None:
+                queued += 1
+                logger.info(f"Queued charge job {job_id} to retry transient failures of run {run['run_id']}.")
+        return queued
@@ -0,0 +1,187 @@
+# app/signup.py
+import hashlib
+import json
+import logging
+from typing import Any, Dict, Iterable, Tuple
+
+from app import stripe_mirror
+from app.config import Config
+from app.flow import Call, Steps, db_call, stripe_call
+from app.lazy import lazy_import
+from app.stripe_mirror import SIGNUP_KEY_METADATA, normalize_email, normalize_phone
+
+stripe = lazy_import('stripe')
+
+logger = logging.getLogger(__name__)
+
+# Optional request header with a client-chosen key per signup submission (e.g. a token generated with the form)
+SIGNUP_KEY_HEADER = 'Idempotency-Key'
+
+
+def signup_key(email: str, phone: str, name: dict, address: dict, metadata: dict, request_key: str | None = None) -> str:
+    """
+    Derives the idempotency key of a signup from its whole normalized payload and, when the client sends one, its
+    request key. Customer.create is sent with it and stores it in the customer's metadata, so a retried signup never
+    creates a second Stripe customer: within Stripe's 24h window the create call returns the first attempt's customer,
+    and the duplicate check finds it afterwards. A signup with different details gets a different key instead of an
+    idempotency error.
+    """
+    payload = json.dumps({
+        'email': normalize_email(email),
+        'phone': normalize_phone(phone),
+        'name': name,
+        'address': address,
+        'metadata': metadata,
+        'request_key': request_key
+    }, sort_keys=True, separators=(',', ':'), default=str)
+    return f"signup-{hashlib.sha256(payload.encode()).hexdigest()[:40]}"
+
+
+def signup_customer_id(customers: Iterable[Any], key: str) -> str | None:
+    """
+    Picks the customer that an earlier attempt of the same signup created (in Stripe, with the database insert
+    failing afterwards) out of the Stripe customers with the signup's email.
+    """
+    for customer in customers:
+        if (customer.get('metadata') or {}).get(SIGNUP_KEY_METADATA) == key:
+            return customer.id
+    return None
+
+
+def replayed(customer: Any) -> bool:
+    """
+    Whether Stripe answered a create call with the saved response of an earlier call under the same idempotency key.
+    """
+    response = getattr(customer, 'last_response', None)
+    return response is not None and (response.headers or {}).get('idempotent-replayed') == 'true'
+
+
+def replacement_key(key: str, deleted_customer_id: str) -> str:
+    """
+    The idempotency key for creating a signup's customer again after the one its key created was deleted; still the
+    same for every retry, so those do not create a customer each.
+    """
+    return f"{key}-{deleted_customer_id}"
+
+
+def parse_signup(data: Dict[str, Any], request_key: str | None = None) -> Tuple[Dict[str, Any] | None, str | None]:
+    """
+    Validates the body of /submit-application.
+
+    Parameters:
+    - data (Dict[str, Any]): The JSON body.
+    - request_key (str | None): The SIGNUP_KEY_HEADER of the request, if sent.
+
+    Returns:
+    - Tuple[Dict[str, Any] | None, str | None]: The signup ('email', 'phone', 'name', 'address', 'metadata' and its
+      idempotency 'key') and None, or None and the error to answer with a 400.
+    """
+    email = data.get('email')
+    phone = data.get('phone')
+    name = data.get('name', {})
+    address = data.get('address', {})
+    metadata = data.get('metadata', {})
+
+    if not email or not phone:
+        return None, 'Both email and phone number are required.'
+    if not all(key in name for key in ['first', 'last']):
+        return None, 'Name must include "first" and "last" fields.'
+    if not all(key in address for key in ['state', 'city', 'address1', 'zip']):
+        return None, 'Address must include State, City, Address1, and Zip fields.'
+    return {
+        'email': email,
+        'phone': phone,
+        'name': name,
+        'address': address,
+        'metadata': metadata,
+        'key': signup_key(email, phone, name, address, metadata, request_key)
+    }, None
+
+
+def stripe_check(form: Dict[str, Any]) -> Steps:
+    """
+    The Stripe duplicate check of a signup, answered from the local mirror; Stripe is only asked when the mirror is
+    too stale to trust a "no". Returns whether the customer exists and, if an earlier attempt of this signup created
+    it (and failed on the insert), its ID, so resuming takes no second lookup. Raises stripe.StripeError.
+    """
+    email, phone, key = form['email'], form['phone'], form['key']
+    try:
+        exists, fresh, customer_id = yield Call(stripe_mirror.lookup, stripe_mirror.lookup_async, email, phone, key)
+        if exists or fresh or not Config.STRIPE_MIRROR_FALLBACK:
+            return exists, customer_id
+    except Exception:
+        logger.error("Failed to query the Stripe customer mirror.", exc_info=True)
+
+    try:
+        # Check for existing customer by email in Stripe
+        existing_customers = (yield stripe_call('Customer.list', email=email)).data
+    except stripe.StripeError:
+        logger.error("Failed to query Stripe for existing customer.", exc_info=True)
+        raise
+    return bool(existing_customers), signup_customer_id(existing_customers, key)
+
+
+def create_customer(form: Dict[str, Any]) -> Steps:
+    """
+    Creates the signup's Stripe customer and returns its ID. The idempotency key ties the customer to the signup, so a
+    retry gets the same customer back. Raises stripe.StripeError.
+    """
+    key = form['key']
+    params = {
+        'name': f"{form['name'].get('first')}, {form['name'].get('last')}",
+        'email': form['email'],
+        'phone': form['phone'],
+        'metadata': {SIGNUP_KEY_METADATA: key}
+    }
+    customer = yield stripe_call('Customer.create', **params, idempotency_key=key)
+    if replayed(customer) and (yield stripe_call('Customer.retrieve', customer.id)).get('deleted'):
+        # The same signup within Stripe's key window after its customer was deleted: create a new one
+        logger.info(f"Signup customer {customer.id} was deleted, creating it again.")
+        customer = yield stripe_call('Customer.create', **params, idempotency_key=replacement_key(key, customer.id))
+    return customer.id
+
+
+def submit(form: Dict[str, Any], pending_stripe_check: Call) -> Steps:
+    """
+    /submit-application after validation. The caller starts stripe_check(form) before running this, so it overlaps
+    the database duplicate check, and passes the Call that waits for its outcome.
+
+    Returns:
+    - Tuple[Dict[str, Any], int]: The JSON body and status code of the response.
+    """
+    email, phone = form['email'], form['phone']
+    database_check = yield db_call('check_existence', table_name='customers', fields=['email', 'phone'],
+                                   values=[email, phone])
+    if database_check:
+        return {'error': 'Customer already exists.'}, 409
+    try:
+        exists, customer_id = yield pending_stripe_check
+        if exists:
+            # Stripe (or the mirror) knows the customer but the database does not: resume only this signup's own
+            if customer_id is None:
+                return {'error': 'Customer already exists.'}, 409
+            logger.info(f"Resuming the signup of Stripe customer {customer_id}.")
+    except stripe.StripeError:
+        return {'error': 'Failed to communicate with Stripe.'}, 500
+
+    if customer_id is None:
+        try:
+            customer_id = yield from create_customer(form)
+        except stripe.StripeError:
+            logger.error("Failed to create Stripe customer.", exc_info=True)
+            return {'error': 'Failed to create customer in Stripe.'}, 500
+
+    try:
+        yield db_call('insert_record', table_name='customers', data={
+            'customer_id': customer_id,
+            'email': email,
+            'phone': phone,
+            'name': json.dumps(form['name']),
+            'address': json.dumps(form['address']),
+            'metadata': json.dumps(form['metadata'])
+        })
+        return {'message': 'Application submitted successfully.', 'id': customer_id}, 201
+    except Exception:
+        # No compensating delete: the Stripe customer carries the signup key, so a retry picks it up again
+        logger.error(f"Failed to insert customer {customer_id}.", exc_info=True)
+        return {'error': 'An error occurred. Please try again later.'}, 409
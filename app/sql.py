@@ -0,0 +1,195 @@
+# app/sql.py
+import hashlib
+import io
+import json
+import threading
+import weakref
+from functools import lru_cache
+from typing import Any, Iterable, Sequence, Tuple
+
+from app.config import Config
+
+
+def quote_identifier(name: str) -> str:
+    """
+    Quotes a table or column name for Postgres. Dotted names are quoted per part (schema.table).
+    """
+    if name == '*':
+        return name
+    return '.'.join('"' + part.replace('"', '""') + '"' for part in name.split('.'))
+
+
+def _column_list(fields: Sequence[str]) -> str:
+    return ', '.join(quote_identifier(field) for field in fields)
+
+
+def _where(fields: Sequence[str], joiner: str) -> str:
+    if not fields:
+        return ''
+    return ' WHERE ' + f' {joiner} '.join(f"{quote_identifier(field)} = %s" for field in fields)
+
+
+@lru_cache(maxsize=1024)
+def compile_query(shape: str, table_name: str, fields: Tuple[str, ...] = (), return_fields: Tuple[str, ...] = ()) -> str:
+    """
+    Builds a statement with quoted identifiers and %s value placeholders. Results are cached per
+    (shape, table, fields, return fields), so hot statements are only composed once per process.
+
+    Parameters:
+    - shape (str): One of 'exists', 'select', 'insert' or 'delete'.
+    - table_name (str): The table the statement targets.
+    - fields (Tuple[str, ...]): Filter fields ('exists', 'select' are OR-ed, 'delete' is AND-ed) or inserted columns.
+    - return_fields (Tuple[str, ...]): The columns returned by 'select'.
+
+    Returns:
+    - str: The SQL statement.
+    """
+    table = quote_identifier(table_name)
+    if shape == 'exists':
+        return f"SELECT 1 FROM {table}{_where(fields, 'OR')} LIMIT 1"
+    if shape == 'select':
+        return f"SELECT {_column_list(return_fields)} FROM {table}{_where(fields, 'OR')}"
+    if shape == 'insert':
+        placeholders = ', '.join('%s' for _ in fields)
+        return f"INSERT INTO {table} ({_column_list(fields)}) VALUES ({placeholders})"
+    if shape == 'delete':
+        if not fields:
+            raise ValueError("No conditions provided for deletion.")
+        return f"DELETE FROM {table}{_where(fields, 'AND')}"
+    raise ValueError(f"Unknown query shape: {shape}")
+
+
+@lru_cache(maxsize=256)
+def compile_insert_values(table_name: str, fields: Tuple[str, ...], conflict_fields: Tuple[str, ...] | None = None,
+                          update_fields: Tuple[str, ...] = (), update_where: str | None = None) -> str:
+    """
+    Builds a multi-row INSERT for psycopg2.extras.execute_values (a single %s stands for the VALUES list).
+    With conflict_fields it becomes an upsert: conflicting rows update update_fields, or are skipped when there are none.
+    update_where restricts which conflicting rows are updated (a condition on the table's row and EXCLUDED).
+    """
+    query = f"INSERT INTO {quote_identifier(table_name)} ({_column_list(fields)}) VALUES %s"
+    return query + _on_conflict(conflict_fields, update_fields, update_where)
+
+
+@lru_cache(maxsize=256)
+def compile_copy(table_name: str, fields: Tuple[str, ...]) -> str:
+    """
+    Builds a COPY ... FROM STDIN statement reading CSV rows for the given columns.
+    """
+    return f"COPY {quote_identifier(table_name)} ({_column_list(fields)}) FROM STDIN WITH (FORMAT csv)"
+
+
+def copy_field(value: Any) -> str:
+    """
+    Encodes one value as a field of the CSV that compile_copy reads: None as an unquoted empty field (NULL to COPY),
+    numbers and booleans bare, dicts and lists as JSON, and everything else quoted, so an empty string stays one.
+    """
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, (int, float)):
+        return repr(value)
+    if isinstance(value, (dict, list)):
+        value = json.dumps(value)
+    return '"' + str(value).replace('"', '""') + '"'
+
+
+def copy_rows(rows: Iterable[Sequence[Any]]) -> io.StringIO:
+    """
+    Encodes rows (in the column order given to compile_copy) as a CSV buffer for cursor.copy_expert.
+    """
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write(','.join(copy_field(value) for value in row) + '\n')
+    buffer.seek(0)
+    return buffer
+
+
+@lru_cache(maxsize=256)
+def compile_insert_select(table_name: str, source_table: str, fields: Tuple[str, ...], conflict_fields: Tuple[str, ...] | None = None,
+                          update_fields: Tuple[str, ...] = (), update_where: str | None = None) -> str:
+    """
+    Builds an INSERT ... SELECT moving rows from a staging table, with the same conflict handling as compile_insert_values.
+    """
+    columns = _column_list(fields)
+    query = f"INSERT INTO {quote_identifier(table_name)} ({columns}) SELECT {columns} FROM {quote_identifier(source_table)}"
+    return query + _on_conflict(conflict_fields, update_fields, update_where)
+
+
+@lru_cache(maxsize=256)
+def compile_delete_any(table_name: str, key_field: str) -> str:
+    """
+    Builds a set-based DELETE matching a key against an array parameter.
+    """
+    return f"DELETE FROM {quote_identifier(table_name)} WHERE {quote_identifier(key_field)} = ANY(%s)"
+
+
+@lru_cache(maxsize=256)
+def compile_select_any(table_name: str, key_field: str) -> str:
+    """
+    Builds a set-based lookup returning the keys that match an array parameter.
+    """
+    key = quote_identifier(key_field)
+    return f"SELECT {key} FROM {quote_identifier(table_name)} WHERE {key} = ANY(%s)"
+
+
+def _on_conflict(conflict_fields: Tuple[str, ...] | None, update_fields: Tuple[str, ...], update_where: str | None = None) -> str:
+    if conflict_fields is None:
+        return ''
+    target = f" ON CONFLICT ({_column_list(conflict_fields)})"
+    if not update_fields:
+        return target + " DO NOTHING"
+    assignments = ', '.join(f"{quote_identifier(field)} = EXCLUDED.{quote_identifier(field)}" for field in update_fields)
+    condition = f" WHERE {update_where}" if update_where else ''
+    return target + f" DO UPDATE SET {assignments}{condition}"
+
+
+# Statements already prepared on each connection. Weak keys drop the entry when a connection is discarded.
+_prepared = weakref.WeakKeyDictionary()
+_prepared_lock = threading.Lock()
+
+
+@lru_cache(maxsize=1024)
+def to_positional(query: str) -> str:
+    """
+    Rewrites %s placeholders as the $1, $2, ... parameters Postgres itself (PREPARE, asyncpg) expects.
+    """
+    parts = query.split('%s')
+    return parts[0] + ''.join(f"${index}{part}" for index, part in enumerate(parts[1:], start=1))
+
+
+@lru_cache(maxsize=1024)
+def _prepare_statement(query: str) -> Tuple[str, str, str]:
+    # Postgres PREPARE takes $n parameters; EXECUTE takes the values positionally
+    name = 'ps_' + hashlib.md5(query.encode()).hexdigest()[:16]
+    placeholders = query.count('%s')
+    execute = f"EXECUTE {name}" + (f" ({', '.join('%s' for _ in range(placeholders))})" if placeholders else '')
+    return name, to_positional(query), execute
+
+
+def execute(cursor, query: str, values: Sequence[Any] = (), prepare: bool = False) -> None:
+    """
+    Executes a compiled statement. With prepare=True (and Config.DB_PREPARED_STATEMENTS enabled) the statement is
+    prepared once per connection on first use and then run with EXECUTE, so Postgres skips parsing and planning.
+
+    Parameters:
+    - cursor: The cursor to execute on.
+    - query (str): A statement from compile_query (or any statement using %s placeholders only).
+    - values (Sequence[Any]): The parameter values.
+    - prepare (bool): Whether this is a hot statement worth preparing.
+    """
+    if not (prepare and Config.DB_PREPARED_STATEMENTS):
+        cursor.execute(query, tuple(values))
+        return
+
+    name, prepared, execute_statement = _prepare_statement(query)
+    connection = cursor.connection
+    with _prepared_lock:
+        names = _prepared.setdefault(connection, set())
+        needs_prepare = name not in names
+    if needs_prepare:
+        cursor.execute(f"PREPARE {name} AS {prepared}")
+        with _prepared_lock:
+            names.add(name)
+    cursor.execute(execute_statement, tuple(values))
@@ -0,0 +1,246 @@
+# app/stripe_client.py
+import asyncio
+import contextvars
+import logging
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Awaitable, Callable, Dict, Iterator
+
+from app import metrics, profiling
+from app.config import Config
+from app.lazy import lazy_import
+from app.rate_limiter import TokenBucket
+
+# Imported on the first configure(), so processes that never call Stripe do not pay for loading the SDK
+httpx = lazy_import('httpx')
+requests = lazy_import('requests')
+stripe = lazy_import('stripe')
+
+logger = logging.getLogger(__name__)
+
+# One bucket per process so every worker thread shares the same Stripe quota
+limiter = TokenBucket(rate=Config.STRIPE_RATE_LIMIT, min_rate=Config.STRIPE_MIN_RATE)
+
+# Limiter priority of calls made outside priority(): request handlers and scripts go ahead of charge runs
+INTERACTIVE_PRIORITY = 100
+_priority = contextvars.ContextVar('stripe_priority', default=INTERACTIVE_PRIORITY)
+# Highest priority a charge run can ask for, so it never outranks the API requests sharing the limiter
+MAX_BACKGROUND_PRIORITY = INTERACTIVE_PRIORITY - 1
+
+# Objects per page of list_all, the most a Stripe list request returns
+LIST_PAGE_SIZE = 100
+
+# Methods that only read, so retrying them after an ambiguous failure can never create anything twice
+READ_METHOD_PREFIXES = ('retrieve', 'list', 'search')
+
+_configure_lock = threading.Lock()
+_configured = False
+
+
+def _reset_after_fork() -> None:
+    # A forked child inherits the parent's limiter and HTTP client, possibly mid-request from another thread: give
+    # it its own, so it never shares sockets with the parent or waits on a lock no thread of its own will release
+    global limiter, _configure_lock, _configured
+    limiter = TokenBucket(rate=Config.STRIPE_RATE_LIMIT, min_rate=Config.STRIPE_MIN_RATE)
+    _configure_lock = threading.Lock()
+    _configured = False
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def _session() -> 'requests.Session':
+    # One keep-alive connection pool shared by every thread, sized so concurrent workers never queue for a socket
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=Config.STRIPE_HTTP_POOL_SIZE)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def configure(api_key: str | None = None) -> None:
+    """
+    Configures the Stripe library once per process: API key, base URL, the library's own network retries and a
+    pooled keep-alive HTTP client with connect and read timeouts, backed by an httpx client with the same timeouts
+    for the *_async methods. Called on first use, calling it again is a no-op.
+
+    Parameters:
+    - api_key (str | None): Overrides Config.STRIPE_SECRET_KEY.
+    """
+    global _configured
+    with _configure_lock:
+        if _configured:
+            return
+        stripe.api_key = api_key or Config.STRIPE_SECRET_KEY
+        if Config.STRIPE_API_BASE:
+            stripe.api_base = Config.STRIPE_API_BASE
+        # The library retries connection errors, 409s and 5xx with the same idempotency key, so these are always safe
+        stripe.max_network_retries = Config.STRIPE_MAX_NETWORK_RETRIES
+        stripe.default_http_client = stripe.RequestsClient(
+            timeout=(Config.STRIPE_CONNECT_TIMEOUT, Config.STRIPE_READ_TIMEOUT),
+            session=_session(),
+            async_fallback_client=stripe.HTTPXClient(
+                timeout=httpx.Timeout(Config.STRIPE_READ_TIMEOUT, connect=Config.STRIPE_CONNECT_TIMEOUT)
+            )
+        )
+        _configured = True
+        logger.info(f"Stripe client configured for {stripe.api_base}.")
+
+
+@contextmanager
+def priority(level: int) -> Iterator[None]:
+    """
+    Makes the calls of the current thread (or task) queue for the shared limiter at the given priority. When the
+    quota is contended, waiting callers with a higher priority are served first. Worker pool threads do not inherit
+    it, so enter it inside the function the pool runs.
+
+    Parameters:
+    - level (int): The priority; charge runs use their schedule's priority, below INTERACTIVE_PRIORITY.
+    """
+    token = _priority.set(level)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def _is_transient(error: 'stripe.StripeError') -> bool:
+    if isinstance(error, stripe.APIConnectionError):
+        return True
+    return isinstance(error, stripe.APIError) and (error.http_status or 500) >= 500
+
+
+def _safe_to_retry(method: Callable[..., Any], kwargs: dict) -> bool:
+    # Writes are only replayed under the caller's idempotency key (idempotency_key=None means there is none); the
+    # library's own key changes on every call
+    return bool(kwargs.get('idempotency_key')) or getattr(method, '__name__', '').startswith(READ_METHOD_PREFIXES)
+
+
+def _backoff(attempt: int) -> float:
+    delay = min(Config.STRIPE_BACKOFF_MAX, Config.STRIPE_BACKOFF_BASE * 2 ** (attempt - 1))
+    return random.uniform(delay / 2, delay)
+
+
+def _method_name(method: Callable[..., Any]) -> str:
+    # Customer.retrieve_async reports under the same series as Customer.retrieve
+    return getattr(method, '__qualname__', repr(method)).removesuffix('_async')
+
+
+def _retry_delay(error: 'stripe.StripeError', method: Callable[..., Any], kwargs: dict, attempts: Dict[str, int],
+                 method_name: str) -> float:
+    """
+    Decides whether a failed call is retried: returns the backoff before the next attempt or re-raises the error.
+    Counts the attempt per kind of failure in attempts.
+    """
+    metrics.STRIPE_ERRORS.inc(method_name, error.__class__.__name__)
+    if isinstance(error, stripe.RateLimitError):
+        attempts['rate_limited'] += 1
+        limiter.throttle()
+        if attempts['rate_limited'] > Config.STRIPE_RATE_LIMIT_RETRIES:
+            raise error
+        delay = _backoff(attempts['rate_limited'])
+        logger.warning(f"Stripe rate limit hit, retrying in {delay:.2f}s (attempt {attempts['rate_limited']}).")
+        return delay
+    if not _is_transient(error) or not _safe_to_retry(method, kwargs):
+        raise error
+    attempts['transient'] += 1
+    if attempts['transient'] > Config.STRIPE_TRANSIENT_RETRIES:
+        raise error
+    delay = _backoff(attempts['transient'])
+    logger.warning(f"Transient Stripe error ({error.__class__.__name__}), retrying in {delay:.2f}s (attempt {attempts['transient']}).")
+    return delay
+
+
+def call(method: Callable[..., Any], *args, **kwargs) -> Any:
+    """
+    Calls a Stripe API method through the shared rate limiter (at the priority set by priority()) and HTTP client.
+    Rate-limit (429) responses slow the limiter down and are retried with jittered exponential backoff. Transient
+    errors (connection failures, timeouts, 5xx) that outlast the library's own retries are retried the same way,
+    but only for reads and for writes carrying an idempotency_key. When profiling, the wait for the limiter and
+    every attempt are recorded as spans.
+
+    Parameters:
+    - method (Callable): The Stripe API method to call, e.g. stripe.Customer.retrieve.
+    - *args, **kwargs: Passed through to the method.
+
+    Returns:
+    - Any: Whatever the Stripe method returns.
+
+    Raises:
+    - stripe.RateLimitError: If the call is still rate limited after the configured number of retries.
+    - stripe.StripeError: Transient errors after the configured number of retries, any other error unchanged.
+    """
+    configure()
+    method_name = _method_name(method)
+    attempts = {'rate_limited': 0, 'transient': 0}
+    while True:
+        waited = time.perf_counter()
+        limiter.acquire(priority=_priority.get())
+        started = time.perf_counter()
+        profiling.record_span('stripe.limiter_wait', waited, started - waited, method=method_name)
+        metrics.STRIPE_REQUESTS.inc(method_name)
+        try:
+            try:
+                result = method(*args, **kwargs)
+            finally:
+                duration = time.perf_counter() - started
+                metrics.STRIPE_REQUEST_DURATION.observe(duration, method_name)
+                profiling.record_span(f"stripe.{method_name}", started, duration)
+        except stripe.StripeError as e:
+            time.sleep(_retry_delay(e, method, kwargs, attempts, method_name))
+            continue
+        limiter.recover()
+        return result
+
+
+async def call_async(method: Callable[..., Awaitable[Any]], *args, **kwargs) -> Any:
+    """
+    call for coroutines: takes an *_async Stripe method (e.g. stripe.Customer.retrieve_async), which goes out
+    through the shared httpx client, and waits for the limiter and the backoffs on the event loop. Same limiter,
+    retries and metrics as call.
+    """
+    configure()
+    method_name = _method_name(method)
+    attempts = {'rate_limited': 0, 'transient': 0}
+    while True:
+        waited = time.perf_counter()
+        await limiter.acquire_async(priority=_priority.get())
+        started = time.perf_counter()
+        profiling.record_span('stripe.limiter_wait', waited, started - waited, method=method_name)
+        metrics.STRIPE_REQUESTS.inc(method_name)
+        try:
+            try:
+                result = await method(*args, **kwargs)
+            finally:
+                duration = time.perf_counter() - started
+                metrics.STRIPE_REQUEST_DURATION.observe(duration, method_name)
+                profiling.record_span(f"stripe.{method_name}", started, duration)
+        except stripe.StripeError as e:
+            await asyncio.sleep(_retry_delay(e, method, kwargs, attempts, method_name))
+            continue
+        limiter.recover()
+        return result
+
+
+def list_all(method: Callable[..., Any], **params) -> Iterator[Any]:
+    """
+    Pages through a Stripe list endpoint 100 objects at a time. Unlike auto_paging_iter, every page request goes
+    through call, so it shares the rate limiter and the retries.
+
+    Parameters:
+    - method (Callable): The Stripe list method, e.g. stripe.Customer.list.
+    - **params: Filters passed to every page request.
+
+    Returns:
+    - Iterator[Any]: The listed objects in the order Stripe returns them.
+    """
+    params['limit'] = LIST_PAGE_SIZE
+    while True:
+        page = call(method, **params)
+        yield from page.data
+        if not page.has_more or not page.data:
+            return
+        params['starting_after'] = page.data[-1].id
@@ -0,0 +1,171 @@
+# app/stripe_mirror.py
+import argparse
+import datetime
+import itertools
+import logging
+import re
+from typing import Any, Dict, List, Tuple
+
+from app import stripe_client
+from app.config import Config
+from app.async_queries import AsyncQueries
+from app.lazy import lazy_import
+from app.queries import Queries
+
+stripe = lazy_import('stripe')
+
+queries = Queries()
+async_queries = AsyncQueries()
+
+logger = logging.getLogger(__name__)
+
+# Metadata key of Stripe customers created by /submit-application, holding the signup's idempotency key
+SIGNUP_KEY_METADATA = 'signup_key'
+
+# Upserts only replace a mirrored customer with a newer state of it; of two states as of the same second, the
+# deleted one wins, since a deleted customer never comes back. Rows without a version only hold payment_info_updated_at.
+NEWER_STATE = ("stripe_customers.stripe_updated IS NULL OR "
+               "(stripe_customers.stripe_updated, stripe_customers.deleted) <= (EXCLUDED.stripe_updated, EXCLUDED.deleted)")
+
+
+def normalize_email(email: str | None) -> str | None:
+    return email.strip().lower() if email else None
+
+
+def normalize_phone(phone: str | None) -> str | None:
+    if not phone:
+        return None
+    digits = re.sub(r'\D', '', phone)
+    # Ten digit numbers are North American numbers written without the country code
+    if len(digits) == 10:
+        digits = '1' + digits
+    return digits or None
+
+
+def mirror_row(customer: Any, as_of: datetime.datetime) -> Dict[str, Any]:
+    """
+    Converts a Stripe customer object (or the object of a customer.* webhook event) into a mirror row.
+    as_of is when Stripe's state was read: the event's created time, or when the listing page was requested.
+    """
+    invoice_settings = customer.get('invoice_settings') or {}
+    default_payment_method = invoice_settings.get('default_payment_method')
+    if default_payment_method is not None and not isinstance(default_payment_method, str):
+        default_payment_method = default_payment_method['id']
+    created = customer.get('created')
+    return {
+        'customer_id': customer['id'],
+        'email_normalized': normalize_email(customer.get('email')),
+        'phone_normalized': normalize_phone(customer.get('phone')),
+        'deleted': bool(customer.get('deleted', False)),
+        'default_payment_method': default_payment_method,
+        'stripe_created': datetime.datetime.fromtimestamp(created, datetime.timezone.utc) if created else None,
+        'signup_key': (customer.get('metadata') or {}).get(SIGNUP_KEY_METADATA),
+        'stripe_updated': as_of,
+        'synced_at': datetime.datetime.now(datetime.timezone.utc)
+    }
+
+
+def full_sync() -> int:
+    """
+    Seeds or refreshes the mirror by paging through every Stripe customer and upserting each page. Customers a webhook
+    event updated after their page was requested keep the event's state. Mirrored customers the listing no longer
+    returns have been deleted in Stripe and are flagged as such.
+
+    Returns:
+    - int: The number of customers synced.
+    """
+    started_at = datetime.datetime.now(datetime.timezone.utc)
+    synced = 0
+    customers = stripe_client.list_all(stripe.Customer.list)
+    while True:
+        # Taking one page's worth requests exactly one page, so the clock is read just before that request
+        requested_at = datetime.datetime.now(datetime.timezone.utc)
+        page = list(itertools.islice(customers, stripe_client.LIST_PAGE_SIZE))
+        if not page:
+            break
+        queries.upsert_many('stripe_customers', [mirror_row(customer, requested_at) for customer in page], ['customer_id'],
+                            update_where=NEWER_STATE)
+        synced += len(page)
+
+    # Every customer seen above was stamped after started_at, anything older is gone from Stripe
+    deleted = queries.mark_mirror_customers_deleted(synced_before=started_at)
+    queries.set_mirror_state('full_sync', started_at)
+    logger.info(f"Synced {synced} Stripe customers, flagged {deleted} as deleted.")
+    return synced
+
+
+CUSTOMER_EVENTS = ('customer.created', 'customer.updated', 'customer.deleted')
+
+
+def apply_events(events: List[Any]) -> List[str]:
+    """
+    Applies a batch of customer.created / customer.updated / customer.deleted webhook events to the mirror with
+    one upsert. Only the latest state of each customer is written, and only over an older one (see NEWER_STATE), so
+    an event applied late, e.g. a customer.updated retried after the customer.deleted, cannot revive the customer.
+
+    Returns:
+    - List[str]: The IDs of customers deleted in Stripe.
+    """
+    rows = {}
+    for event in events:
+        if event['type'] not in CUSTOMER_EVENTS:
+            continue
+        row = mirror_row(event['data']['object'], datetime.datetime.fromtimestamp(event['created'], datetime.timezone.utc))
+        if event['type'] == 'customer.deleted':
+            row['deleted'] = True
+        current = rows.get(row['customer_id'])
+        if current is None or (current['stripe_updated'], current['deleted']) <= (row['stripe_updated'], row['deleted']):
+            rows[row['customer_id']] = row
+    if rows:
+        queries.upsert_many('stripe_customers', list(rows.values()), ['customer_id'], update_where=NEWER_STATE)
+        queries.set_mirror_state('event')
+    return [customer_id for customer_id, row in rows.items() if row['deleted']]
+
+
+def lookup(email: str | None, phone: str | None = None, signup_key: str | None = None) -> Tuple[bool, bool, str | None]:
+    """
+    Answers the signup duplicate check from the mirror with one indexed lookup.
+
+    Returns:
+    - Tuple[bool, bool, str | None]: Whether a live Stripe customer with that email or phone exists, whether the mirror
+      is fresh enough (fully synced within Config.STRIPE_MIRROR_MAX_AGE seconds) to trust a negative answer, and the
+      ID of the matching customer that carries signup_key (created by an earlier attempt of the same signup), if any.
+    """
+    customer = queries.mirror_customer_lookup(normalize_email(email), normalize_phone(phone), signup_key)
+    if customer:
+        return True, True, _signup_customer_id(customer, signup_key)
+    return False, _is_fresh(queries.fetch_mirror_state().get('full_sync')), None
+
+
+async def lookup_async(email: str | None, phone: str | None = None,
+                       signup_key: str | None = None) -> Tuple[bool, bool, str | None]:
+    """
+    lookup for the ASGI app, on the asyncpg pool.
+    """
+    customer = await async_queries.mirror_customer_lookup(normalize_email(email), normalize_phone(phone), signup_key)
+    if customer:
+        return True, True, _signup_customer_id(customer, signup_key)
+    return False, _is_fresh((await async_queries.fetch_mirror_state()).get('full_sync')), None
+
+
+def _signup_customer_id(customer: Dict[str, Any], signup_key: str | None) -> str | None:
+    return customer['customer_id'] if signup_key and customer['signup_key'] == signup_key else None
+
+
+def _is_fresh(full_sync_at: datetime.datetime | None) -> bool:
+    max_age = datetime.timedelta(seconds=Config.STRIPE_MIRROR_MAX_AGE)
+    return full_sync_at is not None and datetime.datetime.now(datetime.timezone.utc) - full_sync_at <= max_age
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Maintain the local Stripe customer mirror.')
+    parser.add_argument('command', choices=['sync'], help='sync: page through all Stripe customers and refresh the mirror.')
+    parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    stripe_client.configure()
+    full_sync()
+
+
+if __name__ == "__main__":
+    main()
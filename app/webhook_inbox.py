@@ -0,0 +1,167 @@
+# app/webhook_inbox.py
+import logging
+import threading
+from typing import Any, Dict, List
+
+from flask import Flask
+
+from app import charge_errors, stripe_mirror
+from app.config import Config
+from app.queries import Queries
+
+queries = Queries()
+
+logger = logging.getLogger(__name__)
+
+PAYMENT_METHOD_EVENTS = ('payment_method.attached', 'payment_method.detached', 'payment_method.updated',
+                         'payment_method.automatically_updated')
+PAYMENT_INTENT_OUTCOMES = {
+    'payment_intent.succeeded': 'success',
+    'payment_intent.payment_failed': 'failure',
+    'payment_intent.canceled': 'failure'
+}
+
+
+def _payment_method_customer(event: Dict[str, Any]) -> str | None:
+    # A detached payment method no longer has a customer, the previous one is in previous_attributes
+    customer = event['data']['object'].get('customer')
+    if not customer:
+        customer = (event['data'].get('previous_attributes') or {}).get('customer')
+    return customer
+
+
+def _payment_intent_outcome(event_type: str, payment_intent: Dict[str, Any]) -> Dict[str, Any]:
+    status = PAYMENT_INTENT_OUTCOMES[event_type]
+    outcome = {
+        'payment_intent_id': payment_intent['id'],
+        'payment_intent_status': payment_intent.get('status'),
+        'status': status,
+        'reason': '',
+        'failure_type': None,
+        'failure_code': None
+    }
+    if status == 'failure':
+        # The debit itself failed (or was canceled): retrying the same payment method will not help
+        error = payment_intent.get('last_payment_error') or {}
+        canceled = event_type == 'payment_intent.canceled'
+        outcome.update(charge_errors.failure(
+            charge_errors.PERMANENT,
+            error.get('decline_code') or error.get('code') or ('canceled' if canceled else 'payment_failed'),
+            error.get('message') or ('Payment canceled' if canceled else 'Payment failed')
+        ))
+    return outcome
+
+
+def apply_events(events: List[Dict[str, Any]]) -> Dict[str, int]:
+    """
+    Applies a batch of Stripe events with set-based writes: one mirror upsert for customer events, one delete for
+    deleted customers, one update for changed payment info and one ledger update for settled PaymentIntents
+    (matched on the PaymentIntent, not the customer, so a late event for an earlier try leaves a retry's result alone).
+    Event types without a handler are acknowledged and ignored.
+
+    Parameters:
+    - events (List[Dict[str, Any]]): Stripe event payloads, oldest first.
+
+    Returns:
+    - Dict[str, int]: The number of rows touched per kind of write.
+    """
+    deleted_customers = stripe_mirror.apply_events(events)
+
+    payment_info_changed = set()
+    outcomes = {}
+    for event in events:
+        event_type = event['type']
+        if event_type in PAYMENT_METHOD_EVENTS:
+            customer = _payment_method_customer(event)
+            if customer:
+                payment_info_changed.add(customer)
+        elif event_type == 'customer.updated' and 'invoice_settings' in (event['data'].get('previous_attributes') or {}):
+            # A new default payment method counts as new payment info
+            payment_info_changed.add(event['data']['object']['id'])
+        elif event_type in PAYMENT_INTENT_OUTCOMES:
+            payment_intent = event['data']['object']
+            if (payment_intent.get('metadata') or {}).get('charge_run_id'):
+                # Later events of the same PaymentIntent replace earlier ones in the batch
+                outcomes[payment_intent['id']] = _payment_intent_outcome(event_type, payment_intent)
+
+    applied = {'customers_deleted': 0, 'payment_info_changed': 0, 'charge_attempts_updated': 0}
+    if deleted_customers:
+        applied['customers_deleted'] = queries.delete_many('customers', 'customer_id', deleted_customers)['rows_deleted']
+    if payment_info_changed:
+        applied['payment_info_changed'] = queries.touch_payment_info(list(payment_info_changed))
+    if outcomes:
+        applied['charge_attempts_updated'] = queries.update_charge_attempt_outcomes(list(outcomes.values()))
+    return applied
+
+
+class WebhookInboxWorker:
+    def __init__(self, app: Flask, batch_size: int | None = None):
+        """
+        Drains the webhook inbox in a background thread, one batch of events at a time.
+        :param app: The Flask app, used to provide an app context to the worker thread.
+        :param batch_size: Events applied per batch. Defaults to Config.WEBHOOK_BATCH_SIZE.
+        """
+        self.app = app
+        self.batch_size = batch_size or Config.WEBHOOK_BATCH_SIZE
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self) -> None:
+        """
+        Starts the drain thread.
+        """
+        if not Config.WEBHOOK_INBOX_WORKER:
+            return
+        self._thread = threading.Thread(target=self._work, name='webhook-inbox', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float | None = None) -> None:
+        """
+        Asks the drain thread to stop after its current batch and waits for it.
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _work(self) -> None:
+        while not self._stop.is_set():
+            try:
+                with self.app.app_context():
+                    drained = self.drain_once()
+            except Exception:
+                logger.error("Failed to drain the webhook inbox.", exc_info=True)
+                drained = 0
+            # Keep going while there is a backlog, otherwise poll
+            if drained < self.batch_size:
+                self._stop.wait(Config.WEBHOOK_POLL_INTERVAL)
+
+    def drain_once(self) -> int:
+        """
+        Claims and applies one batch of events.
+
+        Returns:
+        - int: The number of events in the batch.
+        """
+        records = queries.claim_webhook_events(self.batch_size, Config.WEBHOOK_LEASE_SECONDS, Config.WEBHOOK_MAX_ATTEMPTS)
+        if not records:
+            return 0
+        self._apply(records)
+        return len(records)
+
+    def _apply(self, records: List[Dict[str, Any]]) -> None:
+        event_ids = [record['event_id'] for record in records]
+        try:
+            applied = apply_events([record['payload'] for record in records])
+        except Exception as e:
+            if len(records) > 1:
+                # One bad event fails the whole batch; bisect (oldest half first) so only it uses up its attempts
+                logger.warning(f"Failed to apply a batch of {len(records)} webhook events, splitting it: {e}")
+                middle = len(records) // 2
+                self._apply(records[:middle])
+                self._apply(records[middle:])
+                return
+            logger.error(f"Failed to apply webhook event {event_ids[0]}.", exc_info=True)
+            queries.finish_webhook_events(event_ids, error=str(e))
+            return
+        queries.finish_webhook_events(event_ids)
+        logger.debug(f"Applied {len(records)} webhook events: {applied}")
@@ -0,0 +1,6 @@
+# app/wsgi.py
+# WSGI entry point: gunicorn 'app.wsgi:app'. Each worker builds its app after the fork, and the Postgres pool, Stripe
+# client and SendGrid client are only created on first use, so a worker boots without touching the network.
+from app.main import create_app
+
+app = create_app()
@@ -0,0 +1,58 @@
+# bench/compare.py
+import argparse
+import json
+from typing import Any, Dict
+
+# Metrics where a smaller number is the improvement
+LOWER_IS_BETTER = ('seconds', '_ms', 'stripe_requests')
+
+
+def flatten(value: Any, prefix: str = '') -> Dict[str, float]:
+    """
+    Flattens a results document into 'charges[size=1000].seconds' style keys with numeric values.
+    """
+    flat: Dict[str, float] = {}
+    if isinstance(value, dict):
+        for key, item in value.items():
+            flat.update(flatten(item, f"{prefix}.{key}" if prefix else key))
+    elif isinstance(value, list):
+        for index, item in enumerate(value):
+            label = index
+            if isinstance(item, dict):
+                label = next((f"{key}={item[key]}" for key in ('size', 'route') if key in item), index)
+            flat.update(flatten(item, f"{prefix}[{label}]"))
+    elif isinstance(value, (int, float)) and not isinstance(value, bool):
+        flat[prefix] = float(value)
+    return flat
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare two benchmark result files.')
+    parser.add_argument('baseline')
+    parser.add_argument('candidate')
+    parser.add_argument('--threshold', type=float, default=10.0, help='Percent change flagged as a regression.')
+    args = parser.parse_args()
+
+    documents = []
+    for path in (args.baseline, args.candidate):
+        with open(path) as file:
+            documents.append(json.load(file))
+    baseline, candidate = (flatten(document['results']) for document in documents)
+    print(f"baseline {documents[0]['commit']}  candidate {documents[1]['commit']}")
+
+    regressions = 0
+    for key in sorted(baseline.keys() & candidate.keys()):
+        old, new = baseline[key], candidate[key]
+        change = (new - old) / old * 100 if old else 0.0
+        worse = change > 0 if any(marker in key for marker in LOWER_IS_BETTER) else change < 0
+        flag = ''
+        if worse and abs(change) >= args.threshold:
+            flag = '  REGRESSION'
+            regressions += 1
+        print(f"{key:70} {old:14.3f} {new:14.3f} {change:+8.1f}%{flag}")
+    if regressions:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
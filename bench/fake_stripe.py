@@ -0,0 +1,303 @@
+# bench/fake_stripe.py
+import argparse
+import itertools
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+
+def _form(pairs: Dict[str, List[str]]) -> Dict[str, Any]:
+    # Stripe form encoding nests with brackets: metadata[charge_run_id]=1, expand[0]=x
+    params: Dict[str, Any] = {}
+    for key, values in pairs.items():
+        parts = re.findall(r'[^\[\]]+', key)
+        target = params
+        for part in parts[:-1]:
+            target = target.setdefault(part, {})
+        target[parts[-1]] = values[0]
+    return params
+
+
+def _expands(params: Dict[str, Any]) -> List[str]:
+    expand = params.get('expand') or {}
+    return list(expand.values()) if isinstance(expand, dict) else [expand]
+
+
+class FakeStripe:
+    def __init__(self, latency_ms: float = 0.0, jitter_ms: float = 0.0, error_rate: float = 0.0,
+                 rate_limit_rate: float = 0.0, seed: int = 0):
+        """
+        In-memory stand-in for the parts of the Stripe API this service uses, with injectable latency and faults.
+        :param latency_ms: Added to every response.
+        :param jitter_ms: Uniform random extra latency on top of latency_ms.
+        :param error_rate: Share of requests answered with a 500 api_error.
+        :param rate_limit_rate: Share of requests answered with a 429 rate_limit error.
+        :param seed: Seed of the fault injection, so runs are comparable.
+        """
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self.customers: Dict[str, Dict[str, Any]] = {}
+        self.customer_order: List[str] = []
+        self.customer_index: Dict[str, int] = {}
+        self.customers_by_email: Dict[str, List[str]] = {}
+        self.payment_methods: Dict[str, Dict[str, Any]] = {}
+        self.subscriptions: Dict[str, Dict[str, Any]] = {}
+        self.schedules: Dict[str, Dict[str, Any]] = {}
+        # customer_id -> ids, so per-customer listings stay O(1) with 100k customers
+        self.by_customer: Dict[Tuple[str, str], List[str]] = {}
+        self.payment_intents = 0
+        self.idempotent_responses: Dict[str, Tuple[int, Dict[str, Any]]] = {}
+        self.requests: Dict[str, int] = {}
+
+    def _new_id(self, prefix: str) -> str:
+        return f"{prefix}_fake{next(self._ids):08d}"
+
+    def add_customer(self, customer_id: str | None = None, email: str | None = None, phone: str | None = None,
+                     payment_method: bool = True, subscriptions: int = 0) -> Dict[str, Any]:
+        with self._lock:
+            customer_id = customer_id or self._new_id('cus')
+            customer = {
+                'id': customer_id, 'object': 'customer', 'email': email, 'phone': phone, 'name': None,
+                'created': int(time.time()), 'deleted': False, 'invoice_settings': {'default_payment_method': None}
+            }
+            if payment_method:
+                pm_id = f"pm_{customer_id}"
+                self.payment_methods[pm_id] = {
+                    'id': pm_id, 'object': 'payment_method', 'type': 'card', 'customer': customer_id,
+                    'card': {'brand': 'visa', 'last4': '4242', 'exp_month': 12, 'exp_year': 2099}
+                }
+                customer['invoice_settings']['default_payment_method'] = pm_id
+                self.by_customer.setdefault(('payment_method', customer_id), []).append(pm_id)
+            for number in range(subscriptions):
+                sub_id = f"sub_{customer_id}_{number}"
+                self.subscriptions[sub_id] = {'id': sub_id, 'object': 'subscription', 'customer': customer_id, 'status': 'active'}
+                self.by_customer.setdefault(('subscription', customer_id), []).append(sub_id)
+            self.customers[customer_id] = customer
+            self.customer_index[customer_id] = len(self.customer_order)
+            self.customer_order.append(customer_id)
+            if email:
+                self.customers_by_email.setdefault(email, []).append(customer_id)
+            return customer
+
+    def seed(self, customer_ids: List[str], subscriptions: int = 0) -> None:
+        for customer_id in customer_ids:
+            self.add_customer(customer_id, email=f"{customer_id}@bench.invalid", subscriptions=subscriptions)
+
+    def latency(self) -> float:
+        """
+        Returns the injected latency of one request, in seconds.
+        """
+        if not self.jitter_ms:
+            return self.latency_ms / 1000
+        with self._lock:
+            return (self.latency_ms + self._random.uniform(0, self.jitter_ms)) / 1000
+
+    # --- request handling -------------------------------------------------------------------------------------
+
+    def _customer_view(self, customer: Dict[str, Any], expand: List[str]) -> Dict[str, Any]:
+        view = dict(customer, invoice_settings=dict(customer['invoice_settings']))
+        pm_id = view['invoice_settings']['default_payment_method']
+        if pm_id and any(e.endswith('invoice_settings.default_payment_method') for e in expand):
+            view['invoice_settings']['default_payment_method'] = self.payment_methods.get(pm_id)
+        if view['deleted']:
+            return {'id': view['id'], 'object': 'customer', 'deleted': True}
+        del view['deleted']
+        return view
+
+    def _page(self, items: List[Dict[str, Any]], params: Dict[str, Any], url: str) -> Dict[str, Any]:
+        limit = int(params.get('limit', 10))
+        return {'object': 'list', 'url': url, 'data': items[:limit], 'has_more': len(items) > limit}
+
+    def handle(self, method: str, path: str, params: Dict[str, Any], idempotency_key: str | None) -> Tuple[int, Dict[str, Any]]:
+        route = re.sub(r'/(cus|pm|sub|sub_sched|pi|cs)_[\w]+', r'/{id}', path)
+        with self._lock:
+            self.requests[f"{method} {route}"] = self.requests.get(f"{method} {route}", 0) + 1
+            roll = self._random.random()
+            if method == 'POST' and idempotency_key in self.idempotent_responses:
+                return self.idempotent_responses[idempotency_key]
+        if roll < self.rate_limit_rate:
+            return 429, {'error': {'type': 'invalid_request_error', 'code': 'rate_limit', 'message': 'Too many requests.'}}
+        if roll < self.rate_limit_rate + self.error_rate:
+            return 500, {'error': {'type': 'api_error', 'message': 'Injected failure.'}}
+        status, body = self._dispatch(method, path, params)
+        if method == 'POST' and idempotency_key:
+            with self._lock:
+                self.idempotent_responses[idempotency_key] = (status, body)
+        return status, body
+
+    def _not_found(self, what: str) -> Tuple[int, Dict[str, Any]]:
+        return 404, {'error': {'type': 'invalid_request_error', 'code': 'resource_missing', 'message': f"No such {what}"}}
+
+    def _dispatch(self, method: str, path: str, params: Dict[str, Any]) -> Tuple[int, Dict[str, Any]]:
+        parts = path.strip('/').split('/')[1:]  # drop the v1 prefix
+        resource, rest = parts[0], parts[1:]
+        if resource == 'customers':
+            return self._customers(method, rest, params)
+        if resource == 'payment_methods':
+            if rest:
+                payment_method = self.payment_methods.get(rest[0])
+                return (200, payment_method) if payment_method else self._not_found('payment_method')
+            items = [self.payment_methods[i] for i in self.by_customer.get(('payment_method', params.get('customer')), [])]
+            return 200, self._page(items, params, '/v1/payment_methods')
+        if resource == 'payment_intents' and method == 'POST':
+            with self._lock:
+                self.payment_intents += 1
+            return 200, {'id': self._new_id('pi'), 'object': 'payment_intent', 'status': 'succeeded',
+                         'amount': int(params.get('amount', 0)), 'customer': params.get('customer'),
+                         'metadata': params.get('metadata') or {}}
+        if resource == 'checkout':
+            session_id = self._new_id('cs')
+            return 200, {'id': session_id, 'object': 'checkout.session', 'url': f"https://checkout.invalid/{session_id}"}
+        if resource == 'subscriptions':
+            if method == 'DELETE':
+                subscription = self.subscriptions.get(rest[0])
+                if not subscription:
+                    return self._not_found('subscription')
+                subscription['status'] = 'canceled'
+                return 200, subscription
+            items = [self.subscriptions[i] for i in self.by_customer.get(('subscription', params.get('customer')), [])]
+            return 200, self._page(self._after(items, params), params, '/v1/subscriptions')
+        if resource == 'subscription_schedules':
+            if method == 'POST' and rest[-1:] == ['cancel']:
+                schedule = self.schedules.get(rest[0])
+                if not schedule:
+                    return self._not_found('subscription_schedule')
+                schedule['status'] = 'canceled'
+                return 200, schedule
+            items = [self.schedules[i] for i in self.by_customer.get(('subscription_schedule', params.get('customer')), [])]
+            return 200, self._page(self._after(items, params), params, '/v1/subscription_schedules')
+        if resource == 'events':
+            return 200, self._page([], params, '/v1/events')
+        return self._not_found(resource)
+
+    @staticmethod
+    def _after(items: List[Dict[str, Any]], params: Dict[str, Any]) -> List[Dict[str, Any]]:
+        starting_after = params.get('starting_after')
+        if not starting_after:
+            return items
+        ids = [item['id'] for item in items]
+        return items[ids.index(starting_after) + 1:] if starting_after in ids else []
+
+    def _customers(self, method: str, rest: List[str], params: Dict[str, Any]) -> Tuple[int, Dict[str, Any]]:
+        expand = _expands(params)
+        if not rest:
+            if method == 'POST':
+                customer = self.add_customer(email=params.get('email'), phone=params.get('phone'), payment_method=False)
+                customer['name'] = params.get('name')
+                customer['metadata'] = params.get('metadata') or {}
+                return 200, self._customer_view(customer, expand)
+            if params.get('email'):
+                candidates = self.customers_by_email.get(params['email'], [])
+            else:
+                start = self.customer_index.get(params.get('starting_after'), -1) + 1
+                limit = int(params.get('limit', 10))
+                # Scan just far enough past deleted customers to fill the page
+                candidates = []
+                for customer_id in itertools.islice(self.customer_order, start, None):
+                    if not self.customers[customer_id]['deleted']:
+                        candidates.append(customer_id)
+                        if len(candidates) > limit:
+                            break
+            items = [self._customer_view(self.customers[c], expand) for c in candidates if not self.customers[c]['deleted']]
+            return 200, self._page(items, params, '/v1/customers')
+
+        customer = self.customers.get(rest[0])
+        if customer is None:
+            return self._not_found('customer')
+        if method == 'DELETE':
+            customer['deleted'] = True
+            return 200, {'id': customer['id'], 'object': 'customer', 'deleted': True}
+        if method == 'POST':
+            default = (params.get('invoice_settings') or {}).get('default_payment_method')
+            if default:
+                customer['invoice_settings']['default_payment_method'] = default
+        return 200, self._customer_view(customer, expand)
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _respond(self):
+        fake: FakeStripe = self.server.fake
+        url = urlsplit(self.path)
+        params = _form(parse_qs(url.query))
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            params.update(_form(parse_qs(self.rfile.read(length).decode())))
+        delay = fake.latency()
+        if delay:
+            time.sleep(delay)
+        status, body = fake.handle(self.command, url.path, params, self.headers.get('Idempotency-Key'))
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.send_header('Request-Id', f"req_fake{id(body)}")
+        self.end_headers()
+        self.wfile.write(payload)
+
+    do_GET = do_POST = do_DELETE = _respond
+
+
+class FakeStripeServer:
+    def __init__(self, fake: FakeStripe, host: str = '127.0.0.1', port: int = 0):
+        """
+        Serves a FakeStripe over HTTP from a background thread. Point STRIPE_API_BASE at .url.
+        """
+        self.fake = fake
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.fake = fake
+        self.httpd.daemon_threads = True
+        self.url = f"http://{host}:{self.httpd.server_port}"
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name='fake-stripe', daemon=True)
+
+    def use(self, fake: FakeStripe) -> None:
+        """
+        Swaps in a fresh FakeStripe (e.g. another seed size) without changing the URL the app was configured with.
+        """
+        self.fake = self.httpd.fake = fake
+
+    def __enter__(self) -> 'FakeStripeServer':
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the fake Stripe API server on its own.')
+    parser.add_argument('--port', type=int, default=12111)
+    parser.add_argument('--latency-ms', type=float, default=0.0)
+    parser.add_argument('--jitter-ms', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0)
+    parser.add_argument('--customers', type=int, default=0, help='Customers (with a card) to seed.')
+    args = parser.parse_args()
+
+    fake = FakeStripe(args.latency_ms, args.jitter_ms, args.error_rate, args.rate_limit_rate)
+    fake.seed([f"cus_bench{i:07d}" for i in range(args.customers)])
+    with FakeStripeServer(fake, port=args.port) as server:
+        print(f"Fake Stripe listening on {server.url}")
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == "__main__":
+    main()
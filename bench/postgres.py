@@ -0,0 +1,74 @@
+# bench/postgres.py
+import os
+import shutil
+import socket
+import subprocess
+import tempfile
+from contextlib import contextmanager
+from typing import Iterator
+from urllib.parse import urlsplit
+
+import psycopg2
+
+# Every table the benchmarks write to, emptied before each scenario
+BENCH_TABLES = ('customers', 'charge_info', 'charge_attempts', 'charge_blocks', 'charge_chunks', 'charge_jobs',
+                'charge_runs', 'stripe_customers', 'stripe_mirror_state', 'webhook_events', 'email_outbox')
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+@contextmanager
+def temporary_postgres() -> Iterator[str]:
+    """
+    Starts a throwaway Postgres cluster (initdb + pg_ctl from PATH) in a temp directory and yields its URL.
+    fsync is off: the numbers are for comparing commits against each other, not for sizing production disks.
+    """
+    if not shutil.which('initdb') or not shutil.which('pg_ctl'):
+        raise RuntimeError('initdb/pg_ctl not found on PATH; set BENCH_DATABASE_URL to an existing bench database instead.')
+    directory = tempfile.mkdtemp(prefix='paysync-bench-pg-')
+    data = os.path.join(directory, 'data')
+    port = _free_port()
+    subprocess.run(['initdb', '-D', data, '-U', 'bench', '--auth=trust'], check=True, stdout=subprocess.DEVNULL)
+    subprocess.run(['pg_ctl', '-D', data, '-l', os.path.join(directory, 'postgres.log'), '-w', 'start',
+                    '-o', f"-p {port} -k {directory} -c fsync=off -c max_connections=200"],
+                   check=True, stdout=subprocess.DEVNULL)
+    try:
+        conn = psycopg2.connect(f"postgresql://bench@127.0.0.1:{port}/postgres")
+        conn.autocommit = True
+        with conn.cursor() as cursor:
+            cursor.execute('CREATE DATABASE bench')
+        conn.close()
+        yield f"postgresql://bench@127.0.0.1:{port}/bench"
+    finally:
+        subprocess.run(['pg_ctl', '-D', data, '-m', 'immediate', 'stop'], stdout=subprocess.DEVNULL)
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+@contextmanager
+def bench_database() -> Iterator[str]:
+    """
+    Yields the URL of the benchmark database: BENCH_DATABASE_URL if set, otherwise a temporary cluster.
+    The benchmarks empty the application tables, so an existing database must have 'bench' in its name.
+    """
+    url = os.getenv('BENCH_DATABASE_URL')
+    if not url:
+        with temporary_postgres() as url:
+            yield url
+        return
+    if 'bench' not in urlsplit(url).path:
+        raise RuntimeError('BENCH_DATABASE_URL must point at a database with "bench" in its name; its tables are truncated.')
+    yield url
+
+
+def reset(db) -> None:
+    """
+    Empties every table the benchmarks touch.
+    """
+    with db.get_connection() as conn:
+        with conn:
+            with conn.cursor() as cursor:
+                cursor.execute(f"TRUNCATE {', '.join(BENCH_TABLES)} RESTART IDENTITY CASCADE")
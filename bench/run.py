@@ -0,0 +1,114 @@
+# bench/run.py
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import subprocess
+from typing import Any, Dict
+
+from bench.fake_stripe import FakeStripe, FakeStripeServer
+from bench.postgres import bench_database
+
+SCENARIOS = ('charges', 'endpoints', 'reconcile', 'sweep')
+
+
+def _git(*args: str) -> str:
+    try:
+        return subprocess.run(['git', *args], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+def _configure_environment(database_url: str, stripe_url: str, args: argparse.Namespace, report_dir: str) -> None:
+    # Config reads the environment on import, so this has to happen before any app module is imported
+    os.environ.update({
+        'DATABASE_URL': database_url,
+        'STRIPE_API_BASE': stripe_url,
+        'STRIPE_SECRET_KEY': 'sk_test_bench',
+        'WEBHOOK_SIGNING_SECRET': 'whsec_bench',
+        'REPORT_DIR': report_dir,
+        # Nothing leaves the machine
+        'EMAIL_OUTBOX_WORKER': 'false',
+        'CHARGE_FAILURE_EMAILS': 'false',
+        'DB_POOL_MAX': str(max(args.workers, args.concurrency) * 2 + 4)
+    })
+    if args.stripe_rate:
+        os.environ['STRIPE_RATE_LIMIT'] = str(args.stripe_rate)
+
+
+def run(args: argparse.Namespace) -> Dict[str, Any]:
+    def make_fake() -> FakeStripe:
+        return FakeStripe(args.latency_ms, args.jitter_ms, args.error_rate, args.rate_limit_rate, seed=args.seed)
+
+    results: Dict[str, Any] = {}
+    with bench_database() as database_url, FakeStripeServer(make_fake()) as server:
+        _configure_environment(database_url, server.url, args, os.path.join(args.output_dir, 'reports'))
+        from app import migrate
+        from bench import scenarios
+        migrate.upgrade()
+
+        if 'charges' in args.scenarios:
+            results['charges'] = []
+            for size in args.sizes:
+                logging.warning(f"charges: {size} customers")
+                results['charges'].append(scenarios.bench_charges(server, make_fake, size, args.workers))
+        if 'endpoints' in args.scenarios:
+            logging.warning(f"endpoints: {args.requests} requests per route")
+            results['endpoints'] = scenarios.bench_endpoints(server, make_fake, args.endpoint_customers, args.requests,
+                                                             args.concurrency)
+        if 'reconcile' in args.scenarios:
+            results['reconcile'] = []
+            for size in args.sizes:
+                logging.warning(f"reconcile: {size} customers")
+                results['reconcile'].append(scenarios.bench_reconcile(server, make_fake, size))
+        if 'sweep' in args.scenarios:
+            results['sweep'] = []
+            for size in args.sizes:
+                logging.warning(f"sweep: {size} customers")
+                results['sweep'].append(scenarios.bench_sweep(server, make_fake, size, args.workers))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the service against a fake Stripe and a local Postgres.')
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument('--sizes', nargs='+', type=int, default=[1000, 10000, 100000],
+                        help='Customer counts for charges, reconcile and sweep.')
+    parser.add_argument('--workers', type=int, default=8, help='Charge and sweep workers.')
+    parser.add_argument('--requests', type=int, default=2000, help='Requests per endpoint.')
+    parser.add_argument('--concurrency', type=int, default=16, help='Concurrent endpoint clients.')
+    parser.add_argument('--endpoint-customers', type=int, default=10000, help='Existing customers during the endpoint runs.')
+    parser.add_argument('--latency-ms', type=float, default=30.0, help='Fake Stripe latency per request.')
+    parser.add_argument('--jitter-ms', type=float, default=20.0, help='Uniform extra fake Stripe latency.')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Share of fake Stripe requests failing with a 500.')
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0, help='Share of fake Stripe requests failing with a 429.')
+    parser.add_argument('--stripe-rate', type=float, help='Overrides STRIPE_RATE_LIMIT; the default measures with the production limiter.')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the fake Stripe fault injection.')
+    parser.add_argument('--output-dir', default=os.path.join('bench', 'results'))
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s %(message)s')
+    os.makedirs(args.output_dir, exist_ok=True)
+    started_at = datetime.datetime.now(datetime.timezone.utc)
+    commit = _git('rev-parse', '--short', 'HEAD')
+    results = run(args)
+
+    document = {
+        'commit': commit,
+        'dirty': bool(_git('status', '--porcelain', '--untracked-files=no')),
+        'started_at': started_at.isoformat(),
+        'finished_at': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'settings': {key: value for key, value in vars(args).items() if key != 'output_dir'},
+        'results': results
+    }
+    output = os.path.join(args.output_dir, f"{started_at:%Y%m%dT%H%M%S}_{commit or 'nocommit'}.json")
+    with open(output, 'w') as file:
+        json.dump(document, file, indent=4)
+    print(f"Results written to {output}")
+
+
+if __name__ == "__main__":
+    main()
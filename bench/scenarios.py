@@ -0,0 +1,239 @@
+# bench/scenarios.py
+# Imported by bench.run only after it has pointed the app's environment at the fake Stripe server and the bench database.
+import hashlib
+import hmac
+import json
+import math
+import os
+import random
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Tuple
+
+import requests
+from werkzeug.serving import make_server
+
+import check_existence
+import sub_remover
+from app import stripe_mirror
+from app.charge_calendar import process_charges
+from app.config import Config
+from app.database import get_database
+from app.queries import Queries
+from bench.fake_stripe import FakeStripe, FakeStripeServer
+from bench.postgres import reset
+
+queries = Queries()
+
+TYPE_CODE = 'bench'
+CHARGE_INFO = {'amount': 1000, 'card_upcharge': 30}
+
+
+def customer_ids(count: int) -> List[str]:
+    return [f"cus_bench{i:07d}" for i in range(count)]
+
+
+def seed_database(ids: List[str]) -> None:
+    reset(get_database())
+    queries.insert_many('customers', [{
+        'customer_id': customer_id,
+        'email': f"{customer_id}@bench.invalid",
+        'phone': f"+1555{i:07d}",
+        'name': json.dumps({'first': 'Bench', 'last': str(i)}),
+        'customer_type': TYPE_CODE
+    } for i, customer_id in enumerate(ids)])
+    queries.upsert_many('charge_info', [{'type_code': TYPE_CODE, 'label': 'Benchmark', 'data': json.dumps(CHARGE_INFO)}],
+                        ['type_code'])
+
+
+def percentiles(latencies: List[float]) -> Dict[str, float]:
+    # Nearest-rank percentiles, in milliseconds
+    ordered = sorted(latencies)
+    if not ordered:
+        return {}
+    rank = lambda p: ordered[min(len(ordered) - 1, max(0, math.ceil(p / 100 * len(ordered)) - 1))]
+    return {
+        'p50_ms': rank(50) * 1000,
+        'p90_ms': rank(90) * 1000,
+        'p99_ms': rank(99) * 1000,
+        'max_ms': ordered[-1] * 1000
+    }
+
+
+def _attempt_counts(run_id: int) -> Dict[str, int]:
+    with get_database().get_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT status, count(*) FROM charge_attempts WHERE run_id = %s GROUP BY status", (run_id,))
+            return dict(cursor.fetchall())
+
+
+def bench_charges(server: FakeStripeServer, make_fake: Callable[[], FakeStripe], size: int, workers: int) -> Dict[str, Any]:
+    """
+    Seeds size customers (each with a card in the fake Stripe) and times one process_charges run over all of them.
+    """
+    ids = customer_ids(size)
+    fake = make_fake()
+    fake.seed(ids)
+    server.use(fake)
+    seed_database(ids)
+
+    started = time.perf_counter()
+    run_id = process_charges(TYPE_CODE, workers=workers)
+    elapsed = time.perf_counter() - started
+    return {
+        'size': size,
+        'workers': workers,
+        'seconds': elapsed,
+        'customers_per_second': size / elapsed,
+        'attempts': _attempt_counts(run_id),
+        'payment_intents': fake.payment_intents,
+        'stripe_requests': sum(fake.requests.values())
+    }
+
+
+@contextmanager
+def app_server() -> Iterator[str]:
+    """
+    Serves the Flask app from a threaded werkzeug server in the background and yields its base URL.
+    """
+    from app.main import create_app
+    httpd = make_server('127.0.0.1', 0, create_app(), threaded=True)
+    thread = threading.Thread(target=httpd.serve_forever, name='bench-app', daemon=True)
+    thread.start()
+    try:
+        yield f"http://127.0.0.1:{httpd.server_port}"
+    finally:
+        httpd.shutdown()
+
+
+def _signed_webhook(index: int, customer_id: str) -> Tuple[str, Dict[str, str]]:
+    now = int(time.time())
+    payload = json.dumps({
+        'id': f"evt_bench{index:08d}",
+        'object': 'event',
+        'type': 'customer.updated',
+        'created': now,
+        'data': {'object': {'id': customer_id, 'object': 'customer', 'email': f"{customer_id}@bench.invalid",
+                            'created': now, 'invoice_settings': {'default_payment_method': f"pm_{customer_id}"}}}
+    })
+    signature = hmac.new(Config.WEBHOOK_SIGNING_SECRET.encode(), f"{now}.{payload}".encode(), hashlib.sha256).hexdigest()
+    return payload, {'Stripe-Signature': f"t={now},v1={signature}", 'Content-Type': 'application/json'}
+
+
+def _route_request(route: str, index: int, ids: List[str]) -> Tuple[str, Dict[str, Any]]:
+    if route == '/submit-application':
+        return route, {'json': {
+            'email': f"signup{index}@bench.invalid",
+            'phone': f"+1666{index:07d}",
+            'name': {'first': 'Bench', 'last': str(index)},
+            'address': {'state': 'CA', 'city': 'Bench', 'address1': '1 Bench Way', 'zip': '90000'}
+        }}
+    if route == '/customer-payment-methods':
+        return route, {'json': {'customer_id': random.Random(index).choice(ids)}}
+    payload, headers = _signed_webhook(index, random.Random(index).choice(ids))
+    return route, {'data': payload, 'headers': headers}
+
+
+def bench_http(base_url: str, route: str, ids: List[str], total: int, concurrency: int) -> Dict[str, Any]:
+    """
+    Sends total POST requests to route from concurrency client threads (keep-alive sessions) and reports latency.
+    """
+    local = threading.local()
+
+    def send(index: int) -> Tuple[float, int]:
+        if not hasattr(local, 'session'):
+            local.session = requests.Session()
+        path, kwargs = _route_request(route, index, ids)
+        started = time.perf_counter()
+        response = local.session.post(base_url + path, timeout=60, **kwargs)
+        return time.perf_counter() - started, response.status_code
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='bench-client') as executor:
+        outcomes = list(executor.map(send, range(total)))
+    elapsed = time.perf_counter() - started
+    statuses: Dict[str, int] = {}
+    for _, status in outcomes:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    return {
+        'route': route,
+        'requests': total,
+        'concurrency': concurrency,
+        'requests_per_second': total / elapsed,
+        'statuses': statuses,
+        **percentiles([latency for latency, _ in outcomes])
+    }
+
+
+def bench_endpoints(server: FakeStripeServer, make_fake: Callable[[], FakeStripe], size: int, total: int,
+                    concurrency: int) -> List[Dict[str, Any]]:
+    """
+    Latency of the customer facing endpoints against size existing customers, with the Stripe mirror synced.
+    """
+    ids = customer_ids(size)
+    fake = make_fake()
+    fake.seed(ids)
+    server.use(fake)
+    seed_database(ids)
+    stripe_mirror.full_sync()
+
+    with app_server() as base_url:
+        return [bench_http(base_url, route, ids, total, concurrency)
+                for route in ('/submit-application', '/customer-payment-methods', '/webhook')]
+
+
+def bench_reconcile(server: FakeStripeServer, make_fake: Callable[[], FakeStripe], size: int) -> Dict[str, Any]:
+    """
+    Times a full reconciliation with 1% of the customers missing on each side.
+    """
+    ids = customer_ids(size)
+    drift = max(1, size // 100)
+    fake = make_fake()
+    fake.seed(ids[drift:])
+    server.use(fake)
+    seed_database(ids[:-drift])
+
+    started = time.perf_counter()
+    report = check_existence.reconcile_full()
+    elapsed = time.perf_counter() - started
+    return {
+        'size': size,
+        'seconds': elapsed,
+        'customers_per_second': size / elapsed,
+        'missing_in_stripe': len(report['missing_in_stripe']),
+        'missing_in_db': len(report['missing_in_db']),
+        'stripe_requests': sum(fake.requests.values())
+    }
+
+
+def bench_sweep(server: FakeStripeServer, make_fake: Callable[[], FakeStripe], size: int, workers: int,
+                subscriptions: int = 2) -> Dict[str, Any]:
+    """
+    Times the subscription sweep over size Stripe customers with the given number of active subscriptions each.
+    """
+    fake = make_fake()
+    fake.seed(customer_ids(size), subscriptions=subscriptions)
+    server.use(fake)
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix='paysync-bench-sweep-') as directory:
+        # The sweep writes its checkpoint and summary into the working directory
+        os.chdir(directory)
+        try:
+            started = time.perf_counter()
+            sub_remover.remove_subscriptions_from_all_customers(workers, False, os.path.join(directory, 'checkpoint.txt'))
+            elapsed = time.perf_counter() - started
+        finally:
+            os.chdir(cwd)
+    cancelled = sum(1 for subscription in fake.subscriptions.values() if subscription['status'] == 'canceled')
+    return {
+        'size': size,
+        'workers': workers,
+        'seconds': elapsed,
+        'customers_per_second': size / elapsed,
+        'subscriptions_cancelled': cancelled,
+        'stripe_requests': sum(fake.requests.values())
+    }
@@ -1,77 +1,180 @@
-# app/check_customers.py
-import stripe
+# check_existence.py
+import argparse
+import datetime
+import json
+import os
 import logging
-from typing import List, Dict
+from typing import Dict, Iterator, Set
+from app import stripe_client
+from app.stripe_mirror import CUSTOMER_EVENTS
+from app.lazy import lazy_import
 from app.queries import Queries
 
+stripe = lazy_import('stripe')
+
 queries = Queries()
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-def get_customers_from_db() -> List[Dict[str, str]]:
+# Stripe only keeps events for 30 days, older checkpoints need a full reconciliation
+EVENT_RETENTION = datetime.timedelta(days=30)
+
+
+def stream_customer_ids_from_db() -> Iterator[str]:
     """
-    Fetch customers from the database.
-    
+    Stream customer IDs from the database through a server-side cursor.
+
     Returns:
-        List[Dict[str, str]]: List of customers with their customer_id.
+        Iterator[str]: The customer_id of every customer record.
     """
-    return queries.fetch_records(
+    for customer in queries.stream_records(
         table_name='customers',
         fields=[],
         values=[],
         return_fields=['customer_id']
-    )
+    ):
+        if not customer.get('customer_id'):
+            logger.error("Customer record without customer_id found.")
+            continue
+        yield customer['customer_id']
+
+def stripe_customer_ids() -> Set[str]:
+    """
+    Page through every Stripe customer, 100 per request.
+
+    Returns:
+        Set[str]: The IDs of all (non-deleted) Stripe customers.
+    """
+    return {customer.id for customer in stripe_client.list_all(stripe.Customer.list)}
 
 def check_customer_exists_in_stripe(customer_id: str) -> bool:
     """
     Check if a customer exists in Stripe.
-    
+
     Args:
         customer_id (str): The customer ID to check.
-        
+
     Returns:
         bool: True if the customer exists in Stripe, False otherwise.
     """
     try:
-        stripe.Customer.retrieve(customer_id)
-        return True
+        customer = stripe_client.call(stripe.Customer.retrieve, customer_id)
+        return not getattr(customer, 'deleted', False)
     except stripe.error.InvalidRequestError:
         return False
     except stripe.StripeError as e:
         logger.error(f"Stripe error when checking customer {customer_id}: {e.user_message}")
         return False
 
+def reconcile_full() -> Dict:
+    """
+    Diff every DB customer against every Stripe customer with a set join: the Stripe IDs are loaded into a set,
+    the DB IDs are streamed past it, and whatever is left in the set afterwards is missing from the DB.
+
+    Returns:
+        Dict: Counts and both directions of the diff.
+    """
+    in_stripe = stripe_customer_ids()
+    stripe_total = len(in_stripe)
+    db_total = 0
+    missing_in_stripe = []
+
+    for customer_id in stream_customer_ids_from_db():
+        db_total += 1
+        if customer_id in in_stripe:
+            in_stripe.discard(customer_id)
+        else:
+            missing_in_stripe.append(customer_id)
+
+    return {
+        'stripe_customers': stripe_total,
+        'db_customers': db_total,
+        'missing_in_stripe': sorted(missing_in_stripe),
+        'missing_in_db': sorted(in_stripe)
+    }
+
+def reconcile_incremental(since: datetime.datetime) -> Dict:
+    """
+    Diff only the customers that changed since the last checkpoint: Stripe customers with a customer.created,
+    .updated or .deleted event since then, and DB customers inserted since then.
+
+    Args:
+        since (datetime.datetime): The previous checkpoint.
+
+    Returns:
+        Dict: Counts and both directions of the diff, limited to the changed customers.
+    """
+    # Events come newest first, so the first event seen per customer is its current state. Only the customer's own
+    # events: 'customer.*' also matches customer.subscription.* and the like, whose object is not a customer.
+    deleted_in_stripe: Dict[str, bool] = {}
+    for event in stripe_client.list_all(stripe.Event.list, types=list(CUSTOMER_EVENTS),
+                                        created={'gte': int(since.timestamp())}):
+        customer_id = event.data.object.id
+        if customer_id not in deleted_in_stripe:
+            deleted_in_stripe[customer_id] = event.type == 'customer.deleted'
+
+    in_db = queries.fetch_existing_keys('customers', 'customer_id', list(deleted_in_stripe))
+    missing_in_db = [customer_id for customer_id, deleted in deleted_in_stripe.items() if not deleted and customer_id not in in_db]
+    missing_in_stripe = [customer_id for customer_id, deleted in deleted_in_stripe.items() if deleted and customer_id in in_db]
+
+    # New DB customers without any Stripe event in the window have to be checked one by one; there are few of them
+    new_db_customers = 0
+    for customer_id in queries.stream_customer_ids_created_since(since):
+        new_db_customers += 1
+        if customer_id not in deleted_in_stripe and not check_customer_exists_in_stripe(customer_id):
+            missing_in_stripe.append(customer_id)
+
+    return {
+        'stripe_customers_changed': len(deleted_in_stripe),
+        'db_customers_new': new_db_customers,
+        'missing_in_stripe': sorted(missing_in_stripe),
+        'missing_in_db': sorted(missing_in_db)
+    }
+
+def load_checkpoint(path: str) -> datetime.datetime | None:
+    if not os.path.exists(path):
+        return None
+    with open(path) as file:
+        return datetime.datetime.fromisoformat(json.load(file)['last_synced_at'])
+
+def save_checkpoint(path: str, synced_at: datetime.datetime) -> None:
+    with open(path, 'w') as file:
+        json.dump({'last_synced_at': synced_at.isoformat()}, file)
+
 def main():
     """
-    Main function to check if all customers in the database exist in Stripe.
+    Reconcile the customers in the database with the customers in Stripe and write a JSON report.
     """
-    customers = get_customers_from_db()
-    if not customers:
-        logger.error("No customers found in the database.")
-        return
-
-    non_existing_customers = []
-    
-    for customer in customers:
-        customer_id = customer.get('customer_id')
-        if not customer_id:
-            logger.error("Customer record without customer_id found.")
-            continue
-        
-        if not check_customer_exists_in_stripe(customer_id):
-            non_existing_customers.append(customer_id)
-    
-    logger.info(f"Total customers checked: {len(customers)}")
-    logger.info(f"Non-existing customers in Stripe: {len(non_existing_customers)}")
-    
-    if non_existing_customers:
-        logger.info("List of non-existing customer IDs:")
-        for customer_id in non_existing_customers:
-            logger.info(customer_id)
+    parser = argparse.ArgumentParser(description='Reconcile database customers with Stripe customers.')
+    parser.add_argument('--incremental', action='store_true', help='Only check customers changed since the last checkpoint.')
+    parser.add_argument('--checkpoint', default='reconcile_checkpoint.json', help='Checkpoint file for incremental runs.')
+    parser.add_argument('--output', help='Report path. Defaults to reconcile_report_<timestamp>.json.')
+    args = parser.parse_args()
+
+    stripe_client.configure()
+    started_at = datetime.datetime.now(datetime.timezone.utc)
+    since = load_checkpoint(args.checkpoint) if args.incremental else None
+    if args.incremental and (since is None or started_at - since > EVENT_RETENTION):
+        logger.info("No usable checkpoint, running a full reconciliation.")
+        since = None
+
+    if since is None:
+        report = {'mode': 'full', **reconcile_full()}
     else:
-        logger.info("All customers exist in Stripe.")
+        report = {'mode': 'incremental', 'since': since.isoformat(), **reconcile_incremental(since)}
+    report['started_at'] = started_at.isoformat()
+    report['finished_at'] = datetime.datetime.now(datetime.timezone.utc).isoformat()
+
+    output = args.output or f"reconcile_report_{started_at:%Y-%m-%d_%H-%M-%S}.json"
+    with open(output, 'w') as file:
+        json.dump(report, file, indent=4)
+    save_checkpoint(args.checkpoint, started_at)
+
+    logger.info(f"Non-existing customers in Stripe: {len(report['missing_in_stripe'])}")
+    logger.info(f"Stripe customers missing from the database: {len(report['missing_in_db'])}")
+    logger.info(f"Report written to {output}")
 
 if __name__ == "__main__":
     main()
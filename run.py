@@ -1,11 +1,14 @@
 # run.py
-from app.main import app
+from app.config import Config
+from app.main import create_app
 import logging
+import os
 
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 logger.info('Logger initialized.')
 
 if __name__ == "__main__":
-    app.run(debug=True)
-
+    # The debug reloader serves the app from a child process; only that one starts the background workers
+    serving = os.environ.get('WERKZEUG_RUN_MAIN') == 'true'
+    create_app(start_workers=Config.BACKGROUND_WORKERS and serving).run(debug=True)
@@ -1,89 +1,126 @@
-import stripe
-from dotenv import load_dotenv
+import argparse
 import os
+import threading
 import logging
+from dotenv import load_dotenv
 
+# Load .env before the app modules read their configuration
 load_dotenv()
-stripe.api_key = os.getenv('STRIPE_SECRET_KEY')
 
-# Set up basic configuration for logging
-logging.basicConfig(level=logging.INFO, filename='subscription_removal_report.log', filemode='w',
-                    format='%(asctime)s - %(levelname)s - %(message)s')
+from concurrent.futures import ThreadPoolExecutor
+from app import stripe_client
+from app.config import Config
+from app.lazy import lazy_import
+from app.pipeline import imap_unordered
+
+stripe = lazy_import('stripe')
+
+# Schedules and subscriptions in these states have nothing left to cancel
+FINISHED_SCHEDULE_STATUSES = {'canceled', 'completed', 'released'}
+FINISHED_SUBSCRIPTION_STATUSES = {'canceled', 'incomplete_expired'}
 
-def cancel_all_subscriptions(customer_id):
+
+def cancel_all_subscriptions(customer_id, dry_run=False):
     try:
         total_removed = 0
 
-        # Cancel each scheduled subscription
-        scheduled_subscriptions = stripe.SubscriptionSchedule.list(customer=customer_id)
-        for scheduled_subscription in scheduled_subscriptions.auto_paging_iter():
-            if stripe.SubscriptionSchedule.retrieve(scheduled_subscription.id).status == 'canceled':
-                logging.info(f"Subscription schedule {scheduled_subscription.id} is already canceled.")
-                
-            elif stripe.SubscriptionSchedule.retrieve(scheduled_subscription.id).status == 'not_started':
-                logging.info(f"Subscription schedule {scheduled_subscription.id} has not started yet.")
-                stripe.SubscriptionSchedule.cancel(scheduled_subscription.id)
-                total_removed += 1
-                
-            elif stripe.SubscriptionSchedule.retrieve(scheduled_subscription.id).status == 'active':
-                logging.info(f"Subscription schedule {scheduled_subscription.id} is active. Cancelling now.")
-                stripe.SubscriptionSchedule.cancel(scheduled_subscription.id)
-                total_removed += 1
-                
-            try:
-                stripe.SubscriptionSchedule.cancel(scheduled_subscription.id)
-                total_removed += 1
-            except:
-                logging.error(f"Failed to cancel subscription schedule {scheduled_subscription.id}.")
-            
-        # Cancel each active subscription
-        subscriptions = stripe.Subscription.list(customer=customer_id, status='all')
-        for subscription in subscriptions.auto_paging_iter():
-            stripe.Subscription.delete(subscription.id)
+        # Cancel each scheduled subscription. The listing already carries the status, no retrieve needed.
+        for scheduled_subscription in stripe_client.list_all(stripe.SubscriptionSchedule.list, customer=customer_id):
+            if scheduled_subscription.status in FINISHED_SCHEDULE_STATUSES:
+                logging.info(f"Subscription schedule {scheduled_subscription.id} is already {scheduled_subscription.status}.")
+                continue
+            if dry_run:
+                logging.info(f"[dry run] Would cancel {scheduled_subscription.status} subscription schedule {scheduled_subscription.id}.")
+            else:
+                logging.info(f"Subscription schedule {scheduled_subscription.id} is {scheduled_subscription.status}. Cancelling now.")
+                stripe_client.call(stripe.SubscriptionSchedule.cancel, scheduled_subscription.id)
             total_removed += 1
-            
-        try:
-            stripe.Subscription.delete(subscription.id)
+
+        # Cancel each remaining subscription (cancelling an active schedule above already cancels its subscription)
+        for subscription in stripe_client.list_all(stripe.Subscription.list, customer=customer_id, status='all'):
+            if subscription.status in FINISHED_SUBSCRIPTION_STATUSES:
+                continue
+            if dry_run:
+                logging.info(f"[dry run] Would cancel {subscription.status} subscription {subscription.id}.")
+            else:
+                stripe_client.call(stripe.Subscription.delete, subscription.id)
             total_removed += 1
-        except:
-            logging.error(f"Failed to cancel subscription {subscription.id}.")
-                
+
         if total_removed > 0:
             logging.info(f"All subscriptions (active and scheduled) cancelled for customer {customer_id}. Total removed: {total_removed}")
-            return total_removed
         else:
             logging.info(f"No subscriptions found for customer {customer_id} to remove.")
-            return 0
+        return total_removed
     except stripe.StripeError as e:
         # Handle Stripe API errors
         logging.error(f"Stripe API error occurred for customer {customer_id}: {e}")
-        return 0
+        return None
     except Exception as e:
         # Handle other errors
         logging.error(f"An error occurred for customer {customer_id}: {e}")
-        return 0
+        return None
 
-def remove_subscriptions_from_all_customers():
+def load_checkpoint(path):
+    if not os.path.exists(path):
+        return set()
+    with open(path) as file:
+        return {line.strip() for line in file if line.strip()}
+
+def summary_path_for(checkpoint_path, dry_run=False):
+    # Next to the sweep's checkpoint, and separate for dry runs so they never overwrite a real sweep's summary
+    base = os.path.splitext(checkpoint_path)[0]
+    return f"{base}_dry_run_summary.txt" if dry_run else f"{base}_summary.txt"
+
+def remove_subscriptions_from_all_customers(workers=None, dry_run=False, checkpoint_path='subscription_removal_checkpoint.txt',
+                                            summary_path=None):
     total_customers = 0
     total_subscriptions_removed = 0
+    failed_customers = 0
+    workers = workers or Config.CHARGE_WORKERS
+
+    # Customers finished by an earlier, interrupted sweep
+    done = set() if dry_run else load_checkpoint(checkpoint_path)
+    if done:
+        logging.info(f"Resuming sweep, skipping {len(done)} customers from {checkpoint_path}.")
+    checkpoint_lock = threading.Lock()
 
     try:
-        # Fetch all customers
-        customers = stripe.Customer.list()
+        with open(os.devnull if dry_run else checkpoint_path, 'a') as checkpoint:
+            def sweep(customer_id):
+                removed = cancel_all_subscriptions(customer_id, dry_run)
+                if removed is None:
+                    # Not checkpointed, so a rerun tries this customer again
+                    return None
+                with checkpoint_lock:
+                    checkpoint.write(customer_id + '\n')
+                    checkpoint.flush()
+                return removed
 
-        # Cancel all subscriptions for each customer
-        for customer in customers.auto_paging_iter():
-            subs_removed = cancel_all_subscriptions(customer.id)
-            total_customers += 1
-            total_subscriptions_removed += subs_removed
+            customer_ids = (customer.id for customer in stripe_client.list_all(stripe.Customer.list) if customer.id not in done)
+            with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='sweep') as executor:
+                for subs_removed in imap_unordered(executor, sweep, customer_ids, workers * 2):
+                    total_customers += 1
+                    if subs_removed is None:
+                        failed_customers += 1
+                    else:
+                        total_subscriptions_removed += subs_removed
 
         logging.info(f"Processed {total_customers} customers in total.")
         logging.info(f"Total subscriptions removed from all customers: {total_subscriptions_removed}")
+        if failed_customers:
+            logging.warning(f"{failed_customers} customers failed and will be retried on the next run.")
 
         # Write the summary to a text file
-        with open('summary_report.txt', 'w') as file:
+        summary_path = summary_path or summary_path_for(checkpoint_path, dry_run)
+        with open(summary_path, 'w') as file:
+            if dry_run:
+                file.write("Dry run, nothing was cancelled.\n")
+            if done:
+                file.write(f"Customers skipped (finished by an earlier run): {len(done)}\n")
             file.write(f"Total customers processed: {total_customers}\n")
             file.write(f"Total subscriptions removed: {total_subscriptions_removed}\n")
+            file.write(f"Customers failed: {failed_customers}\n")
+        logging.info(f"Summary written to {summary_path}")
     except stripe.StripeError as e:
         # Handle Stripe API errors
         logging.error(f"Stripe API error occurred while processing all customers: {e}")
@@ -91,5 +128,25 @@ def remove_subscriptions_from_all_customers():
         # Handle other errors
         logging.error(f"An error occurred while processing all customers: {e}")
 
-# Example usage
-remove_subscriptions_from_all_customers()
+def main():
+    parser = argparse.ArgumentParser(description='Cancel every subscription and subscription schedule of every Stripe customer.')
+    parser.add_argument('--workers', type=int, help='Customers processed concurrently. Defaults to CHARGE_WORKERS.')
+    parser.add_argument('--dry-run', action='store_true', help='Only report what would be cancelled.')
+    parser.add_argument('--checkpoint', default='subscription_removal_checkpoint.txt',
+                        help='File of finished customer IDs; an interrupted sweep resumes from it.')
+    parser.add_argument('--restart', action='store_true', help='Ignore and truncate an existing checkpoint.')
+    parser.add_argument('--output', help='Summary path. Defaults to <checkpoint>_summary.txt, or '
+                                         '<checkpoint>_dry_run_summary.txt for a dry run.')
+    args = parser.parse_args()
+
+    # Set up basic configuration for logging
+    logging.basicConfig(level=logging.INFO, filename='subscription_removal_report.log', filemode='w',
+                        format='%(asctime)s - %(levelname)s - %(threadName)s - %(message)s')
+
+    stripe_client.configure(os.getenv('STRIPE_SECRET_KEY'))
+    if args.restart and os.path.exists(args.checkpoint):
+        os.remove(args.checkpoint)
+    remove_subscriptions_from_all_customers(args.workers, args.dry_run, args.checkpoint, args.output)
+
+if __name__ == "__main__":
+    main()
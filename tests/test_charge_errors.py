@@ -0,0 +1,39 @@
+# tests/test_charge_errors.py
+import pytest
+import stripe
+
+from app import charge_errors
+from app.charge_errors import PERMANENT, TRANSIENT
+
+
+def card_error(decline_code: str | None) -> stripe.CardError:
+    body = {'error': {'type': 'card_error', 'code': 'card_declined'}}
+    if decline_code:
+        body['error']['decline_code'] = decline_code
+    return stripe.CardError('Your card was declined.', None, 'card_declined', json_body=body)
+
+
+@pytest.mark.parametrize('error, failure_type, failure_code', [
+    (card_error('insufficient_funds'), PERMANENT, 'insufficient_funds'),
+    (card_error('try_again_later'), TRANSIENT, 'try_again_later'),
+    (card_error(None), PERMANENT, 'card_declined'),
+    (stripe.RateLimitError('Too many requests'), TRANSIENT, 'rate_limit'),
+    (stripe.APIConnectionError('Read timed out'), TRANSIENT, 'api_connection_error'),
+    (stripe.InvalidRequestError('Locked', None, code='lock_timeout'), TRANSIENT, 'lock_timeout'),
+    (stripe.InvalidRequestError('No such customer', 'customer', code='resource_missing'), PERMANENT, 'resource_missing'),
+    (stripe.InvalidRequestError('Bad amount', 'amount'), PERMANENT, 'invalid_request_error'),
+    (stripe.AuthenticationError('Invalid API key'), TRANSIENT, 'authentication_error'),
+    (stripe.APIError('Bad gateway', http_status=502), TRANSIENT, 'http_502'),
+])
+def test_classify(error, failure_type, failure_code):
+    failure = charge_errors.classify(error)
+    assert (failure['failure_type'], failure['failure_code']) == (failure_type, failure_code)
+    assert failure['reason']
+
+
+def test_only_soft_declines_need_a_new_idempotency_key():
+    # Stripe replays the stored decline for the same key; everything else reuses it so a charge that went through is returned
+    for code in charge_errors.SOFT_DECLINE_CODES:
+        assert charge_errors.needs_new_idempotency_key(code)
+    for code in ['api_connection_error', 'rate_limit', 'lock_timeout', 'http_502', 'insufficient_funds', None]:
+        assert not charge_errors.needs_new_idempotency_key(code)
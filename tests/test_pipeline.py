@@ -0,0 +1,56 @@
+# tests/test_pipeline.py
+import itertools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from app.pipeline import imap_unordered
+
+
+def test_items_are_pulled_no_further_ahead_than_max_in_flight():
+    pulled = []
+
+    def items():
+        for item in itertools.count():
+            pulled.append(item)
+            yield item
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        results = imap_unordered(executor, lambda item: item * 2, items(), max_in_flight=3)
+        for taken, result in enumerate(itertools.islice(results, 10), start=1):
+            assert result % 2 == 0
+            # Everything pulled is either yielded already or one of the at most 3 calls in flight
+            assert len(pulled) - taken < 3
+        results.close()
+    assert len(pulled) <= 13
+
+
+def test_no_more_than_max_in_flight_calls_run_at_once():
+    lock = threading.Lock()
+    running, peak = [0], [0]
+
+    def work(item):
+        with lock:
+            running[0] += 1
+            peak[0] = max(peak[0], running[0])
+        time.sleep(0.01)
+        with lock:
+            running[0] -= 1
+        return item
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        assert sorted(imap_unordered(executor, work, range(20), max_in_flight=2)) == list(range(20))
+    assert peak[0] <= 2
+
+
+def test_errors_are_raised_when_collected():
+    def work(item):
+        if item == 3:
+            raise ValueError(item)
+        return item
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        with pytest.raises(ValueError):
+            list(imap_unordered(executor, work, range(10), max_in_flight=2))
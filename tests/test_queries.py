@@ -0,0 +1,54 @@
+# tests/test_queries.py
+import datetime
+import os
+
+import pytest
+
+from app import database, sql
+from app.config import Config
+
+# The round trips need a scratch Postgres database; they create and drop their own table in it
+TEST_DATABASE_URL = os.getenv('TEST_DATABASE_URL')
+
+
+def test_copy_rows_keeps_none_and_empty_strings_apart():
+    buffer = sql.copy_rows([(None, '', 1, True, 'a "b"', {'k': None})])
+    assert buffer.read() == ',"",1,t,"a ""b""","{""k"": null}"\n'
+
+
+@pytest.fixture
+def queries(monkeypatch):
+    if not TEST_DATABASE_URL:
+        pytest.skip('TEST_DATABASE_URL is not set')
+    pytest.importorskip('psycopg2')
+    from app.queries import Queries
+    monkeypatch.setattr(Config, 'DATABASE_URL', TEST_DATABASE_URL)
+    monkeypatch.setattr(database, '_database', None)
+    queries = Queries()
+    with queries.db.get_connection() as conn:
+        with conn, conn.cursor() as cursor:
+            cursor.execute("CREATE TABLE copy_round_trip (id INTEGER PRIMARY KEY, label TEXT, seen TIMESTAMPTZ, n INTEGER)")
+    yield queries
+    with queries.db.get_connection() as conn:
+        with conn, conn.cursor() as cursor:
+            cursor.execute("DROP TABLE copy_round_trip")
+
+
+@pytest.mark.parametrize('copy_threshold', [1, 10 ** 9], ids=['copy', 'execute_values'])
+@pytest.mark.parametrize('conflict_fields', [None, ['id']], ids=['insert', 'upsert'])
+def test_none_round_trips_as_null(queries, monkeypatch, copy_threshold, conflict_fields):
+    monkeypatch.setattr(Config, 'DB_COPY_THRESHOLD', copy_threshold)
+    seen = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+    rows = [
+        {'id': 1, 'label': None, 'seen': None, 'n': None},
+        {'id': 2, 'label': '', 'seen': seen, 'n': 0}
+    ]
+    if conflict_fields is None:
+        queries.insert_many('copy_round_trip', rows)
+    else:
+        queries.upsert_many('copy_round_trip', rows, conflict_fields)
+
+    with queries.db.get_connection() as conn:
+        with conn, conn.cursor() as cursor:
+            cursor.execute("SELECT id, label, seen, n FROM copy_round_trip ORDER BY id")
+            assert cursor.fetchall() == [(1, None, None, None), (2, '', seen, 0)]
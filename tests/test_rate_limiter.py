@@ -0,0 +1,64 @@
+# tests/test_rate_limiter.py
+import pytest
+
+from app import rate_limiter
+from app.rate_limiter import TokenBucket
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(rate_limiter.time, 'monotonic', lambda: now[0])
+    return now
+
+
+def test_waiting_higher_priority_takes_refilled_tokens_first(clock):
+    bucket = TokenBucket(rate=10, burst=1)
+    assert bucket._attempt(1, priority=0, register=False) == 0.0
+
+    # Empty bucket: the high priority caller registers and waits for the refill
+    assert bucket._attempt(1, priority=100, register=True) == pytest.approx(0.1)
+    clock[0] += 0.1
+    # The token is back, but a lower priority leaves it to the waiting caller
+    assert bucket._attempt(1, priority=0, register=False) > 0
+    assert bucket._attempt(1, priority=100, register=False) == 0.0
+    bucket._leave(100)
+
+    clock[0] += 0.1
+    assert bucket._attempt(1, priority=0, register=False) == 0.0
+
+
+def test_equal_priorities_are_not_held_back(clock):
+    bucket = TokenBucket(rate=10, burst=1)
+    bucket._attempt(1, priority=0, register=False)
+    assert bucket._attempt(1, priority=5, register=True) > 0
+    clock[0] += 0.1
+    assert bucket._attempt(1, priority=5, register=False) == 0.0
+
+
+def test_acquire_returns_the_time_waited(clock, monkeypatch):
+    monkeypatch.setattr(rate_limiter.time, 'sleep', lambda seconds: clock.__setitem__(0, clock[0] + seconds))
+    bucket = TokenBucket(rate=4, burst=1)
+    assert bucket.acquire() == 0.0
+    assert bucket.acquire() == pytest.approx(0.25)
+    assert bucket._waiting == {}
+
+
+def test_throttle_halves_the_rate_down_to_the_floor_and_drains_the_bucket(clock):
+    bucket = TokenBucket(rate=100, min_rate=20)
+    bucket.throttle()
+    assert bucket.rate == 50
+    assert bucket._attempt(1, priority=0, register=False) > 0
+    bucket.throttle()
+    bucket.throttle()
+    assert bucket.rate == 20
+
+
+def test_recover_raises_the_rate_additively_up_to_the_ceiling(clock):
+    bucket = TokenBucket(rate=100, min_rate=1)
+    bucket.throttle(0.5)
+    bucket.recover()
+    assert bucket.rate == 51
+    for _ in range(100):
+        bucket.recover()
+    assert bucket.rate == 100
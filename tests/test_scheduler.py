@@ -0,0 +1,64 @@
+# tests/test_scheduler.py
+import datetime
+
+import pytest
+
+from app import scheduler
+
+
+def test_parse_schedule_fills_in_defaults():
+    schedule = scheduler.parse_schedule({'days_of_month': [1, '15']})
+    assert schedule['days_of_month'] == {1, 15}
+    assert schedule['weekdays'] == set()
+    assert schedule['at'] == datetime.time(0, 0)
+    assert schedule['timezone'].key == 'UTC'
+    assert schedule['window'] == datetime.timedelta(0)
+    assert schedule['priority'] == 0
+
+
+@pytest.mark.parametrize('schedule', [
+    {},
+    {'days_of_month': [0]},
+    {'days_of_month': [32]},
+    {'weekdays': [7]},
+    {'days_of_month': [1], 'window_minutes': -5},
+    {'days_of_month': [1], 'at': '25:00'},
+])
+def test_parse_schedule_rejects_malformed_schedules(schedule):
+    with pytest.raises(ValueError):
+        scheduler.parse_schedule(schedule)
+
+
+@pytest.mark.parametrize('wanted, day, expected', [
+    # Days a month does not have fall on its last day
+    ([31], datetime.date(2025, 4, 30), True),
+    ([31], datetime.date(2025, 4, 29), False),
+    ([30], datetime.date(2025, 2, 28), True),
+    ([29], datetime.date(2024, 2, 28), False),
+    ([29], datetime.date(2024, 2, 29), True),
+    ([31], datetime.date(2025, 1, 31), True),
+    # Earlier days are not moved to the last day
+    ([15], datetime.date(2025, 4, 30), False),
+    ([28], datetime.date(2025, 2, 28), True),
+])
+def test_days_of_month_past_the_end_fall_on_the_last_day(wanted, day, expected):
+    assert scheduler._matches(scheduler.parse_schedule({'days_of_month': wanted}), day) is expected
+
+
+def test_weekdays_match_alongside_days_of_month():
+    schedule = scheduler.parse_schedule({'days_of_month': [1], 'weekdays': [0]})
+    assert scheduler._matches(schedule, datetime.date(2025, 4, 7))  # a Monday
+    assert scheduler._matches(schedule, datetime.date(2025, 4, 1))
+    assert not scheduler._matches(schedule, datetime.date(2025, 4, 8))
+
+
+def test_latest_occurrence_is_in_the_schedules_timezone():
+    schedule = scheduler.parse_schedule({'days_of_month': [31], 'at': '06:00', 'timezone': 'America/New_York'})
+    now = datetime.datetime(2025, 5, 1, 3, 0, tzinfo=datetime.timezone.utc)  # still April 30 in New York
+    assert scheduler.latest_occurrence(schedule, now) == datetime.datetime(2025, 4, 30, 10, 0, tzinfo=datetime.timezone.utc)
+
+
+def test_latest_occurrence_skips_todays_occurrence_before_its_time():
+    schedule = scheduler.parse_schedule({'days_of_month': [15], 'at': '06:00'})
+    now = datetime.datetime(2025, 4, 15, 5, 59, tzinfo=datetime.timezone.utc)
+    assert scheduler.latest_occurrence(schedule, now) == datetime.datetime(2025, 3, 15, 6, 0, tzinfo=datetime.timezone.utc)
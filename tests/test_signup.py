@@ -0,0 +1,33 @@
+# tests/test_signup.py
+from app.signup import signup_key
+
+NAME = {'first': 'Ada', 'last': 'Lovelace'}
+ADDRESS = {'state': 'NY', 'city': 'New York', 'address1': '1 Main St', 'zip': '10001'}
+
+
+def key(**overrides):
+    signup = {'email': 'ada@example.com', 'phone': '(555) 555-0100', 'name': NAME, 'address': ADDRESS, 'metadata': {}}
+    signup.update(overrides)
+    return signup_key(**signup)
+
+
+def test_key_ignores_formatting_of_email_and_phone():
+    assert key() == key(email=' Ada@Example.com ', phone='+1 555 555 0100')
+
+
+def test_key_ignores_key_order_of_nested_fields():
+    assert key() == key(address=dict(reversed(list(ADDRESS.items()))))
+
+
+def test_key_covers_the_whole_payload():
+    # A signup with the same email and phone but other details is a different signup, not a retry of the first
+    assert key() != key(name={'first': 'Ada', 'last': 'Byron'})
+    assert key() != key(address={**ADDRESS, 'zip': '10002'})
+    assert key() != key(metadata={'plan': 'pro'})
+    assert key() != key(email='ada@example.org')
+
+
+def test_key_includes_the_request_key():
+    assert key(request_key='form-1') == key(request_key='form-1')
+    assert key(request_key='form-1') != key(request_key='form-2')
+    assert key(request_key='form-1') != key()
@@ -0,0 +1,60 @@
+# tests/test_sql.py
+import pytest
+
+from app import sql
+
+
+def test_compile_query_shapes():
+    assert sql.compile_query('exists', 'customers', ('email', 'phone')) == \
+        'SELECT 1 FROM "customers" WHERE "email" = %s OR "phone" = %s LIMIT 1'
+    assert sql.compile_query('select', 'customers', ('customer_type',), ('customer_id', 'email')) == \
+        'SELECT "customer_id", "email" FROM "customers" WHERE "customer_type" = %s'
+    assert sql.compile_query('select', 'customers', (), ('*',)) == 'SELECT * FROM "customers"'
+    assert sql.compile_query('insert', 'customers', ('customer_id', 'email')) == \
+        'INSERT INTO "customers" ("customer_id", "email") VALUES (%s, %s)'
+    assert sql.compile_query('delete', 'customers', ('customer_id', 'email')) == \
+        'DELETE FROM "customers" WHERE "customer_id" = %s AND "email" = %s'
+
+
+def test_compile_query_rejects_unconditional_deletes_and_unknown_shapes():
+    with pytest.raises(ValueError):
+        sql.compile_query('delete', 'customers')
+    with pytest.raises(ValueError):
+        sql.compile_query('update', 'customers', ('email',))
+
+
+def test_identifiers_are_quoted():
+    assert sql.quote_identifier('public.charge_info') == '"public"."charge_info"'
+    assert sql.compile_query('select', 'customers; DROP TABLE customers', ('a"b',), ('id',)) == \
+        'SELECT "id" FROM "customers; DROP TABLE customers" WHERE "a""b" = %s'
+
+
+def test_compile_insert_values_conflict_handling():
+    insert = 'INSERT INTO "stripe_customers" ("customer_id", "email") VALUES %s'
+    assert sql.compile_insert_values('stripe_customers', ('customer_id', 'email')) == insert
+    assert sql.compile_insert_values('stripe_customers', ('customer_id', 'email'), ('customer_id',)) == \
+        insert + ' ON CONFLICT ("customer_id") DO NOTHING'
+    assert sql.compile_insert_values('stripe_customers', ('customer_id', 'email'), ('customer_id',), ('email',)) == \
+        insert + ' ON CONFLICT ("customer_id") DO UPDATE SET "email" = EXCLUDED."email"'
+    assert sql.compile_insert_values('stripe_customers', ('customer_id', 'email'), ('customer_id',), ('email',),
+                                     'stripe_customers.email IS NULL') == \
+        insert + ' ON CONFLICT ("customer_id") DO UPDATE SET "email" = EXCLUDED."email" WHERE stripe_customers.email IS NULL'
+
+
+def test_compile_insert_select_merges_a_staging_table():
+    assert sql.compile_insert_select('customers', 'staging_1', ('customer_id', 'email'), ('customer_id',), ('email',)) == \
+        'INSERT INTO "customers" ("customer_id", "email") SELECT "customer_id", "email" FROM "staging_1" ' \
+        'ON CONFLICT ("customer_id") DO UPDATE SET "email" = EXCLUDED."email"'
+
+
+def test_set_based_statements_take_an_array():
+    assert sql.compile_delete_any('customers', 'customer_id') == 'DELETE FROM "customers" WHERE "customer_id" = ANY(%s)'
+    assert sql.compile_select_any('customers', 'customer_id') == \
+        'SELECT "customer_id" FROM "customers" WHERE "customer_id" = ANY(%s)'
+
+
+def test_to_positional_numbers_placeholders_in_order():
+    assert sql.to_positional('SELECT 1 FROM t WHERE a = %s OR b = %s LIMIT %s') == \
+        'SELECT 1 FROM t WHERE a = $1 OR b = $2 LIMIT $3'
+    assert sql.to_positional('SELECT 1') == 'SELECT 1'
+    assert sql.to_positional('%s') == '$1'
@@ -0,0 +1,30 @@
+# tests/test_stripe_client.py
+import pytest
+import stripe
+
+from app import stripe_client
+
+
+def test_write_without_idempotency_key_is_not_safe_to_retry():
+    assert not stripe_client._safe_to_retry(stripe.PaymentIntent.create, {'amount': 100})
+    assert not stripe_client._safe_to_retry(stripe.PaymentIntent.create, {'amount': 100, 'idempotency_key': None})
+    assert not stripe_client._safe_to_retry(stripe.PaymentIntent.create, {'amount': 100, 'idempotency_key': ''})
+
+
+def test_write_with_idempotency_key_and_reads_are_safe_to_retry():
+    assert stripe_client._safe_to_retry(stripe.PaymentIntent.create, {'idempotency_key': 'charge-run-1-cus_1'})
+    assert stripe_client._safe_to_retry(stripe.Customer.retrieve, {})
+
+
+def test_call_does_not_replay_a_write_with_a_none_idempotency_key(monkeypatch):
+    monkeypatch.setattr(stripe_client.time, 'sleep', lambda seconds: None)
+    calls = []
+
+    def create(**kwargs):
+        calls.append(kwargs)
+        raise stripe.APIConnectionError('Read timed out')
+    create.__name__ = create.__qualname__ = 'create'
+
+    with pytest.raises(stripe.APIConnectionError):
+        stripe_client.call(create, amount=100, idempotency_key=None)
+    assert len(calls) == 1